@@ -1,32 +1,64 @@
 import os
+import sys
 import logging
+import queue
+import atexit
+from logging.handlers import QueueHandler, QueueListener
 import traceback
 import time
 import uuid
 import random
 import re
+import bisect
+import heapq
+import math
+import unicodedata
+import threading
 from typing import Dict, Any, Optional, Tuple, List
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass, asdict, field
 from functools import wraps
+from contextlib import contextmanager
 import json
-from collections import defaultdict
+import collections
+from collections import defaultdict, OrderedDict, deque
 import hashlib
-
-from flask import Flask, render_template, request, jsonify, session, abort
+import sqlite3
+import tempfile
+import hmac
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from types import MappingProxyType
+from urllib.parse import urljoin, urlparse
+
+from flask import Flask, render_template, request, jsonify, session, abort, g, Response, has_request_context, stream_with_context
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
+from limits.storage import Storage as LimitsStorage
+from werkzeug.exceptions import HTTPException
+from werkzeug.middleware.proxy_fix import ProxyFix
 from twilio.request_validator import RequestValidator
 import bleach
+import requests
 from markupsafe import escape
 
-# Configuração de logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+try:
+    import openai  # Opcional: sem ele as respostas usam os fallbacks
+except ImportError:
+    openai = None
+
+try:
+    import tiktoken  # Opcional: contagem exata de tokens nos prompts
+except ImportError:
+    tiktoken = None
+
+from thumbnails import Image, make_thumbnail  # Pillow é opcional (Image = None sem ele)
+
+# Logging configurado em setup_logging() logo após o Config
 logger = logging.getLogger(__name__)
 
 # ===== CONFIGURAÇÃO =====
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
 @dataclass
 class Config:
     SECRET_KEY: str = os.getenv('SECRET_KEY', 'carglass-secreto-render-key')
@@ -37,6 +69,8 @@ class Config:
     USE_REAL_API: bool = os.getenv('USE_REAL_API', 'true').lower() == 'true'
     SESSION_TIMEOUT: int = int(os.getenv('SESSION_TIMEOUT', '1800'))
     CACHE_TTL: int = int(os.getenv('CACHE_TTL', '300'))
+    CLIENT_CACHE_MAX_RECORDS: int = int(os.getenv('CLIENT_CACHE_MAX_RECORDS', '1000'))
+    CLIENT_NEGATIVE_CACHE_TTL: int = int(os.getenv('CLIENT_NEGATIVE_CACHE_TTL', '60'))  # "Cliente não encontrado"
 
     # Configurações Twilio
     TWILIO_ACCOUNT_SID: str = os.getenv('TWILIO_ACCOUNT_SID', '')
@@ -44,21 +78,807 @@ class Config:
     TWILIO_WHATSAPP_NUMBER: str = os.getenv('TWILIO_WHATSAPP_NUMBER', 'whatsapp:+14155238886')
     TWILIO_ENABLED: bool = bool(os.getenv('TWILIO_ACCOUNT_SID'))
 
+    # Sanitização de entrada
+    MAX_INPUT_CHARS: int = int(os.getenv('MAX_INPUT_CHARS', '2000'))
+
+    # Rate limiting compartilhado entre workers ("shared" ou "memory")
+    RATELIMIT_STORAGE: str = os.getenv('RATELIMIT_STORAGE', 'shared')
+    RATELIMIT_SHARED_PATH: str = os.getenv('RATELIMIT_SHARED_PATH', '')  # Padrão: /dev/shm/carglass-ratelimit.sqlite3
+    # Proxies reversos à frente da app (Render: 1). Sem isso todos os clientes têm o IP do proxy
+    TRUSTED_PROXY_HOPS: int = int(os.getenv('TRUSTED_PROXY_HOPS', '1'))
+
+    # Proteção contra abuso (HMLSecurityManager)
+    ABUSE_WINDOW_SECONDS: int = int(os.getenv('ABUSE_WINDOW_SECONDS', '3600'))
+    ABUSE_MAX_REQUESTS: int = int(os.getenv('ABUSE_MAX_REQUESTS', '200'))
+    ABUSE_BLOCK_SECONDS: int = int(os.getenv('ABUSE_BLOCK_SECONDS', '3600'))
+    ABUSE_MAX_TRACKED_IPS: int = int(os.getenv('ABUSE_MAX_TRACKED_IPS', '10000'))
+
+    # Logging
+    LOG_LEVEL: str = os.getenv('LOG_LEVEL', 'INFO')
+    LOG_FORMAT: str = os.getenv('LOG_FORMAT', 'text')  # "text" ou "json"
+    LOG_ASYNC: bool = os.getenv('LOG_ASYNC', 'true').lower() == 'true'
+    LOG_QUEUE_SIZE: int = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+    LOG_LEVELS: str = os.getenv('LOG_LEVELS', '')  # Ex.: "werkzeug=WARNING,app=DEBUG"
+    LOG_DEBUG_SAMPLE_RATE: float = float(os.getenv('LOG_DEBUG_SAMPLE_RATE', '1.0'))
+
+    # Observabilidade
+    METRICS_TOKEN: str = os.getenv('METRICS_TOKEN', '')  # Vazio = /metrics só no modo DEBUG
+    TRACE_SLOW_THRESHOLD_MS: int = int(os.getenv('TRACE_SLOW_THRESHOLD_MS', '5000'))
+    TRACE_EXPORT_FILE: str = os.getenv('TRACE_EXPORT_FILE', '')  # Ex.: /tmp/carglass-traces.jsonl
+    TRACE_EXPORT_SLOW_ONLY: bool = os.getenv('TRACE_EXPORT_SLOW_ONLY', 'true').lower() == 'true'
+    ADMIN_TOKEN: str = os.getenv('ADMIN_TOKEN', '')  # Libera /debug/profile fora do modo DEBUG
+
+    # Definição das etapas do atendimento (status, rótulos, progresso, emoji)
+    PIPELINE_FILE: str = os.getenv('PIPELINE_FILE', os.path.join(DATA_DIR, 'pipeline.json'))
+
+    STORES_FILE: str = os.getenv('STORES_FILE', os.path.join(DATA_DIR, 'lojas.json'))
+    STORES_NEAREST_COUNT: int = int(os.getenv('STORES_NEAREST_COUNT', '3'))
+    FUZZY_MAX_DISTANCE: float = float(os.getenv('FUZZY_MAX_DISTANCE', '1.0'))  # Custo máximo de edição para sugerir (< 2)
+    FUZZY_MAX_IDENTIFIERS: int = int(os.getenv('FUZZY_MAX_IDENTIFIERS', '100000'))  # Por tipo (placa/ordem); 0 = sem limite
+    FAQ_FILE: str = os.getenv('FAQ_FILE', os.path.join(DATA_DIR, 'faq.json'))
+    FAQ_MIN_SCORE: float = float(os.getenv('FAQ_MIN_SCORE', '0.35'))  # Similaridade mínima (0-1) para responder sem IA
+
+    # Consulta em lote para a central de atendimento (/api/status/batch)
+    BATCH_API_KEYS: str = os.getenv('BATCH_API_KEYS', '')  # Chaves separadas por vírgula; vazio = desabilitado
+    BATCH_MAX_IDENTIFIERS: int = int(os.getenv('BATCH_MAX_IDENTIFIERS', '200'))
+    BATCH_MAX_WORKERS: int = int(os.getenv('BATCH_MAX_WORKERS', '8'))  # Consultas simultâneas à API de status
+
+    # Fotos recebidas no WhatsApp (etapa "Aguardando fotos")
+    MEDIA_DIR: str = os.getenv('MEDIA_DIR', os.path.join(tempfile.gettempdir(), 'carglass-media'))
+    MEDIA_ALLOWED_HOSTS: str = os.getenv('MEDIA_ALLOWED_HOSTS', 'api.twilio.com,media.twiliocdn.com,mms.twiliocdn.com')
+    MEDIA_MAX_BYTES: int = int(os.getenv('MEDIA_MAX_BYTES', str(10 * 1024 * 1024)))
+    MEDIA_CHUNK_SIZE: int = int(os.getenv('MEDIA_CHUNK_SIZE', '65536'))
+    MEDIA_DOWNLOAD_TIMEOUT: int = int(os.getenv('MEDIA_DOWNLOAD_TIMEOUT', '30'))
+    MEDIA_DOWNLOAD_WORKERS: int = int(os.getenv('MEDIA_DOWNLOAD_WORKERS', '4'))
+    MEDIA_THUMBNAIL_WORKERS: int = int(os.getenv('MEDIA_THUMBNAIL_WORKERS', '2'))  # Processos (Pillow é CPU)
+    MEDIA_THUMBNAIL_SIZE: int = int(os.getenv('MEDIA_THUMBNAIL_SIZE', '320'))
+
+    # Controle de admissão das rotas de mensagem (por processo). Os limites de requisições em
+    # andamento precisam ficar abaixo de --threads do gunicorn (Procfile: 16), senão nunca disparam
+    ADMISSION_SOFT_LIMIT: int = int(os.getenv('ADMISSION_SOFT_LIMIT', '8'))  # Em andamento: acima disso, sem IA
+    ADMISSION_HARD_LIMIT: int = int(os.getenv('ADMISSION_HARD_LIMIT', '12'))  # Em andamento: acima disso, 503
+    # Espera no proxy: só com um proxy que envie X-Request-Start (o do Render não envia)
+    ADMISSION_SOFT_QUEUE_MS: int = int(os.getenv('ADMISSION_SOFT_QUEUE_MS', '2000'))
+    ADMISSION_HARD_QUEUE_MS: int = int(os.getenv('ADMISSION_HARD_QUEUE_MS', '8000'))
+    ADMISSION_RETRY_AFTER: int = int(os.getenv('ADMISSION_RETRY_AFTER', '5'))  # Segundos sugeridos no Retry-After
+
+    # Atualização de status em background (avisos proativos no WhatsApp)
+    STATUS_REFRESH_ENABLED: bool = os.getenv('STATUS_REFRESH_ENABLED', 'false').lower() == 'true'
+    STATUS_REFRESH_INTERVAL: int = int(os.getenv('STATUS_REFRESH_INTERVAL', '300'))  # Segundos entre ciclos
+    STATUS_REFRESH_BATCH_SIZE: int = int(os.getenv('STATUS_REFRESH_BATCH_SIZE', '20'))
+    STATUS_REFRESH_MAX_RPS: float = float(os.getenv('STATUS_REFRESH_MAX_RPS', '2'))  # Consultas à API por segundo
+
+    # Resposta de status gerada antecipadamente logo após a identificação
+    SPECULATIVE_STATUS_ENABLED: bool = os.getenv('SPECULATIVE_STATUS_ENABLED', 'true').lower() == 'true'
+    SPECULATIVE_STATUS_WORKERS: int = int(os.getenv('SPECULATIVE_STATUS_WORKERS', '2'))
+    SPECULATIVE_STATUS_TTL: int = int(os.getenv('SPECULATIVE_STATUS_TTL', '300'))  # Segundos até descartar
+
+    # Orçamento de tokens por chamada OpenAI
+    PROMPT_MAX_TOKENS: int = int(os.getenv('PROMPT_MAX_TOKENS', '1500'))  # Sistema + histórico + pergunta
+    OPENAI_MAX_TOKENS: str = os.getenv('OPENAI_MAX_TOKENS', 'identification=350,status=250,chat=150')  # Resposta
+
+    # Cliente OpenAI
+    OPENAI_TIMEOUT: float = float(os.getenv('OPENAI_TIMEOUT', '20'))  # Segundos por tentativa
+    OPENAI_MAX_RETRIES: int = int(os.getenv('OPENAI_MAX_RETRIES', '2'))
+    OPENAI_RETRY_BACKOFF: float = float(os.getenv('OPENAI_RETRY_BACKOFF', '0.5'))  # Base do backoff exponencial
+    OPENAI_POOL_SIZE: int = int(os.getenv('OPENAI_POOL_SIZE', '10'))  # Conexões HTTP mantidas abertas
+
+    # Roteamento de modelos por finalidade (identification, status, chat)
+    OPENAI_MODELS: str = os.getenv('OPENAI_MODELS', 'chat=gpt-3.5-turbo')  # Sem entrada: OPENAI_MODEL
+    OPENAI_FAST_MODEL: str = os.getenv('OPENAI_FAST_MODEL', 'gpt-3.5-turbo')
+    OPENAI_BUSY_CALLS: int = int(os.getenv('OPENAI_BUSY_CALLS', '8'))  # Chamadas simultâneas = "sob carga"
+    OPENAI_LATENCY_BUDGET_MS: int = int(os.getenv('OPENAI_LATENCY_BUDGET_MS', '8000'))  # Por requisição
+    OPENAI_PRICES: str = os.getenv(  # USD por 1K tokens: "modelo=prompt/completion"
+        'OPENAI_PRICES', 'gpt-4-turbo=0.01/0.03,gpt-4o=0.005/0.015,gpt-3.5-turbo=0.0005/0.0015')
+
+    # Histórico da conversa enviado à OpenAI
+    CONTEXT_WINDOW_TURNS: int = int(os.getenv('CONTEXT_WINDOW_TURNS', '4'))  # Trocas recentes na íntegra
+    CONTEXT_MAX_TOKENS: int = int(os.getenv('CONTEXT_MAX_TOKENS', '600'))  # Trocas recentes + resumo
+    CONTEXT_SUMMARY_MAX_TOKENS: int = int(os.getenv('CONTEXT_SUMMARY_MAX_TOKENS', '200'))
+
 config = Config()
 
+def parse_mapping_setting(value: str) -> Dict[str, str]:
+    """Lê configurações no formato "chave=valor,chave=valor" (ex.: LOG_LEVELS)"""
+    mapping = {}
+    for item in filter(None, (part.strip() for part in value.split(','))):
+        key, _, val = item.partition('=')
+        if key.strip() and val.strip():
+            mapping[key.strip()] = val.strip()
+    return mapping
+
+# ===== LOGGING =====
+TEXT_LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+LOG_HANDLER_NAME = "carglass"  # Marca o handler instalado por setup_logging
+
+class JsonLogFormatter(logging.Formatter):
+    """Uma linha JSON por registro (campos estáveis para ingestão)"""
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            "request_id": getattr(record, 'request_id', None),
+            "thread": record.threadName
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+class RequestIdFilter(logging.Filter):
+    """Anexa o ID da requisição (g.request_id) ainda na thread que gerou o log"""
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = g.get('request_id') if has_request_context() else None
+        return True
+
+class DebugSamplingFilter(logging.Filter):
+    """Mantém apenas uma fração dos registros DEBUG (alto volume no caminho quente)"""
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG or self.rate >= 1.0:
+            return True
+        return random.random() < self.rate
+
+class LazyQueueHandler(QueueHandler):
+    """
+    QueueHandler que adia a formatação para a thread do QueueListener.
+    Só resolve na hora o que não pode atravessar threads com segurança:
+    tracebacks e argumentos mutáveis.
+    """
+    SAFE_ARG_TYPES = (str, int, float, bool, type(None))
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        args = record.args
+        if args:
+            values = args.values() if isinstance(args, dict) else args
+            if not all(isinstance(value, self.SAFE_ARG_TYPES) for value in values):
+                record.msg = record.getMessage()
+                record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        # Sob rajada, descarta em vez de bloquear a requisição
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def setup_logging(cfg: Config) -> logging.Handler:
+    """
+    Configura o logging da aplicação: texto (formato original) ou JSON,
+    escrita síncrona ou via fila + thread de background, nível por módulo
+    (LOG_LEVELS="werkzeug=WARNING,app=DEBUG") e amostragem de DEBUG.
+    Idempotente: se o módulo for importado de novo (ex.: como __main__ e
+    como app), reaproveita o handler já instalado no logger raiz.
+    """
+    root = logging.getLogger()
+    root.setLevel(cfg.LOG_LEVEL.upper())
+    for name, level in parse_mapping_setting(cfg.LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(level.upper())
+
+    for existing in root.handlers:
+        if existing.get_name() == LOG_HANDLER_NAME:
+            return existing
+
+    formatter = JsonLogFormatter() if cfg.LOG_FORMAT == 'json' else logging.Formatter(TEXT_LOG_FORMAT)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+
+    if cfg.LOG_ASYNC:
+        log_queue = queue.Queue(maxsize=cfg.LOG_QUEUE_SIZE)
+        handler = LazyQueueHandler(log_queue)
+        listener = QueueListener(log_queue, stream_handler)
+        listener.start()
+        atexit.register(listener.stop)  # Esvazia a fila no encerramento do worker
+    else:
+        handler = stream_handler
+
+    handler.addFilter(RequestIdFilter())
+    handler.addFilter(DebugSamplingFilter(cfg.LOG_DEBUG_SAMPLE_RATE))
+    handler.set_name(LOG_HANDLER_NAME)
+    root.addHandler(handler)
+    return handler
+
+log_handler = setup_logging(config)
+
 # ===== FLASK APP =====
 app = Flask(__name__)
 app.secret_key = config.SECRET_KEY
+if config.TRUSTED_PROXY_HOPS > 0:
+    # remote_addr/url vêm de X-Forwarded-For/-Proto: limites por cliente e URL https na assinatura da Twilio
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=config.TRUSTED_PROXY_HOPS, x_proto=config.TRUSTED_PROXY_HOPS)
+
+# ===== ARMAZENAMENTO COMPARTILHADO DE LIMITES =====
+class SharedCounterStore:
+    """
+    Contadores com expiração compartilhados entre os workers do gunicorn
+    na mesma máquina. Usa SQLite em modo WAL sobre um arquivo local (por
+    padrão em /dev/shm, ou seja, memória compartilhada): cada incremento
+    é um único UPSERT atômico, sem serviço externo.
+    """
+    PURGE_EVERY = 1000  # Remove chaves expiradas a cada N incrementos
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._ops = 0
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS counters ("
+            "key TEXT PRIMARY KEY, value INTEGER NOT NULL, expires REAL NOT NULL) WITHOUT ROWID"
+        )
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # Uma conexão por thread; autocommit para que cada comando seja atômico
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            self._local.conn = conn
+        return conn
+
+    def incr(self, key: str, expiry: float, amount: int = 1) -> int:
+        now = time.time()
+        row = self._conn().execute(
+            "INSERT INTO counters (key, value, expires) VALUES (?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET "
+            "value = CASE WHEN expires <= ? THEN excluded.value ELSE value + excluded.value END, "
+            "expires = CASE WHEN expires <= ? THEN excluded.expires ELSE expires END "
+            "RETURNING value",
+            (key, amount, now + expiry, now, now)
+        ).fetchone()
+
+        self._ops += 1
+        if self._ops % self.PURGE_EVERY == 0:
+            self.purge_expired()
+        return row[0]
+
+    def set(self, key: str, value: int, expiry: float):
+        self._conn().execute(
+            "INSERT OR REPLACE INTO counters (key, value, expires) VALUES (?, ?, ?)",
+            (key, value, time.time() + expiry)
+        )
+
+    def get(self, key: str) -> int:
+        row = self._conn().execute(
+            "SELECT value FROM counters WHERE key = ? AND expires > ?", (key, time.time())
+        ).fetchone()
+        return row[0] if row else 0
+
+    def get_expiry(self, key: str) -> float:
+        row = self._conn().execute(
+            "SELECT expires FROM counters WHERE key = ? AND expires > ?", (key, time.time())
+        ).fetchone()
+        return row[0] if row else time.time()
+
+    def count_prefix(self, prefix: str) -> int:
+        row = self._conn().execute(
+            "SELECT COUNT(*) FROM counters WHERE key >= ? AND key < ? AND expires > ?",
+            (prefix, prefix + "￿", time.time())
+        ).fetchone()
+        return row[0]
+
+    def clear(self, key: str):
+        self._conn().execute("DELETE FROM counters WHERE key = ?", (key,))
+
+    def reset(self) -> int:
+        return self._conn().execute("DELETE FROM counters").rowcount
+
+    def purge_expired(self) -> int:
+        return self._conn().execute("DELETE FROM counters WHERE expires <= ?", (time.time(),)).rowcount
+
+    def check(self) -> bool:
+        try:
+            self._conn().execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+_shared_stores: Dict[str, SharedCounterStore] = {}
+
+def get_shared_store(path: str) -> SharedCounterStore:
+    """Uma instância por arquivo, compartilhada entre limiter e security manager"""
+    store = _shared_stores.get(path)
+    if store is None:
+        store = _shared_stores[path] = SharedCounterStore(path)
+    return store
+
+class SharedLimiterStorage(LimitsStorage):
+    """
+    Backend do flask-limiter (estratégia fixed-window) sobre o
+    SharedCounterStore. Registrado no esquema "carglass-shared://<caminho>".
+    """
+    STORAGE_SCHEME = ["carglass-shared"]
+
+    def __init__(self, uri: Optional[str] = None, wrap_exceptions: bool = False, **options):
+        path = uri.split("://", 1)[1] if uri and "://" in uri else default_shared_store_path()
+        self.store = get_shared_store(path)
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+
+    @property
+    def base_exceptions(self):
+        return sqlite3.Error
+
+    # elastic_expiry só existe nas versões antigas da biblioteca limits
+    def incr(self, key: str, expiry: int, elastic_expiry: bool = False, amount: int = 1) -> int:
+        return self.store.incr(key, expiry, amount)
+
+    def get(self, key: str) -> int:
+        return self.store.get(key)
+
+    def get_expiry(self, key: str) -> float:
+        return self.store.get_expiry(key)
+
+    def check(self) -> bool:
+        return self.store.check()
+
+    def reset(self) -> Optional[int]:
+        return self.store.reset()
+
+    def clear(self, key: str):
+        self.store.clear(key)
+
+def default_shared_store_path() -> str:
+    if config.RATELIMIT_SHARED_PATH:
+        return config.RATELIMIT_SHARED_PATH
+    base_dir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(base_dir, 'carglass-ratelimit.sqlite3')
+
+def build_limiter_storage_uri() -> str:
+    """Usa o armazenamento compartilhado quando disponível; senão memória local"""
+    if config.RATELIMIT_STORAGE != 'shared':
+        return "memory://"
+    path = default_shared_store_path()
+    try:
+        get_shared_store(path)
+        return f"carglass-shared://{path}"
+    except Exception as e:
+        logger.error(f"❌ Armazenamento compartilhado de limites indisponível ({path}): {e}. Usando memória local.")
+        return "memory://"
+
+limiter_storage_uri = build_limiter_storage_uri()
 
 # ===== CONFIGURAÇÃO DE SEGURANÇA PARA HML =====
 # Rate Limiting (CRÍTICO mesmo em HML)
-# REMOVIDO key_func=get_remote_address do construtor Limiter conforme correção anterior
+# flask-limiter 3.x: key_func é o primeiro argumento posicional e o app vai por keyword
 limiter = Limiter(
-    app,
+    get_remote_address,
+    app=app,
     default_limits=["500 per day", "100 per hour"],  # Mais permissivo para testes
-    storage_uri="memory://"
+    storage_uri=limiter_storage_uri
 )
 
+# ===== MÉTRICAS (FORMATO PROMETHEUS) =====
+# Instrumentação leve: um lock por métrica e nenhuma dependência externa.
+# Os valores são por processo (cada worker gunicorn expõe os seus).
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+TOKEN_BUCKETS = (25, 50, 100, 200, 400, 800, 1600, 3200)
+
+def _format_labels(labelnames: Tuple[str, ...], labelvalues: Tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{name}="{value}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values: Dict[Tuple[str, ...], float] = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self.values[key] += amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = list(self.values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets))
+        # chave -> [contagens por bucket (+Inf no fim), soma, total]
+        self.values: Dict[Tuple[str, ...], list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Mede a duração do bloco; preenche o label `outcome` se a métrica o tiver"""
+        start = time.perf_counter()
+        outcome = "success"
+        try:
+            yield
+        except Exception:
+            outcome = "error"
+            raise
+        finally:
+            if "outcome" in self.labelnames and "outcome" not in labels:
+                labels["outcome"] = outcome
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = [(key, (list(state[0]), state[1], state[2])) for key, state in self.values.items()]
+        for key, (counts, total_sum, total_count) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                bucket_labels = _format_labels(self.labelnames, key, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            bucket_labels = _format_labels(self.labelnames, key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{bucket_labels} {total_count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total_sum}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {total_count}")
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: List[Any] = []
+        self._gauges: List[Tuple[str, str, Any]] = []
+
+    def counter(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_LATENCY_BUCKETS) -> Histogram:
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge_callback(self, name: str, documentation: str, func):
+        """Gauge calculado apenas no momento da coleta (custo zero no caminho quente)"""
+        self._gauges.append((name, documentation, func))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for name, documentation, func in self._gauges:
+            try:
+                value = func()
+            except Exception as e:
+                logger.error(f"Erro ao calcular gauge {name}: {e}")
+                continue
+            lines.extend([f"# HELP {name} {documentation}", f"# TYPE {name} gauge", f"{name} {value}"])
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+
+metric_http_requests = metrics.counter(
+    "carglass_http_requests_total", "Requisições HTTP por rota, método e status", ("route", "method", "status"))
+metric_http_duration = metrics.histogram(
+    "carglass_http_request_duration_seconds", "Duração das requisições HTTP por rota", ("route",))
+metric_message_handling = metrics.histogram(
+    "carglass_message_handling_seconds", "Tempo de tratamento da mensagem por etapa", ("stage", "platform"))
+metric_status_api_duration = metrics.histogram(
+    "carglass_status_api_duration_seconds", "Duração das consultas à API de status", ("tipo", "outcome"))
+metric_status_api_fallback = metrics.counter(
+    "carglass_status_api_fallback_total", "Consultas atendidas pelos dados mockados", ("tipo",))
+metric_client_cache = metrics.counter(
+    "carglass_client_cache_total", "Consultas de cliente no cache", ("result",))
+metric_openai_duration = metrics.histogram(
+    "carglass_openai_request_duration_seconds", "Duração das chamadas OpenAI", ("purpose", "model", "outcome"))
+metric_openai_tokens = metrics.histogram(
+    "carglass_openai_tokens", "Tokens por chamada OpenAI", ("purpose", "model", "kind"), TOKEN_BUCKETS)
+metric_openai_retries = metrics.counter(
+    "carglass_openai_retries_total", "Novas tentativas de chamadas OpenAI", ("purpose", "model"))
+metric_openai_routing = metrics.counter(
+    "carglass_openai_routing_total", "Modelo escolhido por finalidade e motivo", ("purpose", "model", "reason"))
+metric_openai_cost = metrics.counter(
+    "carglass_openai_cost_usd_total", "Custo estimado das chamadas OpenAI (USD)", ("purpose", "model"))
+metric_prompt_tokens = metrics.histogram(
+    "carglass_prompt_tokens_estimated", "Tokens do prompt contados localmente antes do envio", ("purpose",), TOKEN_BUCKETS)
+metric_prompt_truncated = metrics.counter(
+    "carglass_prompt_truncated_total", "Prompts cortados para caber no orçamento de tokens", ("purpose",))
+metric_status_refresh = metrics.counter(
+    "carglass_status_refresh_total", "Registros atualizados em background por resultado", ("outcome",))
+metric_status_notifications = metrics.counter(
+    "carglass_status_notifications_total", "Avisos de mudança de status enviados no WhatsApp", ("outcome",))
+metric_status_speculation = metrics.counter(
+    "carglass_status_speculation_total", "Respostas de status antecipadas por resultado", ("outcome",))
+metric_identifier_suggestions = metrics.counter(
+    "carglass_identifier_suggestions_total", "Sugestões \"você quis dizer\" para identificadores", ("outcome",))
+metric_faq_lookups = metrics.counter(
+    "carglass_faq_lookups_total", "Perguntas livres consultadas na base de FAQ", ("result",))
+metric_media_downloads = metrics.counter(
+    "carglass_media_downloads_total", "Fotos do WhatsApp por resultado do download", ("outcome",))
+metric_media_bytes = metrics.counter("carglass_media_bytes_total", "Bytes de fotos do WhatsApp gravados em disco")
+metric_media_thumbnails = metrics.counter(
+    "carglass_media_thumbnails_total", "Miniaturas de fotos por resultado", ("outcome",))
+metric_admission = metrics.counter(
+    "carglass_admission_total", "Decisões do controle de admissão por rota", ("route", "decision"))
+metric_request_queue = metrics.histogram(
+    "carglass_request_queue_seconds", "Tempo de espera no proxy antes da aplicação (X-Request-Start)", ("route",))
+metric_batch_lookups = metrics.counter(
+    "carglass_batch_lookups_total", "Identificadores consultados via /api/status/batch", ("result",))
+metric_twilio_duration = metrics.histogram(
+    "carglass_twilio_send_duration_seconds", "Duração dos envios via Twilio", ("outcome",))
+
+def record_openai_usage(purpose: str, model: str, response: Any) -> Dict[str, int]:
+    """Registra tokens de prompt/completion retornados pela OpenAI"""
+    try:
+        usage = response.get('usage') or {}
+    except AttributeError:
+        return {}
+    for kind in ('prompt_tokens', 'completion_tokens'):
+        if kind in usage:
+            metric_openai_tokens.observe(usage[kind], purpose=purpose, model=model, kind=kind.split('_')[0])
+    return usage
+
+# ===== TRACING DE REQUISIÇÕES =====
+class RequestTracer:
+    """
+    Tracing leve por requisição: cada thread mantém a lista de spans da
+    requisição corrente. Fora de uma requisição (threads de background)
+    os spans são no-op.
+    """
+    def __init__(self, slow_threshold_ms: int, export_file: str, export_slow_only: bool):
+        self.slow_threshold_ms = slow_threshold_ms
+        self.export_file = export_file
+        self.export_slow_only = export_slow_only
+        self._local = threading.local()
+        self._export_lock = threading.Lock()
+        # thread id -> endpoint em atendimento (usado pelo profiler por rota)
+        self.active_requests: Dict[int, str] = {}
+
+    def start_request(self, request_id: str, name: str):
+        self._local.trace = {
+            "request_id": request_id,
+            "name": name,
+            "start": time.perf_counter(),
+            "wall_start": time.time(),
+            "spans": [],
+            "depth": 0
+        }
+        self.active_requests[threading.get_ident()] = name
+
+    def current_request_id(self) -> Optional[str]:
+        trace = getattr(self._local, 'trace', None)
+        return trace["request_id"] if trace else None
+
+    @contextmanager
+    def span(self, name: str):
+        trace = getattr(self._local, 'trace', None)
+        if trace is None:
+            yield
+            return
+
+        start = time.perf_counter()
+        # [nome, início relativo (s), duração (s), profundidade, erro]
+        record = [name, start - trace["start"], 0.0, trace["depth"], None]
+        trace["spans"].append(record)
+        trace["depth"] += 1
+        try:
+            yield
+        except Exception as e:
+            record[4] = type(e).__name__
+            raise
+        finally:
+            record[2] = time.perf_counter() - start
+            trace["depth"] -= 1
+
+    def traced(self, name: str = None):
+        """Decorator que envolve a função inteira em um span"""
+        def decorator(func):
+            span_name = name or func.__name__
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(span_name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def finish_request(self, status_code: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        trace = getattr(self._local, 'trace', None)
+        if trace is None:
+            return None
+        self._local.trace = None
+        self.active_requests.pop(threading.get_ident(), None)
+
+        total_ms = (time.perf_counter() - trace["start"]) * 1000
+        is_slow = total_ms >= self.slow_threshold_ms
+        if is_slow:
+            logger.warning(f"🐢 Requisição lenta {trace['request_id']} {trace['name']} "
+                           f"{total_ms:.0f}ms (status {status_code}): {self.format_timeline(trace['spans'])}")
+
+        if self.export_file and (is_slow or not self.export_slow_only):
+            self._export(trace, total_ms, status_code)
+        return trace
+
+    @staticmethod
+    def format_timeline(spans: List[list]) -> str:
+        """Timeline compacta: +início duração nome (› indica aninhamento)"""
+        if not spans:
+            return "sem spans"
+        parts = []
+        for name, offset, duration, depth, error in spans:
+            error_tag = f" !{error}" if error else ""
+            parts.append(f"{'›' * depth}{name} +{offset * 1000:.0f}ms {duration * 1000:.0f}ms{error_tag}")
+        return " | ".join(parts)
+
+    def _export(self, trace: Dict[str, Any], total_ms: float, status_code: Optional[int]):
+        entry = {
+            "request_id": trace["request_id"],
+            "name": trace["name"],
+            "timestamp": trace["wall_start"],
+            "duration_ms": round(total_ms, 3),
+            "status": status_code,
+            "spans": [
+                {"name": name, "start_ms": round(offset * 1000, 3), "duration_ms": round(duration * 1000, 3),
+                 "depth": depth, "error": error}
+                for name, offset, duration, depth, error in trace["spans"]
+            ]
+        }
+        try:
+            line = json.dumps(entry, ensure_ascii=False)
+            with self._export_lock:
+                with open(self.export_file, 'a', encoding='utf-8') as f:
+                    f.write(line + "\n")
+        except Exception as e:
+            logger.error(f"Erro ao exportar trace {trace['request_id']}: {e}")
+
+tracer = RequestTracer(config.TRACE_SLOW_THRESHOLD_MS, config.TRACE_EXPORT_FILE, config.TRACE_EXPORT_SLOW_ONLY)
+
+# ===== PROFILER POR AMOSTRAGEM =====
+class SamplingProfiler:
+    """
+    Amostra periodicamente as pilhas de todas as threads do processo
+    (sys._current_frames) e agrega no formato "collapsed stack" usado por
+    flamegraph.pl / speedscope. Com `route`, só amostra threads que estão
+    atendendo requisições daquele endpoint.
+    """
+    MAX_SECONDS = 60
+    MIN_INTERVAL = 0.001
+
+    def __init__(self, seconds: float, interval: float, route: Optional[str] = None):
+        self.seconds = min(max(seconds, 0.1), self.MAX_SECONDS)
+        self.interval = max(interval, self.MIN_INTERVAL)
+        self.route = route
+        self.counts: Dict[str, int] = defaultdict(int)
+        self.samples = 0
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    @staticmethod
+    def _collapse(frame) -> str:
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        stack.reverse()
+        return ";".join(stack)
+
+    def run(self) -> 'SamplingProfiler':
+        own_thread = threading.get_ident()
+        thread_names = {}
+        self.started_at = time.time()
+        deadline = time.perf_counter() + self.seconds
+
+        while time.perf_counter() < deadline:
+            active = tracer.active_requests
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread:
+                    continue
+                endpoint = active.get(thread_id)
+                if self.route and endpoint != self.route:
+                    continue
+                if thread_id not in thread_names:
+                    thread_names[thread_id] = next(
+                        (t.name for t in threading.enumerate() if t.ident == thread_id), str(thread_id))
+                root = endpoint or thread_names[thread_id]
+                self.counts[f"{root};{self._collapse(frame)}"] += 1
+            self.samples += 1
+            time.sleep(self.interval)
+
+        self.finished_at = time.time()
+        return self
+
+    def collapsed(self) -> str:
+        lines = [f"{stack} {count}" for stack, count in sorted(self.counts.items(), key=lambda item: -item[1])]
+        return "\n".join(lines) + ("\n" if lines else "")
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "seconds": self.seconds,
+            "interval_ms": round(self.interval * 1000, 3),
+            "route": self.route,
+            "samples": self.samples,
+            "unique_stacks": len(self.counts),
+            "started_at": self.started_at,
+            "finished_at": self.finished_at
+        }
+
+class ProfilerManager:
+    """Garante um profile por vez e guarda os últimos resultados em background"""
+    MAX_RESULTS = 5
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.running: Optional[str] = None
+        self.results: Dict[str, SamplingProfiler] = {}
+
+    def acquire(self, profile_id: str) -> bool:
+        with self._lock:
+            if self.running:
+                return False
+            self.running = profile_id
+            return True
+
+    def release(self):
+        with self._lock:
+            self.running = None
+
+    def run_sync(self, profiler: SamplingProfiler) -> Optional[SamplingProfiler]:
+        if not self.acquire("sync"):
+            return None
+        try:
+            return profiler.run()
+        finally:
+            self.release()
+
+    def start_background(self, profiler: SamplingProfiler) -> Optional[str]:
+        profile_id = uuid.uuid4().hex[:12]
+        if not self.acquire(profile_id):
+            return None
+
+        def worker():
+            try:
+                profiler.run()
+                with self._lock:
+                    self.results[profile_id] = profiler
+                    while len(self.results) > self.MAX_RESULTS:
+                        self.results.pop(next(iter(self.results)))
+            except Exception as e:
+                logger.error(f"Erro no profiler {profile_id}: {e}")
+            finally:
+                self.release()
+
+        threading.Thread(target=worker, name=f"profiler-{profile_id}", daemon=True).start()
+        return profile_id
+
+profiler_manager = ProfilerManager()
+
 # ===== TWILIO WHATSAPP HANDLER =====
 class TwilioWhatsAppHandler:
     def __init__(self):
@@ -116,13 +936,14 @@ class TwilioWhatsAppHandler:
                 message = message[:1500] + "...\n\n📱 Continue no link:\nhttps://carglass-assistente.onrender.com"
 
             # Envia mensagem
-            message_instance = self.client.messages.create(
-                body=message,
-                from_=self.whatsapp_number,
-                to=whatsapp_to
-            )
+            with tracer.span("twilio.send"), metric_twilio_duration.time():
+                message_instance = self.client.messages.create(
+                    body=message,
+                    from_=self.whatsapp_number,
+                    to=whatsapp_to
+                )
 
-            logger.info(f"✅ Mensagem Twilio enviada: {message_instance.sid} para {whatsapp_to}")
+            logger.info("✅ Mensagem Twilio enviada: %s para %s", message_instance.sid, whatsapp_to)
             return True
 
         except Exception as e:
@@ -145,16 +966,39 @@ class TwilioWhatsAppHandler:
             message_body = request_data.get('Body', '').strip()
             message_sid = request_data.get('MessageSid', '')
 
+            # Localização compartilhada pelo WhatsApp chega em Latitude/Longitude
+            location = None
+            try:
+                if request_data.get('Latitude') and request_data.get('Longitude'):
+                    location = (float(request_data['Latitude']), float(request_data['Longitude']))
+                    if not (-90 <= location[0] <= 90 and -180 <= location[1] <= 180):
+                        location = None
+            except ValueError:
+                location = None
+
+            # Fotos/arquivos anexados: NumMedia + MediaUrl{n}/MediaContentType{n} (até 10 por mensagem)
+            media = []
+            try:
+                num_media = min(int(request_data.get('NumMedia') or 0), 10)
+            except ValueError:
+                num_media = 0
+            for index in range(num_media):
+                url = request_data.get(f'MediaUrl{index}')
+                if url:
+                    media.append((url, request_data.get(f'MediaContentType{index}', '')))
+
             # Limpa número (remove código do país se necessário)
             if from_number.startswith('55') and len(from_number) > 11:
                 from_number = from_number[2:]  # Remove +55
 
-            logger.info(f"📱 WhatsApp recebido de {from_number[:4]}***: {message_body[:50]}...")
+            logger.info("📱 WhatsApp recebido de %s***: %s...", from_number[:4], message_body[:50])
 
             return {
                 'phone': from_number,
                 'message': message_body,
                 'message_id': message_sid,
+                'location': location,
+                'media': media,
                 'platform': 'whatsapp',
                 'raw_data': dict(request_data)
             }
@@ -187,46 +1031,187 @@ class TwilioWhatsAppHandler:
 # Instância global do handler Twilio
 twilio_handler = TwilioWhatsAppHandler()
 
+# ===== JANELA DESLIZANTE PARA RATE TRACKING =====
+class SlidingWindowCounter:
+    """
+    Contador de janela deslizante por chave com memória constante: cada
+    chave tem um anel de `buckets` contadores e um total corrente. Avançar
+    a janela zera no máximo `buckets` posições, então cada hit é O(1).
+    Chaves ociosas são descartadas em ordem LRU (limite `max_keys`).
+    """
+    def __init__(self, window_seconds: int, buckets: int = 60, max_keys: int = 10000):
+        self.window_seconds = window_seconds
+        self.buckets = buckets
+        self.bucket_seconds = window_seconds / buckets
+        self.max_keys = max_keys
+        # chave -> [contagens por bucket, último epoch visto, total na janela]
+        self._entries: 'OrderedDict[str, list]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _advance(self, entry: list, epoch: int):
+        counts, last_epoch, total = entry
+        steps = min(epoch - last_epoch, self.buckets)
+        for offset in range(1, steps + 1):
+            slot = (last_epoch + offset) % self.buckets
+            total -= counts[slot]
+            counts[slot] = 0
+        if epoch > last_epoch:
+            entry[1] = epoch
+        entry[2] = total
+
+    def _evict_idle(self, epoch: int):
+        # A mais antiga fica no início do OrderedDict (LRU)
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if len(self._entries) > self.max_keys or epoch - entry[1] >= self.buckets:
+                self._entries.popitem(last=False)
+            else:
+                break
+
+    def hit(self, key: str, now: Optional[float] = None) -> int:
+        """Registra um evento e retorna o total na janela"""
+        epoch = int((now if now is not None else time.time()) // self.bucket_seconds)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = [[0] * self.buckets, epoch, 0]
+                self._evict_idle(epoch)
+            else:
+                self._entries.move_to_end(key)
+                self._advance(entry, epoch)
+            entry[0][epoch % self.buckets] += 1
+            entry[2] += 1
+            return entry[2]
+
+    def count(self, key: str, now: Optional[float] = None) -> int:
+        epoch = int((now if now is not None else time.time()) // self.bucket_seconds)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return 0
+            self._advance(entry, epoch)
+            return entry[2]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+class SharedSlidingWindowCounter:
+    """
+    Mesma interface do SlidingWindowCounter sobre o SharedCounterStore.
+    A janela deslizante é aproximada por dois contadores fixos (atual e
+    anterior ponderado pelo tempo restante): dois acessos por hit.
+    """
+    PREFIX = "abuse:"
+
+    def __init__(self, store: SharedCounterStore, window_seconds: int):
+        self.store = store
+        self.window_seconds = window_seconds
+
+    def _window(self, now: Optional[float]) -> Tuple[int, float]:
+        now = now if now is not None else time.time()
+        return int(now // self.window_seconds), (now % self.window_seconds) / self.window_seconds
+
+    def hit(self, key: str, now: Optional[float] = None) -> int:
+        window, elapsed = self._window(now)
+        current = self.store.incr(f"{self.PREFIX}{window}:{key}", self.window_seconds * 2)
+        previous = self.store.get(f"{self.PREFIX}{window - 1}:{key}")
+        return current + int(previous * (1 - elapsed))
+
+    def count(self, key: str, now: Optional[float] = None) -> int:
+        window, elapsed = self._window(now)
+        current = self.store.get(f"{self.PREFIX}{window}:{key}")
+        previous = self.store.get(f"{self.PREFIX}{window - 1}:{key}")
+        return current + int(previous * (1 - elapsed))
+
+    def __len__(self) -> int:
+        window, _ = self._window(None)
+        return self.store.count_prefix(f"{self.PREFIX}{window}:")
+
 # ===== GERENCIADOR DE SEGURANÇA PARA HML =====
+# Caracteres que o bleach/html5lib altera: marcação e controles (exceto \t e \n)
+SANITIZE_FULL_PARSE_CHARS = re.compile(r'[<>&\x00-\x08\x0b-\x1f]')
+
 class HMLSecurityManager:
     """Versão simplificada para homologação"""
-    def __init__(self):
-        self.request_counts = defaultdict(list)
-        self.blocked_ips = set()
+    BLOCK_PREFIX = "block:"
+
+    def __init__(self, store: Optional[SharedCounterStore] = None):
+        # Com store, contagens e bloqueios valem para todos os workers
+        self.store = store
+        if store:
+            self.request_counts = SharedSlidingWindowCounter(store, config.ABUSE_WINDOW_SECONDS)
+        else:
+            self.request_counts = SlidingWindowCounter(
+                config.ABUSE_WINDOW_SECONDS, max_keys=config.ABUSE_MAX_TRACKED_IPS)
+        self.blocked_ips: Dict[str, float] = {}  # ip -> bloqueado até (epoch), apenas sem store
+        self._blocks_lock = threading.Lock()
 
     def sanitize_input(self, text: str) -> str:
-        """Sanitização básica - mais permissiva em HML"""
+        """
+        Sanitização básica - mais permissiva em HML.
+
+        Em camadas: sem caracteres de marcação (o caso comum: CPF, placa,
+        pergunta curta) o bleach devolveria o texto intacto, então só
+        escapamos aspas quando existem; o parse HTML completo roda apenas
+        quando há <, >, & ou caracteres de controle.
+        """
         if not text:
             return ""
 
+        # Limita tamanho antes do parse (mais generoso em HML)
+        text = text[:config.MAX_INPUT_CHARS]
+
+        if SANITIZE_FULL_PARSE_CHARS.search(text) is None:
+            if '"' in text or "'" in text:
+                return escape(text)[:config.MAX_INPUT_CHARS].strip()
+            return text.strip()
+
         # Remove apenas scripts perigosos
         text = bleach.clean(text, tags=[], strip=True)
         text = escape(text)
 
-        # Limita tamanho (mais generoso em HML)
-        return text[:2000].strip()
+        return text[:config.MAX_INPUT_CHARS].strip()
 
     def log_request(self, ip: str, endpoint: str):
-        """Log simples para monitoramento"""
+        """Contabiliza a requisição na janela deslizante do IP (O(1))"""
         now = time.time()
+        count = self.request_counts.hit(ip, now)
 
-        # Remove requests antigos (última hora)
-        cutoff = now - 3600
-        self.request_counts[ip] = [
-            (ep, t) for ep, t in self.request_counts[ip]
-            if t > cutoff
-        ]
+        # Bloqueia apenas abuso extremo (padrão: mais de 200 requests/hora)
+        if count > config.ABUSE_MAX_REQUESTS:
+            if self.store:
+                self.store.set(f"{self.BLOCK_PREFIX}{ip}", 1, config.ABUSE_BLOCK_SECONDS)
+            else:
+                with self._blocks_lock:
+                    self.blocked_ips[ip] = now + config.ABUSE_BLOCK_SECONDS
+            logger.warning("🚨 IP bloqueado por abuso em HML: %s (%d requisições na janela)", ip, count)
+
+    def is_ip_blocked(self, ip: str) -> bool:
+        if self.store:
+            return self.store.get(f"{self.BLOCK_PREFIX}{ip}") > 0
 
-        # Adiciona novo request
-        self.request_counts[ip].append((endpoint, now))
+        blocked_until = self.blocked_ips.get(ip)
+        if blocked_until is None:
+            return False
+        if blocked_until > time.time():
+            return True
 
-        # Bloqueia apenas abuso extremo (mais de 200 requests/hora)
-        if len(self.request_counts[ip]) > 200:
-            self.blocked_ips.add(ip)
-            logger.warning(f"🚨 IP bloqueado por abuso em HML: {ip}")
+        # Bloqueio expirado
+        with self._blocks_lock:
+            if self.blocked_ips.get(ip) == blocked_until:
+                del self.blocked_ips[ip]
+        return False
 
-    def is_ip_blocked(self, ip: str) -> bool:
-        return ip in self.blocked_ips
+    def active_blocks(self) -> int:
+        if self.store:
+            return self.store.count_prefix(self.BLOCK_PREFIX)
+
+        now = time.time()
+        with self._blocks_lock:
+            expired = [ip for ip, until in self.blocked_ips.items() if until <= now]
+            for ip in expired:
+                del self.blocked_ips[ip]
+            return len(self.blocked_ips)
 
     def validate_twilio_webhook(self, request) -> bool:
         """CRÍTICO: Valida webhook mesmo em HML"""
@@ -248,8 +1233,11 @@ class HMLSecurityManager:
             logger.error(f"Erro na validação Twilio: {e}")
             return False
 
-# Instância para HML
-security_manager = HMLSecurityManager()
+# Instância para HML (mesmo armazenamento do limiter quando compartilhado)
+security_manager = HMLSecurityManager(
+    get_shared_store(limiter_storage_uri.split("://", 1)[1])
+    if limiter_storage_uri.startswith("carglass-shared://") else None
+)
 
 # ===== UTILITÁRIOS =====
 def get_current_time() -> str:
@@ -258,6 +1246,10 @@ def get_current_time() -> str:
 def get_current_datetime() -> str:
     return time.strftime("%d/%m/%Y - %H:%M")
 
+def tokens_match(provided: str, expected: str) -> bool:
+    """Comparação em tempo constante; em bytes porque compare_digest recusa str com acentos"""
+    return hmac.compare_digest(provided.encode('utf-8'), expected.encode('utf-8'))
+
 def sanitize_input(text: str) -> str:
     """Função global de sanitização"""
     return security_manager.sanitize_input(text)
@@ -265,7 +1257,7 @@ def sanitize_input(text: str) -> str:
 def validate_cpf(cpf: str) -> bool:
     """Valida CPF com exceções para CPFs de teste - CORRIGIDO"""
     if not cpf or len(cpf) != 11:
-        logger.info(f"CPF inválido - tamanho: {len(cpf) if cpf else 0}")
+        logger.debug("CPF inválido - tamanho: %d", len(cpf) if cpf else 0)
         return False
 
     # CPFs de teste sempre válidos - EXPANSÃO DA LISTA
@@ -282,12 +1274,12 @@ def validate_cpf(cpf: str) -> bool:
     ]
 
     if cpf in test_cpfs:
-        logger.info(f"CPF de teste válido: {cpf[:3]}***")
+        logger.debug("CPF de teste válido: %s***", cpf[:3])
         return True
 
     # Verifica se todos os dígitos são iguais
     if cpf == cpf[0] * 11:
-        logger.info(f"CPF inválido - dígitos iguais: {cpf}")
+        logger.debug("CPF inválido - dígitos iguais: %s", cpf)
         return False
 
     # Validação matemática normal
@@ -297,7 +1289,7 @@ def validate_cpf(cpf: str) -> bool:
         digito1 = 0 if resto < 2 else 11 - resto
 
         if int(cpf[9]) != digito1:
-            logger.info(f"CPF inválido - primeiro dígito: {cpf}")
+            logger.debug("CPF inválido - primeiro dígito: %s", cpf)
             return False
 
         soma = sum(int(cpf[i]) * (11 - i) for i in range(10))
@@ -305,7 +1297,7 @@ def validate_cpf(cpf: str) -> bool:
         digito2 = 0 if resto < 2 else 11 - resto
 
         is_valid = int(cpf[10]) == digito2
-        logger.info(f"CPF {'válido' if is_valid else 'inválido'}: {cpf[:3]}***")
+        logger.debug("CPF %s: %s***", 'válido' if is_valid else 'inválido', cpf[:3])
         return is_valid
     except Exception as e:
         logger.error(f"Erro na validação CPF {cpf}: {e}")
@@ -317,34 +1309,34 @@ def detect_identifier_type(text: str) -> Tuple[Optional[str], str]:
         return None, ""
 
     clean_text = re.sub(r'[^a-zA-Z0-9]', '', text.strip())
-    logger.info(f"🔍 Detectando tipo para: '{clean_text}' (original: '{text}')")
+    logger.debug("🔍 Detectando tipo para: '%s' (original: '%s')", clean_text, text)
 
     # Verifica CPF primeiro (11 dígitos)
     if re.match(r'^\d{11}$', clean_text):
-        logger.info(f"Possível CPF detectado: {clean_text}")
+        logger.debug("Possível CPF detectado: %s", clean_text)
         if validate_cpf(clean_text):
-            logger.info(f"✅ CPF válido confirmado: {clean_text[:3]}***")
+            logger.debug("✅ CPF válido confirmado: %s***", clean_text[:3])
             return "cpf", clean_text
         else:
-            logger.info(f"❌ CPF inválido: {clean_text}")
+            logger.debug("❌ CPF inválido: %s", clean_text)
             return None, clean_text
 
     # Verifica telefone (10 ou 11 dígitos)
     elif re.match(r'^\d{10,11}$', clean_text):
-        logger.info(f"Telefone detectado: {clean_text[:4]}***")
+        logger.debug("Telefone detectado: %s***", clean_text[:4])
         return "telefone", clean_text
 
     # Verifica placa
     elif re.match(r'^[A-Za-z]{3}\d{4}$', clean_text) or re.match(r'^[A-Za-z]{3}\d[A-Za-z]\d{2}$', clean_text):
-        logger.info(f"Placa detectada: {clean_text}")
+        logger.debug("Placa detectada: %s", clean_text)
         return "placa", clean_text.upper()
 
     # Verifica ordem de serviço
     elif re.match(r'^\d{1,8}$', clean_text):
-        logger.info(f"Ordem detectada: {clean_text}")
+        logger.debug("Ordem detectada: %s", clean_text)
         return "ordem", clean_text
 
-    logger.info(f"❌ Nenhum tipo identificado para: {clean_text}")
+    logger.debug("❌ Nenhum tipo identificado para: %s", clean_text)
     return None, clean_text
 
 def format_for_whatsapp(html_content: str) -> str:
@@ -390,46 +1382,680 @@ def format_for_whatsapp(html_content: str) -> str:
 
     return text
 
-# ===== CACHE EM MEMÓRIA =====
-class MemoryCache:
-    def __init__(self):
-        self.cache = {}
-        self.max_items = 1000
-
-    def get(self, key: str) -> Any:
-        item = self.cache.get(key)
-        if item and item['expires'] > time.time():
-            return item['value']
-        elif item:
-            del self.cache[key]
+# ===== CACHE DE REGISTROS DE CLIENTES =====
+# Campos do registro que também identificam o cliente: (tipo, caminho em "dados")
+CLIENT_ALIAS_FIELDS = (
+    ("cpf", ("cpf",)),
+    ("telefone", ("telefone",)),
+    ("placa", ("veiculo", "placa")),
+    ("ordem", ("ordem",))
+)
+
+def client_alias(tipo: str, valor: Any) -> Optional[Tuple[str, str]]:
+    """Chave normalizada de um identificador (só letras/dígitos, maiúsculas)"""
+    if valor is None:
         return None
+    clean = re.sub(r'[^A-Za-z0-9]', '', str(valor)).upper()
+    return (tipo, clean) if clean else None
+
+def record_aliases(data: Dict[str, Any]) -> List[Tuple[str, str]]:
+    """Identificadores contidos em uma resposta da API de status"""
+    aliases = []
+    for tipo, path in CLIENT_ALIAS_FIELDS:
+        value: Any = data.get('dados')
+        for part in path:
+            value = value.get(part) if isinstance(value, (dict, MappingProxyType)) else None
+        alias = client_alias(tipo, value)
+        if alias:
+            aliases.append(alias)
+    return aliases
+
+def record_key(aliases: List[Tuple[str, str]]) -> Optional[Tuple[str, str]]:
+    """Identidade do registro: a ordem de serviço (um CPF pode ter várias), senão o primeiro identificador"""
+    for alias in aliases:
+        if alias[0] == "ordem":
+            return alias
+    return aliases[0] if aliases else None
+
+# Identificam o atendimento, não o cliente: só acompanham o registro se constarem na resposta nova
+SERVICE_ALIAS_TYPES = frozenset(("ordem", "placa"))
+
+def freeze_record(value: Any) -> Any:
+    """Cópia imutável (dicts viram MappingProxyType, listas viram tuplas)"""
+    if isinstance(value, dict):
+        return MappingProxyType({key: freeze_record(item) for key, item in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze_record(item) for item in value)
+    return value
+
+def thaw_record(value: Any) -> Any:
+    """Cópia mutável e serializável em JSON de um registro congelado"""
+    if isinstance(value, (dict, MappingProxyType)):
+        return {key: thaw_record(item) for key, item in value.items()}
+    if isinstance(value, tuple):
+        return [thaw_record(item) for item in value]
+    return value
+
+def record_digest(value: Any) -> str:
+    return hashlib.sha1(json.dumps(thaw_record(value), sort_keys=True, default=str).encode('utf-8')).hexdigest()
 
-    def set(self, key: str, value: Any, ttl: int = 300):
-        if len(self.cache) >= self.max_items:
-            # Remove 20% dos itens mais antigos
-            old_keys = list(self.cache.keys())[:int(self.max_items * 0.2)]
-            for old_key in old_keys:
-                del self.cache[old_key]
+@dataclass
+class ClientRecord:
+    key: Tuple[str, str]  # Identidade do registro (a ordem de serviço, quando presente)
+    value: Any  # Resposta congelada e internada (compartilhada entre sessões)
+    digest: str
+    expires: float
+    aliases: set = field(default_factory=set)
+    refs: int = 0  # Sessões apontando para este registro
+
+class ClientRecordStore:
+    """
+    Cache das respostas da API de status. Cada resposta bem-sucedida é
+    guardada uma vez e indexada por todos os identificadores que contém
+    (cpf, telefone, placa, ordem): consultar o mesmo cliente por outro
+    identificador é hit, e invalidar mexe em um único registro.
+
+    As respostas são congeladas e internadas por hash de conteúdo: uma
+    atualização idêntica reaproveita o mesmo objeto e respostas iguais
+    (ex.: negativas) existem uma vez só. Sessões guardam apenas a chave
+    do registro (acquire/release); registros referenciados não são
+    descartados por tamanho nem por expiração, e uma atualização fica
+    visível para todas as sessões de uma vez.
+
+    O identificador realmente consultado é um alias "vivo"; os extraídos
+    do registro são derivados e nunca tomam o lugar de um vivo de outro
+    registro ainda válido (ex.: telefone compartilhado). Respostas
+    negativas ficam só sob o identificador consultado, com TTL próprio.
+    """
+    def __init__(self, max_records: int = 1000, negative_ttl: int = 60):
+        self.max_records = max_records
+        self.negative_ttl = negative_ttl
+        self._lock = threading.Lock()
+        self._records: 'OrderedDict[Tuple[str, str], ClientRecord]' = OrderedDict()
+        self._aliases: Dict[Tuple[str, str], Tuple[Tuple[str, str], bool]] = {}  # alias -> (registro, vivo)
+        self._negative: 'OrderedDict[Tuple[str, str], Tuple[Any, float, str]]' = OrderedDict()  # (valor, expira, digest)
+        self._interned: Dict[str, List[Any]] = {}  # digest -> [valor congelado, usos]
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def get(self, tipo: str, valor: str) -> Tuple[Optional[Dict[str, Any]], str]:
+        """(resposta, resultado) com resultado em hit, alias_hit, negative_hit ou miss"""
+        alias = client_alias(tipo, valor)
+        now = time.time()
+        with self._lock:
+            entry = self._aliases.get(alias)
+            if entry:
+                record = self._records.get(entry[0])
+                if record and record.expires > now:
+                    return record.value, "hit" if entry[1] else "alias_hit"
+                if record and not record.refs:
+                    self._remove_record(record)
+
+            negative = self._negative.get(alias)
+            if negative:
+                if negative[1] > now:
+                    return negative[0], "negative_hit"
+                self._drop_negative(alias)
+        return None, "miss"
+
+    def current(self, key: Optional[Tuple[str, str]]) -> Optional[Any]:
+        """Valor mais recente do registro (mesmo expirado), usado pelas sessões"""
+        record = self._records.get(key) if key else None
+        return record.value if record else None
+
+    def acquire(self, value: Any) -> Optional[Tuple[str, str]]:
+        """Registra uma sessão apontando para o registro deste valor; retorna a chave"""
+        aliases = record_aliases(value) if hasattr(value, 'get') else []
+        if not aliases:
+            return None
+        with self._lock:
+            record = self._records.get(record_key(aliases))
+            if record is None:
+                return None
+            record.refs += 1
+            return record.key
+
+    def release(self, key: Optional[Tuple[str, str]]):
+        if key is None:
+            return
+        with self._lock:
+            record = self._records.get(key)
+            if record and record.refs:
+                record.refs -= 1
+
+    def put(self, tipo: str, valor: str, data: Dict[str, Any], ttl: int) -> Any:
+        """Armazena a resposta e devolve a versão congelada/internada dela"""
+        digest = record_digest(data)
+        alias = client_alias(tipo, valor)
+        now = time.time()
 
-        self.cache[key] = {
-            'value': value,
-            'expires': time.time() + ttl
-        }
+        if not (data.get('sucesso') and hasattr(data.get('dados'), 'get')):
+            with self._lock:
+                frozen = self._intern(digest, data)
+                if alias is None:
+                    self._release_interned(digest)
+                    return frozen
+                if alias in self._negative:
+                    self._drop_negative(alias)
+                self._negative[alias] = (frozen, now + self.negative_ttl, digest)
+                while len(self._negative) > self.max_records:
+                    self._drop_negative(next(iter(self._negative)))
+            return frozen
+
+        derived = record_aliases(data)
+        key = record_key(derived) or alias
+        with self._lock:
+            # Ao atualizar um registro, os identificadores já consultados continuam vivos,
+            # exceto ordem/placa que não constam mais na resposta
+            live_aliases = {alias} if alias else set()
+            refs = 0
+            frozen = self._intern(digest, data)
+            previous = self._records.get(key)
+            if previous:
+                live_aliases.update(
+                    a for a in previous.aliases
+                    if self._aliases.get(a) == (key, True) and (a[0] not in SERVICE_ALIAS_TYPES or a in derived))
+                refs = previous.refs
+                self._remove_record(previous)
+
+            record = ClientRecord(key=key, value=frozen, digest=digest, expires=now + ttl, refs=refs)
+            self._records[key] = record
+            for live_alias in live_aliases:
+                self._link(record, live_alias, live=True)
+            for derived_alias in derived:
+                if derived_alias in live_aliases:
+                    continue
+                current = self._aliases.get(derived_alias)
+                if current and current[1] and current[0] != key:
+                    owner = self._records.get(current[0])
+                    if owner and owner.expires > now:
+                        continue  # Alias vivo de outro registro prevalece
+                self._link(record, derived_alias, live=False)
+
+            # Uma resposta positiva nova derruba negativas antigas dos mesmos identificadores
+            for known_alias in record.aliases:
+                self._negative.pop(known_alias, None)
+
+            self._evict_overflow()
+        return frozen
+
+    def invalidate(self, tipo: str, valor: str) -> bool:
+        """Remove o registro (com todos os seus aliases) e a negativa do identificador"""
+        alias = client_alias(tipo, valor)
+        with self._lock:
+            removed = alias in self._negative
+            if removed:
+                self._drop_negative(alias)
+            entry = self._aliases.get(alias)
+            record = self._records.get(entry[0]) if entry else None
+            if record:
+                if record.refs:
+                    record.expires = 0  # Sessões mantêm o valor; a próxima consulta busca de novo
+                    self._unlink(record)
+                else:
+                    self._remove_record(record)
+                removed = True
+        return removed
 
-    def delete(self, key: str):
-        if key in self.cache:
-            del self.cache[key]
+    def cleanup_expired(self) -> int:
+        """Remove registros e negativas expirados"""
+        now = time.time()
+        with self._lock:
+            expired = [record for record in self._records.values() if record.expires <= now and not record.refs]
+            for record in expired:
+                self._remove_record(record)
+            expired_negative = [alias for alias, (_, expires, _) in self._negative.items() if expires <= now]
+            for alias in expired_negative:
+                self._drop_negative(alias)
+        removed = len(expired) + len(expired_negative)
+        if removed:
+            logger.info("Cache cleanup: removidos %d itens expirados", removed)
+        return removed
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "records": len(self._records),
+                "referenced": sum(1 for record in self._records.values() if record.refs),
+                "aliases": len(self._aliases),
+                "negative": len(self._negative),
+                "interned": len(self._interned)
+            }
 
-    def cleanup_expired(self):
-        """Remove itens expirados do cache"""
-        current_time = time.time()
-        expired_keys = [key for key, item in self.cache.items() if item['expires'] <= current_time]
-        for key in expired_keys:
-            del self.cache[key]
-        if expired_keys:
-            logger.info(f"Cache cleanup: removidos {len(expired_keys)} itens expirados")
+    def debug_info(self) -> Dict[str, Any]:
+        now = time.time()
+        with self._lock:
+            return {
+                ":".join(key): {
+                    "expires_in": max(0, int(record.expires - now)),
+                    "aliases": sorted(":".join(alias) for alias in record.aliases),
+                    "sessions": record.refs,
+                    "size": len(str(thaw_record(record.value)))
+                }
+                for key, record in self._records.items()
+            }
 
-cache = MemoryCache()
+    def _link(self, record: ClientRecord, alias: Tuple[str, str], live: bool):
+        current = self._aliases.get(alias)
+        if current and current[0] != record.key:
+            owner = self._records.get(current[0])
+            if owner:
+                owner.aliases.discard(alias)
+        self._aliases[alias] = (record.key, live)
+        record.aliases.add(alias)
+
+    def _unlink(self, record: ClientRecord):
+        for alias in record.aliases:
+            entry = self._aliases.get(alias)
+            if entry and entry[0] == record.key:
+                del self._aliases[alias]
+        record.aliases.clear()
+
+    def _remove_record(self, record: ClientRecord):
+        if self._records.get(record.key) is record:
+            del self._records[record.key]
+            self._release_interned(record.digest)
+        self._unlink(record)
+
+    def _evict_overflow(self):
+        """Descarta os registros mais antigos sem sessões apontando para eles"""
+        excess = len(self._records) - self.max_records
+        if excess <= 0:
+            return
+        victims = [record for record in self._records.values() if not record.refs][:excess]
+        for record in victims:
+            self._remove_record(record)
+
+    def _drop_negative(self, alias: Tuple[str, str]):
+        _, _, digest = self._negative.pop(alias)
+        self._release_interned(digest)
+
+    def _intern(self, digest: str, data: Dict[str, Any]) -> Any:
+        entry = self._interned.get(digest)
+        if entry is None:
+            entry = self._interned[digest] = [freeze_record(data), 0]
+        entry[1] += 1
+        return entry[0]
+
+    def _release_interned(self, digest: str):
+        entry = self._interned.get(digest)
+        if entry:
+            entry[1] -= 1
+            if entry[1] <= 0:
+                del self._interned[digest]
+
+client_records = ClientRecordStore(config.CLIENT_CACHE_MAX_RECORDS, config.CLIENT_NEGATIVE_CACHE_TTL)
+
+# ===== SUGESTÃO DE IDENTIFICADORES =====
+KEYBOARD_ROWS = ("1234567890", "QWERTYUIOP", "ASDFGHJKL", "ZXCVBNM")
+KEYBOARD_ROW_OFFSETS = (0.0, 0.5, 0.75, 1.25)  # Deslocamento horizontal de cada fileira
+CONFUSABLE_PAIRS = ("O0", "I1", "L1", "B8", "S5", "Z2", "G6", "Q0", "D0")
+
+def build_keyboard_neighbors() -> Dict[str, frozenset]:
+    """Teclas vizinhas no teclado QWERTY (inclui as fileiras de cima e de baixo)"""
+    positions = {char: (row + 0.0, column + KEYBOARD_ROW_OFFSETS[row])
+                 for row, keys in enumerate(KEYBOARD_ROWS) for column, char in enumerate(keys)}
+    neighbors = defaultdict(set)
+    for char, (row, x) in positions.items():
+        for other, (other_row, other_x) in positions.items():
+            if other != char and abs(row - other_row) <= 1 and abs(x - other_x) <= 1.0:
+                neighbors[char].add(other)
+    return {char: frozenset(others) for char, others in neighbors.items()}
+
+KEYBOARD_NEIGHBORS = build_keyboard_neighbors()
+CONFUSABLE = frozenset(pair for a, b in CONFUSABLE_PAIRS for pair in ((a, b), (b, a)))
+
+def substitution_cost(a: str, b: str) -> float:
+    if a == b:
+        return 0.0
+    if b in KEYBOARD_NEIGHBORS.get(a, ()) or (a, b) in CONFUSABLE:
+        return 0.5  # Tecla vizinha ou caractere parecido (O/0, I/1...)
+    return 1.0
+
+def typo_distance(typed: str, candidate: str, limit: Optional[float] = None) -> float:
+    """
+    Distância de edição com custo menor para erros de digitação comuns
+    (inclui troca de posição). Com `limit`, desiste assim que duas linhas
+    seguidas passam do limite e retorna um valor acima dele.
+    """
+    cols = len(candidate) + 1
+    previous_previous: List[float] = []
+    previous = [float(j) for j in range(cols)]
+    for i in range(1, len(typed) + 1):
+        current = [float(i)] + [0.0] * (cols - 1)
+        for j in range(1, cols):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1,
+                             previous[j - 1] + substitution_cost(typed[i - 1], candidate[j - 1]))
+            if (i > 1 and j > 1 and typed[i - 1] == candidate[j - 2]
+                    and typed[i - 2] == candidate[j - 1] and typed[i - 1] != typed[i - 2]):
+                current[j] = min(current[j], previous_previous[j - 2] + 0.75)
+        # A troca de posição olha duas linhas para trás: só dá para parar com as duas acima do limite
+        if limit is not None and min(current) > limit and min(previous) > limit:
+            return min(current)
+        previous_previous, previous = previous, current
+    return previous[-1]
+
+def positional_bigrams(value: str) -> List[Tuple[int, str]]:
+    return [(position, value[position:position + 2]) for position in range(len(value) - 1)]
+
+class IdentifierMatcher:
+    """
+    Índice de placas e ordens conhecidas para sugerir correções quando o
+    cliente erra a digitação.
+
+    Mesmo tamanho: bigramas com posição em listas invertidas filtram os
+    candidatos. Cada unidade de custo destrói no máximo 4 bigramas (tecla
+    vizinha: 2 por 0.5; troca de posição: 3 por 0.75), então quem
+    compartilha poucos bigramas não pode estar perto. Tamanho diferente:
+    uma inserção/remoção já custa 1, então bastam as variantes da própria
+    consulta com um caractere a mais ou a menos. Os candidatos são
+    avaliados do limite inferior mais baixo para o mais alto, parando
+    quando nenhum restante pode superar os já encontrados. Com max_values
+    o índice guarda só os identificadores consultados mais recentemente.
+    """
+    FUZZY_TYPES = ("placa", "ordem")
+    BIGRAMS_PER_COST = 4
+    INDEL_COST = 1.0
+
+    def __init__(self, max_distance: float, max_values: int = 0):
+        self.max_distance = max_distance
+        self.max_values = max_values  # Por tipo; 0 = sem limite. Acima disso sai o mais antigo
+        self._values: Dict[str, Dict[str, None]] = {tipo: {} for tipo in self.FUZZY_TYPES}  # Ordem de inclusão
+        self._by_length: Dict[str, Dict[int, set]] = {tipo: defaultdict(set) for tipo in self.FUZZY_TYPES}
+        self._alphabet: Dict[str, collections.Counter] = {tipo: collections.Counter() for tipo in self.FUZZY_TYPES}
+        self._bigrams: Dict[str, Dict[Tuple[int, str], set]] = {
+            tipo: defaultdict(set) for tipo in self.FUZZY_TYPES}
+        self._lock = threading.Lock()
+
+    def add(self, tipo: str, valor: Any):
+        """Registra um identificador que resolve para um cliente"""
+        if tipo not in self._values or not valor:
+            return
+        identified, valor = detect_identifier_type(str(valor))
+        if identified != tipo:
+            return  # Só sugere valores que o cliente conseguiria digitar
+        with self._lock:
+            values = self._values[tipo]
+            if valor in values:
+                del values[valor]  # Volta para o fim: consultado de novo, sai por último
+                values[valor] = None
+                return
+            values[valor] = None
+            self._by_length[tipo][len(valor)].add(valor)
+            self._alphabet[tipo].update(valor)
+            for key in positional_bigrams(valor):
+                self._bigrams[tipo][key].add(valor)
+            if self.max_values and len(values) > self.max_values:
+                self._remove(tipo, next(iter(values)))
+
+    def _remove(self, tipo: str, valor: str):
+        del self._values[tipo][valor]
+        self._by_length[tipo][len(valor)].discard(valor)
+        alphabet = self._alphabet[tipo]
+        alphabet.subtract(valor)
+        for char in set(valor):
+            if alphabet[char] <= 0:
+                del alphabet[char]
+        index = self._bigrams[tipo]
+        for key in positional_bigrams(valor):
+            postings = index.get(key)
+            if postings is not None:
+                postings.discard(valor)
+                if not postings:
+                    del index[key]
+
+    def add_many(self, tipo: str, valores):
+        for valor in valores:
+            self.add(tipo, valor)
+
+    def add_record(self, data: Any):
+        dados = data.get('dados', {}) if data else {}
+        self.add("ordem", dados.get('ordem'))
+        self.add("placa", (dados.get('veiculo') or {}).get('placa'))
+
+    def __len__(self) -> int:
+        return sum(len(values) for values in self._values.values())
+
+    def _same_length(self, tipo: str, valor: str, budget: float) -> List[Tuple[float, str]]:
+        """[(limite inferior da distância, valor)] de mesmo tamanho que podem estar a até `budget`"""
+        total = len(valor) - 1
+        min_shared = total - int(budget * self.BIGRAMS_PER_COST)
+        if min_shared <= 0:
+            # Curto demais para o filtro: compara com todos do mesmo tamanho
+            with self._lock:
+                return [(0.0, known) for known in self._by_length[tipo].get(len(valor), ())]
+
+        shared = collections.Counter()  # update() conta os conjuntos em C
+        index = self._bigrams[tipo]
+        with self._lock:  # add() de outras requisições altera os conjuntos
+            for key in positional_bigrams(valor):
+                postings = index.get(key)
+                if postings:
+                    shared.update(postings)
+        return [((total - count) / self.BIGRAMS_PER_COST, known) for known, count in shared.items()
+                if count >= min_shared and len(known) == len(valor)]
+
+    def _indel_variants(self, tipo: str, valor: str) -> set:
+        """A consulta com um caractere a menos ou a mais"""
+        variants = {valor[:position] + valor[position + 1:] for position in range(len(valor))}
+        with self._lock:
+            alphabet = list(self._alphabet[tipo])
+        for position in range(len(valor) + 1):
+            for char in alphabet:
+                variants.add(valor[:position] + char + valor[position:])
+        return variants
+
+    def candidates(self, tipo: str, valor: str, limit: int = 3) -> List[Tuple[str, float]]:
+        """[(valor conhecido, distância)] dentro de max_distance, do mais próximo ao mais distante"""
+        if tipo not in self._values or valor in self._values[tipo]:
+            return []
+
+        bounds: Dict[str, float] = dict((known, bound) for bound, known in
+                                        self._same_length(tipo, valor, self.max_distance))
+        remaining = self.max_distance - self.INDEL_COST
+        if remaining >= 0:
+            for variant in self._indel_variants(tipo, valor):
+                if variant in self._values[tipo]:
+                    nearby = [(0.0, variant)]
+                elif remaining >= 0.5:  # Sobra orçamento para uma tecla vizinha além da inserção/remoção
+                    nearby = self._same_length(tipo, variant, remaining)
+                else:
+                    continue
+                for bound, known in nearby:
+                    bounds[known] = min(bounds.get(known, float('inf')), self.INDEL_COST + bound)
+
+        found: List[Tuple[str, float]] = []
+        for known, lower_bound in sorted(bounds.items(), key=lambda item: item[1]):
+            if len(found) >= limit and lower_bound > found[-1][1]:
+                break
+            distance = typo_distance(valor, known, self.max_distance)
+            if distance <= self.max_distance:
+                found.append((known, distance))
+                found.sort(key=lambda item: (item[1], item[0]))
+                del found[limit:]
+        return found
+
+    def suggest(self, tipo: str, valor: str) -> Optional[str]:
+        """Melhor candidato, apenas se não houver empate (ambíguo = não sugere)"""
+        found = self.candidates(tipo, valor, limit=2)
+        if not found or (len(found) > 1 and found[1][1] == found[0][1]):
+            return None
+        return found[0][0]
+
+identifier_matcher = IdentifierMatcher(config.FUZZY_MAX_DISTANCE, config.FUZZY_MAX_IDENTIFIERS)
+
+
+# ===== CONTAGEM DE TOKENS =====
+class TokenCounter:
+    """
+    Conta tokens localmente antes do envio. Com tiktoken instalado a
+    contagem é exata; sem ele (ou sem o arquivo de encoding) usa uma
+    estimativa conservadora por caracteres, calibrada para português.
+    """
+    CHARS_PER_TOKEN = 3.2
+    MESSAGE_OVERHEAD = 3  # Tokens de formatação por mensagem de chat
+    REPLY_OVERHEAD = 3    # Início da resposta do assistente
+
+    def __init__(self, model: str):
+        self.model = model
+        self._encoding = None  # Trocado uma única vez, pela thread de carga
+        if tiktoken is not None:
+            threading.Thread(target=self._load, name="tiktoken-load", daemon=True).start()
+
+    def _load(self):
+        """
+        Carrega o encoding em background desde a inicialização: sem o arquivo
+        em TIKTOKEN_CACHE_DIR o tiktoken o baixa da internet, sem timeout.
+        Nenhuma requisição espera por isso; até terminar (ou se falhar) as
+        contagens usam a estimativa.
+        """
+        try:
+            try:
+                encoding = tiktoken.encoding_for_model(self.model)
+            except KeyError:
+                encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            logger.warning("tiktoken indisponível (%s) - usando estimativa de tokens", e)
+            return
+        self._encoding = encoding
+        logger.info("Encoding %s carregado - contagem exata de tokens", encoding.name)
+
+    @property
+    def exact(self) -> bool:
+        return self._encoding is not None
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        encoding = self._encoding
+        if encoding is not None:
+            return len(encoding.encode(text))
+        return -(-len(text) * 10 // int(self.CHARS_PER_TOKEN * 10))  # Arredonda para cima
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """Corta o texto para caber em max_tokens"""
+        if max_tokens <= 0:
+            return ""
+        encoding = self._encoding
+        if encoding is not None:
+            tokens = encoding.encode(text)
+            return text if len(tokens) <= max_tokens else encoding.decode(tokens[:max_tokens])
+        return text[:int(max_tokens * self.CHARS_PER_TOKEN)]
+
+token_counter = TokenCounter(config.OPENAI_MODEL)
+
+# ===== CONTEXTO DA CONVERSA =====
+SENTENCE_SPLIT_PATTERN = re.compile(r'(?<=[.!?])\s+|\n+')
+GREETING_PATTERN = re.compile(r'^(olá|ola|oi|bom dia|boa tarde|boa noite|entendi|claro|obrigad)', re.IGNORECASE)
+
+class ConversationContext:
+    """
+    Histórico enviado ao modelo com custo limitado: as trocas mais recentes
+    (pergunta + resposta) vão na íntegra e as que saem da janela viram uma
+    linha de resumo extrativo. O resumo cresce uma linha por troca e, ao
+    passar do orçamento, descarta as linhas mais antigas.
+    """
+    SUMMARY_HEADER = "Resumo da conversa até aqui:\n"
+    SNIPPET_CHARS = 160
+
+    def __init__(self, window_turns: int = None, max_tokens: int = None,
+                 summary_max_tokens: int = None, counter: TokenCounter = None):
+        self.window_turns = window_turns if window_turns is not None else config.CONTEXT_WINDOW_TURNS
+        self.max_tokens = max_tokens if max_tokens is not None else config.CONTEXT_MAX_TOKENS
+        self.summary_max_tokens = min(
+            summary_max_tokens if summary_max_tokens is not None else config.CONTEXT_SUMMARY_MAX_TOKENS,
+            self.max_tokens
+        )
+        self.counter = counter or token_counter
+
+        self._turns: deque = deque()  # (pergunta, resposta, tokens)
+        self._turn_tokens = 0
+        self._summary: deque = deque()  # (linha, tokens)
+        self._summary_tokens = 0
+        self.summarized_turns = 0
+
+    def __len__(self) -> int:
+        return len(self._turns) + self.summarized_turns
+
+    @property
+    def tokens(self) -> int:
+        return self._turn_tokens + self._summary_overhead() + self._summary_tokens
+
+    def _summary_overhead(self) -> int:
+        if not self._summary:
+            return 0
+        return TokenCounter.MESSAGE_OVERHEAD + self.counter.count(self.SUMMARY_HEADER)
+
+    def add_turn(self, user_message: str, assistant_message: str):
+        """Registra uma troca completa; as mais antigas saem para o resumo"""
+        tokens = (self.counter.count(user_message) + self.counter.count(assistant_message)
+                  + 2 * TokenCounter.MESSAGE_OVERHEAD)
+        self._turns.append((user_message, assistant_message, tokens))
+        self._turn_tokens += tokens
+
+        recent_budget = self.max_tokens - self.summary_max_tokens
+        while self._turns and (len(self._turns) > self.window_turns or self._turn_tokens > recent_budget):
+            old_user, old_assistant, old_tokens = self._turns.popleft()
+            self._turn_tokens -= old_tokens
+            self._summarize(old_user, old_assistant)
+
+    def _summarize(self, user_message: str, assistant_message: str):
+        line = f"- Cliente: {self._key_sentence(user_message)} | Clara: {self._key_sentence(assistant_message)}"
+        tokens = self.counter.count(line) + 1  # + quebra de linha
+        self._summary.append((line, tokens))
+        self._summary_tokens += tokens
+        self.summarized_turns += 1
+
+        while self._summary and self._summary_tokens > self.summary_max_tokens:
+            _, dropped_tokens = self._summary.popleft()
+            self._summary_tokens -= dropped_tokens
+
+    @classmethod
+    def _key_sentence(cls, text: str) -> str:
+        """Primeira frase informativa (pula saudações), limitada em tamanho"""
+        sentences = [part.strip() for part in SENTENCE_SPLIT_PATTERN.split(text) if part and part.strip()]
+        chosen = next(
+            (sentence for sentence in sentences
+             if len(sentence.split()) >= 4 and not GREETING_PATTERN.match(sentence)),
+            sentences[0] if sentences else ""
+        )
+        chosen = " ".join(chosen.split())
+        if len(chosen) > cls.SNIPPET_CHARS:
+            chosen = chosen[:cls.SNIPPET_CHARS - 1].rstrip() + "…"
+        return chosen
+
+    def messages(self, max_tokens: Optional[int] = None) -> Tuple[List[Dict[str, str]], int]:
+        """
+        Mensagens de histórico para a OpenAI e seu custo em tokens. Com
+        max_tokens, mantém as trocas mais recentes que couberem e inclui
+        o resumo apenas se ainda houver espaço.
+        """
+        budget = self.tokens if max_tokens is None else max_tokens
+        recent: List[Dict[str, str]] = []
+        used = 0
+        for user_message, assistant_message, tokens in reversed(self._turns):
+            if used + tokens > budget:
+                break
+            recent[:0] = [{"role": "user", "content": user_message},
+                          {"role": "assistant", "content": assistant_message}]
+            used += tokens
+
+        summary_tokens = self._summary_overhead() + self._summary_tokens
+        if self._summary and used + summary_tokens <= budget and len(recent) == 2 * len(self._turns):
+            summary = self.SUMMARY_HEADER + "\n".join(line for line, _ in self._summary)
+            recent.insert(0, {"role": "system", "content": summary})
+            used += summary_tokens
+
+        return recent, used
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "recent_turns": len(self._turns),
+            "summarized_turns": self.summarized_turns,
+            "summary_lines": len(self._summary),
+            "tokens": self.tokens
+        }
 
 # ===== SESSÕES =====
 @dataclass
@@ -438,10 +2064,36 @@ class SessionData:
     created_at: float
     last_activity: float
     client_identified: bool
-    client_info: Optional[Dict[str, Any]]
     messages: List[Dict[str, Any]]
     platform: str = "web"  # "web" ou "whatsapp"
     phone_number: Optional[str] = None  # Para sessões WhatsApp
+    context: ConversationContext = field(default_factory=ConversationContext)  # Histórico para a OpenAI
+    client_key: Optional[Tuple[str, str]] = None  # Registro compartilhado em client_records
+    _client_snapshot: Any = field(default=None, repr=False)  # Último valor visto (se o registro sair do cache)
+    pending_identifier: Optional[Tuple[str, str]] = None  # Sugestão "você quis dizer" aguardando confirmação
+    pending_verification: Optional[Tuple[str, str]] = None  # Sugestão não revelada: aguarda os dígitos do telefone
+    location: Optional[Tuple[float, float]] = None  # Última localização compartilhada no WhatsApp (lat, lon)
+    speculation: Any = field(default=None, repr=False)  # SpeculativeAnswer pendente (ver status_speculator)
+    pending_media: List[Tuple[str, str]] = field(default_factory=list)  # Fotos recebidas antes da identificação
+    lock: Any = field(default_factory=threading.Lock, repr=False, compare=False)  # Protege messages/context
+
+    @property
+    def client_info(self) -> Optional[Any]:
+        """Registro do cliente (imutável, compartilhado com as demais sessões)"""
+        current = client_records.current(self.client_key)
+        if current is not None:
+            self._client_snapshot = current
+        return self._client_snapshot
+
+    @client_info.setter
+    def client_info(self, value: Optional[Any]):
+        self.release_client()
+        self.client_key = client_records.acquire(value) if value is not None else None
+        self._client_snapshot = value
+
+    def release_client(self):
+        client_records.release(self.client_key)
+        self.client_key = None
 
     def is_expired(self) -> bool:
         return (time.time() - self.last_activity) > config.SESSION_TIMEOUT
@@ -449,15 +2101,38 @@ class SessionData:
     def update_activity(self):
         self.last_activity = time.time()
 
-    def add_message(self, role: str, content: str):
+    def add_message(self, role: str, content: str, automatic: bool = False):
+        """
+        automatic=True marca avisos enviados pela aplicação (ex.: mudança de
+        status): não contam como atividade nem entram no histórico da IA.
+        """
         message = {
             "role": role,
             "content": content,
             "time": get_current_time(),
             "platform": self.platform
         }
-        self.messages.append(message)
-        self.update_activity()
+        if automatic:
+            message["automatic"] = True
+
+        # Avisos chegam da thread do agendador, concorrendo com a requisição
+        with self.lock:
+            # Troca completa (pergunta + resposta) de cliente identificado entra no histórico da IA
+            if role == "assistant" and not automatic and self.client_identified:
+                question = self._pending_question()
+                if question is not None:
+                    self.context.add_turn(question, content)
+            self.messages.append(message)
+        if not automatic:
+            self.update_activity()
+
+    def _pending_question(self) -> Optional[str]:
+        """Última pergunta do cliente ainda sem resposta, ignorando avisos automáticos"""
+        for message in reversed(self.messages):
+            if message.get("automatic"):
+                continue
+            return message["content"] if message["role"] == "user" else None
+        return None
 
     def to_dict(self) -> Dict[str, Any]:
         """Converte SessionData para dicionário"""
@@ -466,10 +2141,11 @@ class SessionData:
             "created_at": self.created_at,
             "last_activity": self.last_activity,
             "client_identified": self.client_identified,
-            "client_info": self.client_info,
+            "client_info": thaw_record(self.client_info),
             "messages": self.messages,
             "platform": self.platform,
-            "phone_number": self.phone_number
+            "phone_number": self.phone_number,
+            "context": self.context.to_dict()
         }
 
 class SessionManager:
@@ -486,7 +2162,6 @@ class SessionManager:
             created_at=current_time,
             last_activity=current_time,
             client_identified=False,
-            client_info=None,
             messages=[],
             platform=platform,
             phone_number=phone_number
@@ -507,7 +2182,7 @@ class SessionManager:
             self.whatsapp_sessions[phone_number] = session_id
 
         self._cleanup_expired()
-        logger.info(f"Sessão criada: {session_id[:8]}*** - Plataforma: {platform}")
+        logger.info("Sessão criada: %s*** - Plataforma: %s", session_id[:8], platform)
         return session_data
 
     def get_session(self, session_id: str) -> Optional[SessionData]:
@@ -519,7 +2194,7 @@ class SessionManager:
             session_data.update_activity()
             return session_data
         elif session_data:
-            logger.info(f"Sessão expirada removida: {session_id[:8]}***")
+            logger.info("Sessão expirada removida: %s***", session_id[:8])
             self._remove_session(session_id)
 
         return None
@@ -537,7 +2212,7 @@ class SessionManager:
             else:
                 # Session expirou, remove mapeamento
                 del self.whatsapp_sessions[phone_number]
-                logger.info(f"Mapeamento WhatsApp removido: {phone_number[:4]}***")
+                logger.info("Mapeamento WhatsApp removido: %s***", phone_number[:4])
 
         # Cria nova sessão WhatsApp
         return self.create_session("whatsapp", phone_number)
@@ -548,8 +2223,10 @@ class SessionManager:
             session_data = self.sessions[session_id]
             if session_data.phone_number and session_data.phone_number in self.whatsapp_sessions:
                 del self.whatsapp_sessions[session_data.phone_number]
+            session_data.release_client()
+            status_speculator.discard(session_data)
             del self.sessions[session_id]
-            logger.info(f"Sessão removida: {session_id[:8]}***")
+            logger.info("Sessão removida: %s***", session_id[:8])
 
     def _cleanup_expired(self):
         current_time = time.time()
@@ -558,7 +2235,7 @@ class SessionManager:
         for sid in expired:
             self._remove_session(sid)
         if expired:
-            logger.info(f"Limpeza de sessões: {len(expired)} sessões expiradas removidas")
+            logger.info("Limpeza de sessões: %d sessões expiradas removidas", len(expired))
 
     def get_stats(self) -> Dict[str, Any]:
         """Retorna estatísticas das sessões"""
@@ -577,40 +2254,69 @@ class SessionManager:
 
 session_manager = SessionManager()
 
+metrics.gauge_callback("carglass_sessions_active", "Sessões ativas neste processo", lambda: len(session_manager.sessions))
+metrics.gauge_callback("carglass_cache_items", "Registros de clientes no cache", lambda: len(client_records))
+metrics.gauge_callback("carglass_log_records_dropped", "Registros de log descartados com a fila cheia",
+                       lambda: getattr(log_handler, 'dropped', 0))
+
 # ===== API CLIENT =====
+# URLs específicas para cada tipo de consulta
+STATUS_API_URLS = {
+    "cpf": "http://fusion-hml.carglass.hml.local:3000/api/status/cpf/",
+    "telefone": "http://fusion-hml.carglass.hml.local:3000/api/status/telefone/",
+    "ordem": "http://fusion-hml.carglass.hml.local:3000/api/status/ordem/"
+}
+
+@tracer.traced()
 def get_client_data(tipo: str, valor: str) -> Dict[str, Any]:
-    cache_key = f"client:{tipo}:{valor}"
-    cached_result = cache.get(cache_key)
-    if cached_result:
-        logger.info(f"Cache hit para {tipo}: {valor[:4]}***")
+    cached_result, cache_result = client_records.get(tipo, valor)
+    metric_client_cache.inc(result=cache_result)
+    if cached_result is not None:
+        logger.debug("Cache %s para %s: %s***", cache_result, tipo, valor[:4])
         return cached_result
 
+    if config.USE_REAL_API and tipo not in STATUS_API_URLS:
+        return fetch_client_data(tipo, valor)  # Resposta de tipo não suportado não vai para o cache
+    record = client_records.put(tipo, valor, fetch_client_data(tipo, valor), config.CACHE_TTL)
+    if record.get('sucesso'):
+        identifier_matcher.add_record(record)  # Placa e ordem passam a valer para "você quis dizer"
+    return record
+
+def fetch_client_data(tipo: str, valor: str, allow_fallback: bool = True) -> Optional[Dict[str, Any]]:
+    """
+    Consulta a API de status sem passar pelo cache. Sem allow_fallback,
+    falhas da API retornam None em vez dos dados mockados.
+    """
     if config.USE_REAL_API:
-        import requests
         try:
-            # URLs específicas para cada tipo de consulta
-            api_urls = {
-                "cpf": "http://fusion-hml.carglass.hml.local:3000/api/status/cpf/",
-                "telefone": "http://fusion-hml.carglass.hml.local:3000/api/status/telefone/",
-                "ordem": "http://fusion-hml.carglass.hml.local:3000/api/status/ordem/"
-            }
-
             # Verifica se o tipo é suportado
-            if tipo not in api_urls:
+            if tipo not in STATUS_API_URLS:
                 logger.warning(f"Tipo '{tipo}' não suportado pelas APIs")
                 return {"sucesso": False, "mensagem": f"Tipo '{tipo}' não suportado"}
 
             # Monta URL completa
-            endpoint = f"{api_urls[tipo]}{valor}"
-            logger.info(f"Consultando API CarGlass: {endpoint}")
+            endpoint = f"{STATUS_API_URLS[tipo]}{valor}"
+            logger.info("Consultando API CarGlass: %s", endpoint)
 
             # Faz requisição
-            response = requests.get(endpoint, timeout=10)
+            api_start = time.perf_counter()
+            api_outcome = "error"
+            try:
+                with tracer.span(f"status_api.{tipo}"):
+                    response = requests.get(endpoint, timeout=10)
+                api_outcome = "success" if response.status_code == 200 else f"http_{response.status_code}"
+            except requests.exceptions.ConnectionError:
+                api_outcome = "connection_error"
+                raise
+            except requests.exceptions.Timeout:
+                api_outcome = "timeout"
+                raise
+            finally:
+                metric_status_api_duration.observe(time.perf_counter() - api_start, tipo=tipo, outcome=api_outcome)
 
             if response.status_code == 200:
                 data = response.json()
-                logger.info(f"API CarGlass - Sucesso: {data.get('sucesso')}")
-                cache.set(cache_key, data, config.CACHE_TTL)
+                logger.info("API CarGlass - Sucesso: %s", data.get('sucesso'))
                 return data
             else:
                 logger.error(f"API CarGlass - Status: {response.status_code}")
@@ -622,334 +2328,1439 @@ def get_client_data(tipo: str, valor: str) -> Dict[str, Any]:
         except Exception as e:
             logger.error(f"Erro na API CarGlass: {e}")
 
+        if not allow_fallback:
+            return None
+
     # Fallback para dados mockados
     logger.info("Usando dados mockados como fallback")
-    mock_data = get_mock_data(tipo, valor)
-    cache.set(cache_key, mock_data, config.CACHE_TTL)
-    return mock_data
+    metric_status_api_fallback.inc(tipo=tipo)
+    return get_mock_data(tipo, valor)
+
+# Base mockada (testes e fallback quando a API está indisponível)
+MOCK_DATABASE = {
+    "12345678900": {
+        "sucesso": True,
+        "dados": {
+            "nome": "Carlos Silva",
+            "cpf": "12345678900",
+            "telefone": "11987654321",
+            "ordem": "ORD12345",
+            "status": "Em andamento", # <<< AJUSTE PARA TESTAR FLUXOS
+            "tipo_servico": "Troca de Parabrisa",
+            "veiculo": {"modelo": "Honda Civic", "placa": "ABC1234", "ano": "2022"},
+            "loja": "CarGlass Morumbi",
+            "endereco_loja": "Av. Professor Francisco Morato, 2307 - Butantã",
+            "previsao_conclusao": "hoje às 16h"
+        }
+    },
+    "98765432100": {
+        "sucesso": True,
+        "dados": {
+            "nome": "Maria Santos",
+            "cpf": "98765432100",
+            "telefone": "11976543210",
+            "ordem": "ORD67890",
+            "status": "Serviço agendado com sucesso",
+            "tipo_servico": "Reparo de Trinca",
+            "veiculo": {"modelo": "Toyota Corolla", "placa": "DEF5678", "ano": "2021"},
+            "loja": "CarGlass Vila Mariana",
+            "endereco_loja": "Rua Domingos de Morais, 1267 - Vila Mariana",
+            "previsao_conclusao": "amanhã às 14h"
+        }
+    },
+    "11122233344": {
+        "sucesso": True,
+        "dados": {
+            "nome": "João Oliveira",
+            "cpf": "11122233344",
+            "telefone": "11955556666",
+            "ordem": "ORD54321",
+            "status": "Aguardando fotos para liberação da ordem",
+            "tipo_servico": "Troca de Vidro Lateral",
+            "veiculo": {"modelo": "Volkswagen Golf", "placa": "GHI9012", "ano": "2023"},
+            "loja": "CarGlass Santo André",
+            "endereco_loja": "Av. Industrial, 600 - Santo André"
+        }
+    },
+    "33344455566": {
+        "sucesso": True,
+        "dados": {
+            "nome": "Ana Costa",
+            "cpf": "33344455566",
+            "telefone": "11944443333",
+            "ordem": "ORD98765",
+            "status": "Concluído",
+            "tipo_servico": "Calibração ADAS",
+            "veiculo": {"modelo": "BMW X3", "placa": "JKL3456", "ano": "2024"},
+            "loja": "CarGlass Morumbi",
+            "endereco_loja": "Av. Professor Francisco Morato, 2307 - Butantã"
+        }
+    },
+    "44455566677": {
+        "sucesso": True,
+        "dados": {
+            "nome": "Pedro Mendes",
+            "cpf": "44455566677",
+            "telefone": "11933332222",
+            "ordem": "ORD24680",
+            "status": "Fotos Recebidas", # <<< AJUSTE PARA TESTAR FLUXOS
+            "tipo_servico": "Calibração ADAS",
+            "veiculo": {"modelo": "Jeep Compass", "placa": "MNO7890", "ano": "2023"},
+            "loja": "CarGlass Morumbi",
+            "endereco_loja": "Av. Professor Francisco Morato, 2307 - Butantã"
+        }
+    },
+    "55566677788": {
+        "sucesso": True,
+        "dados": {
+            "nome": "Paulo Mendes",
+            "cpf": "55566677788",
+            "telefone": "11911110000",
+            "ordem": "ORD36925",
+            "status": "Ordem de Serviço Aberta",
+            "tipo_servico": "Reparo de Parabrisa",
+            "veiculo": {"modelo": "Chevrolet Onix", "placa": "STU5678", "ano": "2021"},
+            "loja": "CarGlass Vila Mariana",
+            "endereco_loja": "Rua Domingos de Morais, 1267 - Vila Mariana"
+        }
+    },
+    "77788899900": {
+        "sucesso": True,
+        "dados": {
+            "nome": "Roberto Santos",
+            "cpf": "77788899900",
+            "telefone": "11933332222",
+            "ordem": "ORD24680",
+            "status": "Peça Identificada", # <<< AJUSTE PARA TESTAR FLUXOS
+            "tipo_servico": "Calibração ADAS",
+            "veiculo": {"modelo": "Jeep Compass", "placa": "MNO7890", "ano": "2023"},
+            "loja": "CarGlass Santo André",
+            "endereco_loja": "Av. Industrial, 600 - Santo André"
+        }
+    },
+    "22233344455": {
+        "sucesso": True,
+        "dados": {
+            "nome": "Fernanda Lima",
+            "cpf": "22233344455",
+            "telefone": "11922221111",
+            "ordem": "ORD13579",
+            "status": "Ordem de Serviço Liberada",
+            "tipo_servico": "Polimento de Faróis",
+            "veiculo": {"modelo": "Hyundai HB20", "placa": "PQR1234", "ano": "2022"},
+            "loja": "CarGlass Morumbi",
+            "endereco_loja": "Av. Professor Francisco Morato, 2307 - Butantã"
+        }
+    }
+}
+
+# Mapeamentos completos (identificador -> CPF)
+MOCK_ORDEM_PARA_CPF = {
+    "123456": "12345678900",
+    "ORD12345": "12345678900",
+    "ORD67890": "98765432100",
+    "ORD54321": "11122233344",
+    "ORD98765": "33344455566",
+    "ORD24680": "44455566677",
+    "ORD36925": "55566677788",
+    "ORD13579": "22233344455"
+}
+MOCK_TELEFONE_PARA_CPF = {
+    "11987654321": "12345678900",
+    "11976543210": "98765432100",
+    "11955556666": "11122233344",
+    "11944443333": "33344455566",
+    "11933332222": "44455566677",
+    "11911110000": "55566677788",
+    "11922221111": "22233344455"
+}
+MOCK_PLACA_PARA_CPF = {
+    "ABC1234": "12345678900",
+    "DEF5678": "98765432100",
+    "GHI9012": "11122233344",
+    "JKL3456": "33344455566",
+    "MNO7890": "44455566677",
+    "STU5678": "55566677788",
+    "PQR1234": "22233344455"
+}
 
 def get_mock_data(tipo: str, valor: str) -> Dict[str, Any]:
     """Dados mockados completos para testes"""
-    mock_database = {
-        "12345678900": {
-            "sucesso": True,
-            "dados": {
-                "nome": "Carlos Silva",
-                "cpf": "12345678900",
-                "telefone": "11987654321",
-                "ordem": "ORD12345",
-                "status": "Em andamento", # <<< AJUSTE PARA TESTAR FLUXOS
-                "tipo_servico": "Troca de Parabrisa",
-                "veiculo": {"modelo": "Honda Civic", "placa": "ABC1234", "ano": "2022"},
-                "loja": "CarGlass Morumbi",
-                "endereco_loja": "Av. Professor Francisco Morato, 2307 - Butantã",
-                "previsao_conclusao": "hoje às 16h"
-            }
-        },
-        "98765432100": {
-            "sucesso": True,
-            "dados": {
-                "nome": "Maria Santos",
-                "cpf": "98765432100",
-                "telefone": "11976543210",
-                "ordem": "ORD67890",
-                "status": "Serviço agendado com sucesso",
-                "tipo_servico": "Reparo de Trinca",
-                "veiculo": {"modelo": "Toyota Corolla", "placa": "DEF5678", "ano": "2021"},
-                "loja": "CarGlass Vila Mariana",
-                "endereco_loja": "Rua Domingos de Morais, 1267 - Vila Mariana",
-                "previsao_conclusao": "amanhã às 14h"
-            }
-        },
-        "11122233344": {
-            "sucesso": True,
-            "dados": {
-                "nome": "João Oliveira",
-                "cpf": "11122233344",
-                "telefone": "11955556666",
-                "ordem": "ORD54321",
-                "status": "Aguardando fotos para liberação da ordem",
-                "tipo_servico": "Troca de Vidro Lateral",
-                "veiculo": {"modelo": "Volkswagen Golf", "placa": "GHI9012", "ano": "2023"},
-                "loja": "CarGlass Santo André",
-                "endereco_loja": "Av. Industrial, 600 - Santo André"
-            }
-        },
-        "33344455566": {
-            "sucesso": True,
-            "dados": {
-                "nome": "Ana Costa",
-                "cpf": "33344455566",
-                "telefone": "11944443333",
-                "ordem": "ORD98765",
-                "status": "Concluído",
-                "tipo_servico": "Calibração ADAS",
-                "veiculo": {"modelo": "BMW X3", "placa": "JKL3456", "ano": "2024"},
-                "loja": "CarGlass Morumbi",
-                "endereco_loja": "Av. Professor Francisco Morato, 2307 - Butantã"
-            }
-        },
-        "44455566677": {
-            "sucesso": True,
-            "dados": {
-                "nome": "Pedro Mendes",
-                "cpf": "44455566677",
-                "telefone": "11933332222",
-                "ordem": "ORD24680",
-                "status": "Fotos Recebidas", # <<< AJUSTE PARA TESTAR FLUXOS
-                "tipo_servico": "Calibração ADAS",
-                "veiculo": {"modelo": "Jeep Compass", "placa": "MNO7890", "ano": "2023"},
-                "loja": "CarGlass Morumbi",
-                "endereco_loja": "Av. Professor Francisco Morato, 2307 - Butantã"
-            }
-        },
-        "55566677788": {
-            "sucesso": True,
-            "dados": {
-                "nome": "Paulo Mendes",
-                "cpf": "55566677788",
-                "telefone": "11911110000",
-                "ordem": "ORD36925",
-                "status": "Ordem de Serviço Aberta",
-                "tipo_servico": "Reparo de Parabrisa",
-                "veiculo": {"modelo": "Chevrolet Onix", "placa": "STU5678", "ano": "2021"},
-                "loja": "CarGlass Vila Mariana",
-                "endereco_loja": "Rua Domingos de Morais, 1267 - Vila Mariana"
-            }
-        },
-        "77788899900": {
-            "sucesso": True,
-            "dados": {
-                "nome": "Roberto Santos",
-                "cpf": "77788899900",
-                "telefone": "11933332222",
-                "ordem": "ORD24680",
-                "status": "Peça Identificada", # <<< AJUSTE PARA TESTAR FLUXOS
-                "tipo_servico": "Calibração ADAS",
-                "veiculo": {"modelo": "Jeep Compass", "placa": "MNO7890", "ano": "2023"},
-                "loja": "CarGlass Santo André",
-                "endereco_loja": "Av. Industrial, 600 - Santo André"
-            }
-        },
-        "22233344455": {
-            "sucesso": True,
-            "dados": {
-                "nome": "Fernanda Lima",
-                "cpf": "22233344455",
-                "telefone": "11922221111",
-                "ordem": "ORD13579",
-                "status": "Ordem de Serviço Liberada",
-                "tipo_servico": "Polimento de Faróis",
-                "veiculo": {"modelo": "Hyundai HB20", "placa": "PQR1234", "ano": "2022"},
-                "loja": "CarGlass Morumbi",
-                "endereco_loja": "Av. Professor Francisco Morato, 2307 - Butantã"
+    cpf_key = None
+    if tipo == "cpf" and valor in MOCK_DATABASE:
+        cpf_key = valor
+    elif tipo == "ordem" and valor in MOCK_ORDEM_PARA_CPF:
+        cpf_key = MOCK_ORDEM_PARA_CPF[valor]
+    elif tipo == "telefone" and valor in MOCK_TELEFONE_PARA_CPF:
+        cpf_key = MOCK_TELEFONE_PARA_CPF[valor]
+    elif tipo == "placa" and valor in MOCK_PLACA_PARA_CPF:
+        cpf_key = MOCK_PLACA_PARA_CPF[valor]
+
+    if cpf_key:
+        logger.debug("✅ Dados encontrados para %s: %s", tipo, valor)
+        return MOCK_DATABASE[cpf_key]
+
+    logger.debug("❌ Cliente não encontrado para %s: %s", tipo, valor)
+    return {"sucesso": False, "mensagem": f"Cliente não encontrado para {tipo}"}
+
+if not config.USE_REAL_API:
+    # Sem API real, os identificadores da base mockada são os únicos válidos
+    identifier_matcher.add_many("ordem", MOCK_ORDEM_PARA_CPF)
+    identifier_matcher.add_many("placa", MOCK_PLACA_PARA_CPF)
+
+# ===== PIPELINE DE ATENDIMENTO =====
+# Única definição das etapas (data/pipeline.json), carregada uma vez. Cada
+# status conhecido vira um StatusInfo pré-calculado com tudo que barra de
+# progresso, texto do WhatsApp e prompts precisam: um lookup por mensagem.
+def normalize_status(status: str) -> str:
+    """Chave do índice: sem diferença de caixa nem de espaços extras"""
+    return " ".join(status.split()).casefold()
+
+@dataclass(frozen=True)
+class StatusInfo:
+    name: str
+    index: int  # Posição no pipeline (-1 = status desconhecido)
+    short_label: str
+    timeline_step: int  # Etapa ativa na barra de progresso
+    progress: str
+    css_class: str
+    emoji: str
+    completed: Tuple[str, ...] = ()
+    next_steps: Tuple[str, ...] = ()
+    completed_labels: str = ""  # Rótulos curtos unidos por ", " (prompts e fallbacks)
+    next_labels: str = ""
+
+    @property
+    def known(self) -> bool:
+        return self.index >= 0
+
+    @property
+    def is_final(self) -> bool:
+        return self.known and not self.next_steps
+
+class ServicePipeline:
+    """Etapas do atendimento com índice por status normalizado"""
+
+    def __init__(self, definition: Dict[str, Any]):
+        self.timeline: Tuple[str, ...] = tuple(definition['timeline'])
+        self._unknown = definition.get('unknown', {})
+
+        steps = definition['steps']
+        names = [step['status'] for step in steps]
+        labels = [step.get('short_label', step['status']) for step in steps]
+        self.statuses: Tuple[str, ...] = tuple(names)
+
+        self._index: Dict[str, StatusInfo] = {}
+        for i, step in enumerate(steps):
+            key = normalize_status(step['status'])
+            if key in self._index:
+                raise ValueError(f"Status duplicado no pipeline: {step['status']}")
+            if not 0 <= step['timeline_step'] < len(self.timeline):
+                raise ValueError(f"timeline_step inválido para {step['status']}: {step['timeline_step']}")
+
+            self._index[key] = StatusInfo(
+                name=step['status'],
+                index=i,
+                short_label=labels[i],
+                timeline_step=step['timeline_step'],
+                progress=step['progress'],
+                css_class=step['css_class'],
+                emoji=step['emoji'],
+                completed=tuple(names[:i]),
+                next_steps=tuple(names[i + 1:]),
+                completed_labels=", ".join(labels[:i]),
+                next_labels=", ".join(labels[i + 1:])
+            )
+
+    @classmethod
+    def from_file(cls, path: str) -> 'ServicePipeline':
+        with open(path, encoding='utf-8') as f:
+            return cls(json.load(f))
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def get(self, status: str) -> Optional[StatusInfo]:
+        """StatusInfo do status ou None se ele não pertence ao pipeline"""
+        return self._index.get(normalize_status(status)) if status else None
+
+    def info(self, status: str) -> StatusInfo:
+        """Como get(), mas status desconhecido recebe a apresentação padrão"""
+        found = self.get(status)
+        if found is not None:
+            return found
+        return StatusInfo(
+            name=status,
+            index=-1,
+            short_label=status,
+            timeline_step=self._unknown.get('timeline_step', 0),
+            progress=self._unknown.get('progress', '0%'),
+            css_class=self._unknown.get('css_class', 'desconhecido'),
+            emoji=self._unknown.get('emoji', '📋')
+        )
+
+service_pipeline = ServicePipeline.from_file(config.PIPELINE_FILE)
+logger.info("Pipeline de atendimento carregado: %d status (%s)", len(service_pipeline), config.PIPELINE_FILE)
+
+# Função auxiliar para determinar etapas anteriores e próximas
+def get_status_details(current_status: str) -> Tuple[List[str], List[str]]:
+    info = service_pipeline.get(current_status)
+    if info is None: # Status não encontrado no pipeline
+        return [], []
+    return list(info.completed), list(info.next_steps)
+
+
+# ===== BARRA DE PROGRESSO =====
+def _render_progress_bar_html(status: str, current_time: str) -> str:
+    """Renderização completa (usada para pré-computar os templates por status)"""
+    info = service_pipeline.info(status)
+
+    # Gera HTML com o estado de cada etapa da timeline
+    steps_html = ""
+    for i, label in enumerate(service_pipeline.timeline):
+        if i < info.timeline_step:
+            state = "completed"
+        elif i == info.timeline_step:
+            state = "active"
+        else:
+            state = "pending"
+        steps_html += f'''
+        <div class="timeline-step {state}">
+            <div class="step-node"></div>
+            <div class="step-label">{label}</div>
+            {'' if state != 'active' else '<div class="step-highlight">Etapa Atual</div>'}
+        </div>
+        '''
+
+    return f'''
+    <div class="status-progress-container">
+        <div class="status-current">
+            <span class="status-tag {info.css_class}">{status}</span>
+            <span class="status-date">{current_time}</span>
+        </div>
+        <div class="progress-timeline">
+            <div class="timeline-track" style="--progress-width: {info.progress};">
+                {steps_html}
+            </div>
+        </div>
+    </div>
+    '''
+
+def _render_whatsapp_status_text(status: str) -> str:
+    """Renderização completa (usada para pré-computar o texto por status)"""
+    info = service_pipeline.info(status)
+
+    timeline_text_parts = ["📊 *Timeline do seu Atendimento:*"]
+    
+    # Adicionar as etapas concluídas
+    for step in info.completed:
+        timeline_text_parts.append(f"✅ {step}")
+        
+    # Adicionar a etapa atual
+    timeline_text_parts.append(f"🔄 *{status}*")
+    
+    # Adicionar as próximas etapas
+    if info.next_steps:
+        timeline_text_parts.append("\n*Próximas etapas:*")
+        for step in info.next_steps:
+            timeline_text_parts.append(f"⏳ {step}")
+    elif info.is_final:
+        timeline_text_parts.append("🎉 Serviço finalizado!")
+    else:
+        timeline_text_parts.append("Não há próximas etapas definidas para este status.")
+
+    return f"{info.emoji} Status Atual: {status}\n\n" + "\n".join(timeline_text_parts)
+
+# ===== RENDERIZAÇÕES PRÉ-COMPUTADAS =====
+# A saída só depende do status (mais o horário na barra de progresso), então
+# cada status conhecido é renderizado uma vez na importação. O horário entra
+# no lugar de um marcador: servir = um lookup + uma concatenação.
+_TIMESTAMP_SLOT = "\x00timestamp\x00"
+_RENDER_CACHE_MAX = 128  # Status fora do pipeline (ex.: variações de caixa vindas da API)
+_render_cache_lock = threading.Lock()  # Só a inclusão de status novos; a leitura dispensa o lock
+
+def _split_progress_template(status: str) -> Tuple[str, str]:
+    prefix, _, suffix = _render_progress_bar_html(status, _TIMESTAMP_SLOT).partition(_TIMESTAMP_SLOT)
+    return prefix, suffix
+
+_progress_bar_templates: Dict[str, Tuple[str, str]] = {
+    status: _split_progress_template(status) for status in service_pipeline.statuses
+}
+_whatsapp_status_texts: Dict[str, str] = {
+    status: _render_whatsapp_status_text(status) for status in service_pipeline.statuses
+}
+_PRECOMPUTED_PROGRESS = len(_progress_bar_templates)
+_PRECOMPUTED_WHATSAPP = len(_whatsapp_status_texts)
+
+def get_progress_bar_html(client_data: Dict[str, Any]) -> str:
+    """Gera HTML da barra de progresso baseado no status do cliente"""
+    status = client_data['dados']['status']
+    template = _progress_bar_templates.get(status)
+    if template is None:
+        template = _split_progress_template(status)
+        with _render_cache_lock:
+            if len(_progress_bar_templates) < _PRECOMPUTED_PROGRESS + _RENDER_CACHE_MAX:
+                template = _progress_bar_templates.setdefault(status, template)
+    return template[0] + get_current_datetime() + template[1]
+
+def get_whatsapp_status_text(client_data: Dict[str, Any]) -> str:
+    """Versão simplificada do status para WhatsApp"""
+    status = client_data['dados']['status']
+    text = _whatsapp_status_texts.get(status)
+    if text is None:
+        text = _render_whatsapp_status_text(status)
+        with _render_cache_lock:
+            if len(_whatsapp_status_texts) < _PRECOMPUTED_WHATSAPP + _RENDER_CACHE_MAX:
+                text = _whatsapp_status_texts.setdefault(status, text)
+    return text
+
+
+# ===== ATUALIZAÇÃO DE STATUS EM BACKGROUND =====
+class StatusRefreshScheduler:
+    """
+    Atualiza periodicamente os registros de clientes com sessões ativas e
+    avisa no WhatsApp quando o status muda. Como as sessões compartilham
+    o registro (client_records), cada cliente é consultado uma única vez
+    por ciclo, em lotes e com teto de consultas por segundo à API.
+    """
+    def __init__(self, interval: int, batch_size: int, max_rps: float):
+        self.interval = interval
+        self.batch_size = max(1, batch_size)
+        self.min_call_gap = 1.0 / max_rps if max_rps > 0 else 0.0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._last_call = 0.0
+        self.cycles = 0
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="status-refresh", daemon=True)
+        self._thread.start()
+        logger.info("Atualização de status em background: a cada %ds, até %.1f consultas/s",
+                    self.interval, 1.0 / self.min_call_gap if self.min_call_gap else float('inf'))
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error(f"Erro na atualização de status em background: {e}")
+
+    def _active_sessions(self) -> Dict[Tuple[str, str], List[SessionData]]:
+        """Sessões identificadas e não expiradas, agrupadas por registro"""
+        by_record: Dict[Tuple[str, str], List[SessionData]] = defaultdict(list)
+        for session_data in list(session_manager.sessions.values()):
+            if session_data.client_key and not session_data.is_expired():
+                by_record[session_data.client_key].append(session_data)
+        return by_record
+
+    def _pace(self):
+        """Respeita o intervalo mínimo entre consultas à API"""
+        wait = self._last_call + self.min_call_gap - time.monotonic()
+        if wait > 0:
+            self._stop.wait(wait)
+        self._last_call = time.monotonic()
+
+    def run_once(self) -> Dict[str, int]:
+        """Executa um ciclo completo; retorna contagens por resultado"""
+        by_record = self._active_sessions()
+        keys = list(by_record)
+        counts = defaultdict(int)
+
+        for start in range(0, len(keys), self.batch_size):
+            for key in keys[start:start + self.batch_size]:
+                if self._stop.is_set():
+                    return dict(counts)
+                self._pace()
+                outcome = self._refresh_record(key, by_record[key])
+                counts[outcome] += 1
+                metric_status_refresh.inc(outcome=outcome)
+
+        self.cycles += 1
+        if keys:
+            logger.info("Atualização de status: %d registros (%s)", len(keys), dict(counts))
+        return dict(counts)
+
+    def _refresh_record(self, key: Tuple[str, str], sessions: List[SessionData]) -> str:
+        previous = client_records.current(key)
+        # Com a API real ativa, falhas não podem sobrescrever o registro com dados mockados
+        data = fetch_client_data(key[0], key[1], allow_fallback=not config.USE_REAL_API)
+        if not data or not data.get('sucesso'):
+            return "error"
+        if record_key(record_aliases(data)) != key:
+            # A API devolveu outro atendimento (ex.: outra ordem do mesmo CPF): não avisa nada
+            logger.warning("Atualização de %s***: resposta de outro registro ignorada", key[1][:4])
+            return "error"
+
+        current = client_records.put(key[0], key[1], data, config.CACHE_TTL)
+        old_status = previous['dados'].get('status') if previous else None
+        new_status = current['dados'].get('status')
+        if old_status == new_status:
+            return "unchanged"
+
+        logger.info("Status alterado para %s***: %s -> %s", key[1][:4], old_status, new_status)
+        self._notify(current, sessions)
+        return "changed"
+
+    def _notify(self, record: Any, sessions: List[SessionData]):
+        if not twilio_handler.is_enabled():
+            return
+        text = "🔔 Atualização do seu atendimento!\n\n" + get_whatsapp_status_text(record)
+        for session_data in sessions:
+            if session_data.platform != "whatsapp" or not session_data.phone_number:
+                continue
+            sent = twilio_handler.send_message(session_data.phone_number, format_for_whatsapp(text))
+            metric_status_notifications.inc(outcome="sent" if sent else "failed")
+            if sent:
+                session_data.add_message("assistant", text, automatic=True)
+
+status_refresher = StatusRefreshScheduler(
+    config.STATUS_REFRESH_INTERVAL, config.STATUS_REFRESH_BATCH_SIZE, config.STATUS_REFRESH_MAX_RPS)
+if config.STATUS_REFRESH_ENABLED:
+    status_refresher.start()
+    atexit.register(status_refresher.stop)
+
+
+# ===== BASE DE PERGUNTAS FREQUENTES =====
+FAQ_STOPWORDS = frozenset("""
+a ao aos as ate com como da das de do dos e ela ele em entao eu essa esse esta este eu foi ha isso
+ja la lhe mais mas me meu minha na nao nas no nos o os ou para pela pelo por pra qual quais que se
+sem ser seu sua tem ter um uma uns umas voce voces vcs
+""".split())
+FAQ_TOKEN_PATTERN = re.compile(r'[a-z0-9]+')
+
+def fold_accents(text: str) -> str:
+    """Minúsculas e sem acentos ("Horário" -> "horario")"""
+    decomposed = unicodedata.normalize('NFKD', text.lower())
+    return ''.join(char for char in decomposed if not unicodedata.combining(char))
+
+def faq_tokens(text: str) -> List[str]:
+    """Tokens sem acento e sem stopwords, com plural simples removido"""
+    tokens = []
+    for token in FAQ_TOKEN_PATTERN.findall(fold_accents(text)):
+        if token in FAQ_STOPWORDS:
+            continue
+        if len(token) > 4 and token.endswith('s'):
+            token = token[:-1]
+        tokens.append(token)
+    return tokens
+
+@dataclass(frozen=True)
+class FaqEntry:
+    id: str
+    perguntas: Tuple[str, ...]
+    resposta: str
+
+class FaqIndex:
+    """
+    Índice TF-IDF (cosseno) sobre as perguntas e palavras-chave da FAQ.
+    Vetores esparsos em listas invertidas: uma consulta só percorre as
+    entradas que compartilham algum termo com ela.
+    """
+    def __init__(self, entries: List[Dict[str, Any]]):
+        self.entries: List[FaqEntry] = []
+        documents: List[Dict[str, int]] = []
+        for entry in entries:
+            self.entries.append(FaqEntry(entry['id'], tuple(entry['perguntas']), entry['resposta']))
+            text = ' '.join(entry['perguntas']) + ' ' + ' '.join(entry.get('palavras_chave', []))
+            counts: Dict[str, int] = defaultdict(int)
+            for token in faq_tokens(text):
+                counts[token] += 1
+            documents.append(counts)
+
+        total = len(documents)
+        document_frequency: Dict[str, int] = defaultdict(int)
+        for counts in documents:
+            for token in counts:
+                document_frequency[token] += 1
+        # idf suavizado: termo presente em todas as entradas ainda pesa um pouco
+        self.idf = {token: math.log((1 + total) / (1 + df)) + 1.0 for token, df in document_frequency.items()}
+
+        # term -> [(posição da entrada, peso normalizado)]
+        self.postings: Dict[str, List[Tuple[int, float]]] = defaultdict(list)
+        for position, counts in enumerate(documents):
+            weights = {token: (1 + math.log(tf)) * self.idf[token] for token, tf in counts.items()}
+            norm = math.sqrt(sum(weight * weight for weight in weights.values())) or 1.0
+            for token, weight in weights.items():
+                self.postings[token].append((position, weight / norm))
+
+    @classmethod
+    def from_file(cls, path: str) -> 'FaqIndex':
+        with open(path, encoding='utf-8') as f:
+            return cls(json.load(f))
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def search(self, question: str, limit: int = 3) -> List[Tuple[FaqEntry, float]]:
+        """Entradas mais parecidas com a pergunta, com similaridade de 0 a 1"""
+        counts: Dict[str, int] = defaultdict(int)
+        for token in faq_tokens(question):
+            if token in self.idf:  # Termos fora do vocabulário não pontuam
+                counts[token] += 1
+        if not counts:
+            return []
+
+        query = {token: (1 + math.log(tf)) * self.idf[token] for token, tf in counts.items()}
+        norm = math.sqrt(sum(weight * weight for weight in query.values()))
+        scores: Dict[int, float] = defaultdict(float)
+        for token, weight in query.items():
+            weight /= norm
+            for position, doc_weight in self.postings[token]:
+                scores[position] += weight * doc_weight
+
+        best = heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+        return [(self.entries[position], score) for position, score in best]
+
+    def answer(self, question: str, min_score: float) -> Optional[FaqEntry]:
+        """Melhor entrada se a similaridade passar do limite"""
+        results = self.search(question, limit=1)
+        if results and results[0][1] >= min_score:
+            metric_faq_lookups.inc(result="hit")
+            logger.debug("FAQ '%s' (similaridade %.2f)", results[0][0].id, results[0][1])
+            return results[0][0]
+        metric_faq_lookups.inc(result="miss")
+        return None
+
+faq_index = FaqIndex.from_file(config.FAQ_FILE)
+logger.info("Base de FAQ carregada: %d entradas (%s)", len(faq_index), config.FAQ_FILE)
+
+
+# ===== LOJAS =====
+EARTH_RADIUS_KM = 6371.0
+CEP_PATTERN = re.compile(r'\b(\d{5})-?(\d{3})\b')
+
+def to_unit_vector(lat: float, lon: float) -> Tuple[float, float, float]:
+    """Coordenadas na esfera unitária: a distância euclidiana (corda) preserva a ordem das distâncias reais"""
+    lat_rad, lon_rad = math.radians(lat), math.radians(lon)
+    return (math.cos(lat_rad) * math.cos(lon_rad), math.cos(lat_rad) * math.sin(lon_rad), math.sin(lat_rad))
+
+def chord_to_km(chord_squared: float) -> float:
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(chord_squared) / 2))
+
+@dataclass(frozen=True)
+class Store:
+    id: str
+    nome: str
+    endereco: str
+    bairro: str
+    cidade: str
+    lat: float
+    lon: float
+
+class KDTree:
+    """
+    k-d tree em 3 dimensões sobre os vetores unitários. Nós são tuplas
+    (ponto, índice, eixo, esquerda, direita); a busca dos k vizinhos poda
+    os ramos cujo plano de corte está mais longe que o k-ésimo melhor.
+    """
+    def __init__(self, points: List[Tuple[float, float, float]]):
+        self._root = self._build([(point, position) for position, point in enumerate(points)], 0)
+
+    def _build(self, items: List[Tuple[Tuple[float, float, float], int]], depth: int):
+        if not items:
+            return None
+        axis = depth % 3
+        items.sort(key=lambda item: item[0][axis])
+        middle = len(items) // 2
+        point, position = items[middle]
+        return (point, position, axis,
+                self._build(items[:middle], depth + 1), self._build(items[middle + 1:], depth + 1))
+
+    def nearest(self, target: Tuple[float, float, float], k: int) -> List[Tuple[float, int]]:
+        """[(distância² da corda, índice)] dos k pontos mais próximos, do mais perto ao mais longe"""
+        best: List[Tuple[float, int]] = []  # Heap de máximo via distância negativa
+
+        def visit(node):
+            if node is None:
+                return
+            point, position, axis, left, right = node
+            distance = ((point[0] - target[0]) ** 2 + (point[1] - target[1]) ** 2
+                        + (point[2] - target[2]) ** 2)
+            if len(best) < k:
+                heapq.heappush(best, (-distance, position))
+            elif distance < -best[0][0]:
+                heapq.heapreplace(best, (-distance, position))
+
+            delta = target[axis] - point[axis]
+            near, far = (left, right) if delta < 0 else (right, left)
+            visit(near)
+            if len(best) < k or delta * delta < -best[0][0]:
+                visit(far)
+
+        if k > 0:
+            visit(self._root)
+        return sorted((-distance, position) for distance, position in best)
+
+class StoreCatalog:
+    """Catálogo de lojas com busca das mais próximas por coordenada ou CEP"""
+    def __init__(self, stores: List[Dict[str, Any]], cep_centroids: Dict[str, List[float]]):
+        self.stores = [Store(**store) for store in stores]
+        self._tree = KDTree([to_unit_vector(store.lat, store.lon) for store in self.stores])
+        self._cep_centroids = {prefix: (coords[0], coords[1]) for prefix, coords in cep_centroids.items()}
+        self._cep_prefix_lengths = sorted({len(prefix) for prefix in self._cep_centroids}, reverse=True)
+
+    @classmethod
+    def from_file(cls, path: str) -> 'StoreCatalog':
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        return cls(data['lojas'], data.get('cep_centroides', {}))
+
+    def __len__(self) -> int:
+        return len(self.stores)
+
+    def nearest(self, lat: float, lon: float, k: int) -> List[Tuple[Store, float]]:
+        """[(loja, distância em km)] das k lojas mais próximas"""
+        return [(self.stores[position], chord_to_km(distance))
+                for distance, position in self._tree.nearest(to_unit_vector(lat, lon), k)]
+
+    def locate_cep(self, cep: str) -> Optional[Tuple[float, float]]:
+        """Centro aproximado da região do CEP (prefixo mais longo conhecido)"""
+        digits = re.sub(r'\D', '', cep)
+        for length in self._cep_prefix_lengths:
+            coords = self._cep_centroids.get(digits[:length])
+            if coords:
+                return coords
+        return None
+
+def format_store_list(stores: List[Tuple[Store, Optional[float]]], platform: str) -> str:
+    """Lista de lojas (com distância quando conhecida) no formato de cada plataforma"""
+    lines = []
+    for store, distance in stores:
+        suffix = f" (~{distance:.1f} km)" if distance is not None else ""
+        if platform == "whatsapp":
+            region = store.bairro if store.bairro == store.cidade else f"{store.bairro} - {store.cidade}"
+            lines.append(f"📍 {store.nome}{suffix}\n{store.endereco}\n{region}")
+        else:
+            lines.append(f"• {store.nome}: {store.endereco} - {store.bairro}{suffix}")
+    return ("\n\n" if platform == "whatsapp" else "\n").join(lines)
+
+def get_store_answer(pergunta: str, platform: str, location: Optional[Tuple[float, float]] = None) -> str:
+    """Lojas mais próximas do CEP citado ou da localização compartilhada; sem referência, o catálogo"""
+    cep_match = CEP_PATTERN.search(pergunta)
+    origin = store_catalog.locate_cep(cep_match.group(0)) if cep_match else None
+    origin = origin or location
+
+    if origin:
+        nearest = store_catalog.nearest(origin[0], origin[1], config.STORES_NEAREST_COUNT)
+        header = "🏪 Lojas CarGlass mais próximas:"
+        footer = "📞 Para escolher sua loja: 0800-701-9495"
+        stores: List[Tuple[Store, Optional[float]]] = list(nearest)
+    else:
+        header = "🏪 Lojas CarGlass próximas:"
+        hint = "envie sua localização" if platform == "whatsapp" else "informe seu CEP"
+        footer = f"📍 Para ver a loja mais perto de você, {hint}.\n📞 Para escolher sua loja: 0800-701-9495"
+        stores = [(store, None) for store in store_catalog.stores[:config.STORES_NEAREST_COUNT]]
+
+    return f"\n{header}\n\n{format_store_list(stores, platform)}\n\n{footer}\n"
+
+store_catalog = StoreCatalog.from_file(config.STORES_FILE)
+logger.info("Catálogo de lojas carregado: %d lojas (%s)", len(store_catalog), config.STORES_FILE)
+
+
+# ===== FOTOS RECEBIDAS NO WHATSAPP =====
+class MediaDownloadError(Exception):
+    def __init__(self, outcome: str, message: str):
+        super().__init__(message)
+        self.outcome = outcome  # Rótulo da métrica
+
+@dataclass
+class MediaItem:
+    ordem: str
+    filename: str
+    content_type: str
+    size: int
+    sha256: str
+    received_at: str
+    source: str  # Telefone mascarado de quem enviou
+
+class MediaIngestor:
+    """
+    Recebe as fotos enviadas no WhatsApp sem segurar o webhook: o download
+    roda em threads, em blocos de MEDIA_CHUNK_SIZE direto para o disco
+    (memória constante, limite de MEDIA_MAX_BYTES), só de hosts em
+    MEDIA_ALLOWED_HOSTS, inclusive nos redirecionamentos. As miniaturas
+    (CPU) vão para um pool de processos. Cada ordem tem um diretório com
+    as fotos e um manifest.jsonl que registra o que foi recebido.
+    """
+    CONTENT_EXTENSIONS = {"image/jpeg": ".jpg", "image/png": ".png", "image/webp": ".webp",
+                          "image/heic": ".heic", "image/gif": ".gif"}
+    MAX_REDIRECTS = 3
+
+    def __init__(self, cfg: Config):
+        self.media_dir = cfg.MEDIA_DIR
+        self.allowed_hosts = {host.strip().lower() for host in cfg.MEDIA_ALLOWED_HOSTS.split(',') if host.strip()}
+        self.max_bytes = cfg.MEDIA_MAX_BYTES
+        self.chunk_size = cfg.MEDIA_CHUNK_SIZE
+        self.timeout = cfg.MEDIA_DOWNLOAD_TIMEOUT
+        self.thumbnail_size = cfg.MEDIA_THUMBNAIL_SIZE
+        # A API da Twilio exige as credenciais da conta para baixar a mídia
+        self.auth = (cfg.TWILIO_ACCOUNT_SID, cfg.TWILIO_AUTH_TOKEN) if cfg.TWILIO_ACCOUNT_SID and cfg.TWILIO_AUTH_TOKEN else None
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=cfg.MEDIA_DOWNLOAD_WORKERS, max_retries=0)
+        self.session.mount('https://', adapter)
+        self._downloads = ThreadPoolExecutor(max_workers=cfg.MEDIA_DOWNLOAD_WORKERS, thread_name_prefix="media-download")
+        # "spawn": os processos são criados a partir das threads de download, onde fork não é seguro.
+        # Só sobem no primeiro envio e importam apenas o módulo thumbnails.
+        self._thumbnails = ProcessPoolExecutor(max_workers=cfg.MEDIA_THUMBNAIL_WORKERS,
+                                               mp_context=multiprocessing.get_context("spawn"))
+        self._lock = threading.Lock()
+        self.pending = 0
+
+    def url_allowed(self, url: str) -> bool:
+        parsed = urlparse(url)
+        # Só https: o host da Twilio recebe as credenciais da conta (auth básica)
+        return parsed.scheme == 'https' and (parsed.hostname or '').lower() in self.allowed_hosts
+
+    def order_dir(self, ordem: str) -> str:
+        return os.path.join(self.media_dir, re.sub(r'[^A-Za-z0-9_-]', '_', str(ordem)))
+
+    def submit(self, ordem: str, media: List[Tuple[str, str]], phone: str = "") -> int:
+        """Agenda o download das mídias aceitas; retorna quantas foram aceitas"""
+        accepted = 0
+        for url, content_type in media:
+            if content_type.split(';')[0].strip().lower() not in self.CONTENT_EXTENSIONS:
+                metric_media_downloads.inc(outcome="unsupported_type")
+                continue
+            if not self.url_allowed(url):
+                logger.warning("🚫 Mídia de host não permitido ignorada: %s", urlparse(url).hostname)
+                metric_media_downloads.inc(outcome="host_not_allowed")
+                continue
+            with self._lock:
+                self.pending += 1
+            self._downloads.submit(self._ingest, ordem, url, phone[:4] + "***" if phone else "")
+            accepted += 1
+        return accepted
+
+    def _ingest(self, ordem: str, url: str, source: str):
+        try:
+            item = self._download(ordem, url, source)
+            if item is None:
+                metric_media_downloads.inc(outcome="duplicate")
+                return
+            metric_media_downloads.inc(outcome="stored")
+            metric_media_bytes.inc(item.size)
+            logger.info("📸 Foto recebida para a ordem %s: %s (%d bytes)", ordem, item.filename, item.size)
+            self._schedule_thumbnail(item)
+        except MediaDownloadError as e:
+            logger.warning(f"Foto da ordem {ordem} descartada: {e}")
+            metric_media_downloads.inc(outcome=e.outcome)
+        except Exception as e:
+            logger.error(f"Erro ao baixar foto da ordem {ordem}: {e}")
+            metric_media_downloads.inc(outcome="error")
+        finally:
+            with self._lock:
+                self.pending -= 1
+
+    def _open(self, url: str):
+        """GET em streaming seguindo redirecionamentos só para hosts permitidos"""
+        origin = urlparse(url).hostname
+        for _ in range(self.MAX_REDIRECTS + 1):
+            if not self.url_allowed(url):
+                raise MediaDownloadError("host_not_allowed", f"host não permitido: {urlparse(url).hostname}")
+            # Credenciais só para o host original (o redirecionamento aponta para a CDN)
+            auth = self.auth if urlparse(url).hostname == origin else None
+            response = self.session.get(url, stream=True, timeout=self.timeout, allow_redirects=False, auth=auth)
+            if not response.is_redirect:
+                if response.status_code != 200:
+                    response.close()
+                    raise MediaDownloadError("http_error", f"HTTP {response.status_code}")
+                return response
+            url = urljoin(url, response.headers.get('Location', ''))
+            response.close()
+        raise MediaDownloadError("too_many_redirects", "redirecionamentos demais")
+
+    def _download(self, ordem: str, url: str, source: str) -> Optional[MediaItem]:
+        directory = self.order_dir(ordem)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.part')
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as f, self._open(url) as response:
+                content_type = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+                if content_type not in self.CONTENT_EXTENSIONS:
+                    raise MediaDownloadError("unsupported_type", f"tipo {content_type or 'desconhecido'}")
+                if int(response.headers.get('Content-Length') or 0) > self.max_bytes:
+                    raise MediaDownloadError("too_large", "Content-Length acima do limite")
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise MediaDownloadError("too_large", f"mais de {self.max_bytes} bytes")
+                    digest.update(chunk)
+                    f.write(chunk)
+
+            filename = digest.hexdigest()[:20] + self.CONTENT_EXTENSIONS[content_type]
+            final_path = os.path.join(directory, filename)
+            if os.path.exists(final_path):
+                os.remove(temp_path)
+                return None  # Mesma foto reenviada
+            os.replace(temp_path, final_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        item = MediaItem(ordem=str(ordem), filename=filename, content_type=content_type, size=size,
+                         sha256=digest.hexdigest(), received_at=time.strftime('%Y-%m-%dT%H:%M:%S'), source=source)
+        with self._lock:
+            with open(os.path.join(directory, 'manifest.jsonl'), 'a', encoding='utf-8') as manifest:
+                manifest.write(json.dumps(asdict(item), ensure_ascii=False) + "\n")
+        return item
+
+    def _schedule_thumbnail(self, item: MediaItem):
+        if Image is None:
+            metric_media_thumbnails.inc(outcome="skipped")
+            return
+        directory = self.order_dir(item.ordem)
+        os.makedirs(os.path.join(directory, 'thumbs'), exist_ok=True)
+        future = self._thumbnails.submit(
+            make_thumbnail, os.path.join(directory, item.filename),
+            os.path.join(directory, 'thumbs', os.path.splitext(item.filename)[0] + '.jpg'), self.thumbnail_size)
+
+        def done(finished: Future):
+            failed = finished.exception() is not None
+            if failed:
+                logger.warning(f"Miniatura de {item.filename} falhou: {finished.exception()}")
+            metric_media_thumbnails.inc(outcome="error" if failed else "created")
+        future.add_done_callback(done)
+
+    def items(self, ordem: str) -> List[Dict[str, Any]]:
+        """Fotos registradas para a ordem (com a miniatura, se já existir)"""
+        directory = self.order_dir(ordem)
+        path = os.path.join(directory, 'manifest.jsonl')
+        if not os.path.exists(path):
+            return []
+        with self._lock, open(path, encoding='utf-8') as manifest:
+            items = [json.loads(line) for line in manifest if line.strip()]
+        for item in items:
+            thumbnail = os.path.join('thumbs', os.path.splitext(item['filename'])[0] + '.jpg')
+            item['thumbnail'] = thumbnail if os.path.exists(os.path.join(directory, thumbnail)) else None
+        return items
+
+    def shutdown(self):
+        self._downloads.shutdown(wait=False)
+        self._thumbnails.shutdown(wait=False)
+
+media_ingestor = MediaIngestor(config)
+atexit.register(media_ingestor.shutdown)
+
+MEDIA_PENDING_MAX = 10  # Fotos guardadas por sessão enquanto o cliente não se identifica
+MEDIA_WAITING_IDENTIFICATION = ("📸 Recebi seu arquivo! Assim que você me enviar seu CPF, telefone ou placa do veículo, "
+                                "eu o anexo à sua ordem de serviço.")
+
+def attach_media(session_data: SessionData, media: List[Tuple[str, str]]) -> str:
+    """Envia as fotos para a ordem do cliente identificado e devolve a confirmação"""
+    ordem = session_data.client_info['dados'].get('ordem', 'sem-ordem')
+    accepted = media_ingestor.submit(ordem, media, session_data.phone_number or "")
+    if not accepted:
+        return "❌ Não consegui receber esse arquivo. Envie fotos nos formatos JPG ou PNG.\n\n📞 Dúvidas: 0800-701-9495"
+    return (f"📸 Recebemos {accepted} foto(s) para a ordem *{ordem}*.\n\n"
+            "Nossa equipe vai analisar as imagens e seguir com a liberação da sua ordem. Obrigado!")
+
+def handle_media_message(session_data: SessionData, media: List[Tuple[str, str]]) -> Optional[str]:
+    """
+    Fotos enviadas no WhatsApp. Com o cliente identificado vão direto para
+    a ordem; antes disso só as URLs ficam guardadas na sessão (ver
+    attach_pending_media) e a função devolve None.
+    """
+    session_data.add_message("user", f"📎 {len(media)} arquivo(s) enviado(s)")
+    if session_data.client_identified:
+        return attach_media(session_data, media)
+    session_data.pending_media = (session_data.pending_media + media)[-MEDIA_PENDING_MAX:]
+    return None
+
+def attach_pending_media(session_data: SessionData) -> Optional[str]:
+    """Anexa as fotos guardadas assim que o cliente é identificado"""
+    if not session_data.client_identified or not session_data.pending_media:
+        return None
+    media, session_data.pending_media = session_data.pending_media, []
+    return attach_media(session_data, media)
+
+
+# ===== PROMPTS =====
+class PromptBudgetExceeded(ValueError):
+    """Dados do cliente + instruções não cabem no orçamento de tokens"""
+
+@dataclass
+class RenderedPrompt:
+    purpose: str
+    messages: List[Dict[str, str]]
+    prompt_tokens: int
+    max_tokens: int
+
+class PromptTemplate:
+    """
+    Prompt de sistema em duas partes: instruções estáticas (montadas e
+    contadas uma única vez) seguidas do bloco com os dados do cliente,
+    o único trecho preenchido a cada chamada. Manter o prefixo idêntico
+    entre chamadas também permite o cache de prompt do provedor.
+    """
+    MIN_USER_TOKENS = 16  # Abaixo disso a pergunta cortada perde o sentido
+
+    def __init__(self, purpose: str, instructions: str, context: str, counter: TokenCounter,
+                 max_prompt_tokens: int, max_completion_tokens: int):
+        self.purpose = purpose
+        self.prefix = instructions.strip() + "\n\n"
+        self.context = context.strip()
+        self.counter = counter
+        self.max_prompt_tokens = max_prompt_tokens
+        self.max_completion_tokens = max_completion_tokens
+        self._prefix_tokens: Optional[int] = None
+        self._prefix_exact = False
+
+    @property
+    def prefix_tokens(self) -> int:
+        # Recontado enquanto o encoding ainda carrega (até lá vale a estimativa)
+        if self._prefix_tokens is None or (not self._prefix_exact and self.counter.exact):
+            self._prefix_exact = self.counter.exact
+            self._prefix_tokens = self.counter.count(self.prefix)
+        return self._prefix_tokens
+
+    def render(self, user_message: str, history: Optional[ConversationContext] = None,
+               **fields: Any) -> RenderedPrompt:
+        """
+        Preenche os dados do cliente e aplica o orçamento de tokens. A
+        pergunta atual tem prioridade; o histórico ocupa o que sobrar.
+        """
+        context = self.context.format(**fields)
+        system_message = self.prefix + context
+        fixed_tokens = (self.prefix_tokens + self.counter.count(context)
+                        + 2 * TokenCounter.MESSAGE_OVERHEAD + TokenCounter.REPLY_OVERHEAD)
+
+        available = self.max_prompt_tokens - fixed_tokens
+        if available < self.MIN_USER_TOKENS:
+            raise PromptBudgetExceeded(
+                f"Prompt '{self.purpose}' usa {fixed_tokens} tokens fixos (limite {self.max_prompt_tokens})")
+
+        user_tokens = self.counter.count(user_message)
+        if user_tokens > available:
+            logger.warning("Pergunta cortada de %d para %d tokens (prompt %s)", user_tokens, available, self.purpose)
+            metric_prompt_truncated.inc(purpose=self.purpose)
+            user_message = self.counter.truncate(user_message, available)
+            user_tokens = min(user_tokens, available)
+
+        history_messages, history_tokens = [], 0
+        if history is not None:
+            history_messages, history_tokens = history.messages(available - user_tokens)
+
+        prompt_tokens = fixed_tokens + history_tokens + user_tokens
+        metric_prompt_tokens.observe(prompt_tokens, purpose=self.purpose)
+        return RenderedPrompt(
+            purpose=self.purpose,
+            messages=(
+                [{"role": "system", "content": system_message}]
+                + history_messages
+                + [{"role": "user", "content": user_message}]
+            ),
+            prompt_tokens=prompt_tokens,
+            max_tokens=self.max_completion_tokens
+        )
+
+class PromptLibrary:
+    """Templates por finalidade com os orçamentos definidos no Config"""
+    DEFAULT_COMPLETION_TOKENS = 150
+
+    def __init__(self, cfg: Config, counter: TokenCounter):
+        self.counter = counter
+        self.max_prompt_tokens = cfg.PROMPT_MAX_TOKENS
+        self.completion_budgets = {
+            purpose: int(tokens) for purpose, tokens in parse_mapping_setting(cfg.OPENAI_MAX_TOKENS).items()
+        }
+        self._templates: Dict[str, PromptTemplate] = {}
+
+    def register(self, purpose: str, instructions: str, context: str) -> PromptTemplate:
+        template = PromptTemplate(
+            purpose, instructions, context, self.counter, self.max_prompt_tokens,
+            self.completion_budgets.get(purpose, self.DEFAULT_COMPLETION_TOKENS)
+        )
+        self._templates[purpose] = template
+        return template
+
+    def get(self, purpose: str) -> PromptTemplate:
+        return self._templates[purpose]
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "exact_token_count": self.counter.exact,
+            "max_prompt_tokens": self.max_prompt_tokens,
+            "templates": {
+                purpose: {"prefix_tokens": t.prefix_tokens, "max_completion_tokens": t.max_completion_tokens}
+                for purpose, t in self._templates.items()
             }
         }
-    }
 
-    # Mapeamentos completos
-    ordem_para_cpf = {
-        "123456": "12345678900",
-        "ORD12345": "12345678900",
-        "ORD67890": "98765432100",
-        "ORD54321": "11122233344",
-        "ORD98765": "33344455566",
-        "ORD24680": "44455566677",
-        "ORD36925": "55566677788",
-        "ORD13579": "22233344455"
-    }
-    telefone_para_cpf = {
-        "11987654321": "12345678900",
-        "11976543210": "98765432100",
-        "11955556666": "11122233344",
-        "11944443333": "33344455566",
-        "11933332222": "44455566677",
-        "11911110000": "55566677788",
-        "11922221111": "22233344455"
-    }
-    placa_para_cpf = {
-        "ABC1234": "12345678900",
-        "DEF5678": "98765432100",
-        "GHI9012": "11122233344",
-        "JKL3456": "33344455566",
-        "MNO7890": "44455566677",
-        "STU5678": "55566677788",
-        "PQR1234": "22233344455"
-    }
+prompt_library = PromptLibrary(config, token_counter)
+
+STATUS_PROMPT = prompt_library.register("status", """
+Você é Clara, assistente virtual da CarGlass.
+Seu objetivo é explicar o status do atendimento de forma detalhada, amigável e humana.
+
+Instruções:
+1. Explique o status atual de forma clara e conversacional.
+2. Mencione brevemente as etapas que já foram concluídas (se houver).
+3. Informe qual(is) é(são) a(s) próxima(s) etapa(s) do processo.
+4. Mantenha um tom otimista e prestativo.
+5. Se o serviço já foi concluído, diga isso de forma celebratória.
+6. NÃO use asteriscos duplos, sublinhados ou qualquer formatação markdown excessiva na resposta, a não ser que seja um emoji.
+7. Não se refira à sua própria capacidade de IA.
+8. Lembre o cliente que pode ligar para 0800-701-9495 para mais detalhes.
+9. Finalize perguntando como mais pode ajudar.
+""", """
+Informações do atendimento (cliente: {nome}):
+- Status atual: "{status}"
+- Tipo de serviço: {tipo_servico}
+- Etapas anteriores concluídas: {completed}
+- Próximas etapas: {next_steps}
+""")
 
-    cpf_key = None
-    if tipo == "cpf" and valor in mock_database:
-        cpf_key = valor
-    elif tipo == "ordem" and valor in ordem_para_cpf:
-        cpf_key = ordem_para_cpf[valor]
-    elif tipo == "telefone" and valor in telefone_para_cpf:
-        cpf_key = telefone_para_cpf[valor]
-    elif tipo == "placa" and valor in placa_para_cpf:
-        cpf_key = placa_para_cpf[valor]
+CHAT_PROMPT = prompt_library.register("chat", """
+Você é Clara, assistente virtual da CarGlass.
 
-    if cpf_key:
-        logger.info(f"✅ Dados encontrados para {tipo}: {valor}")
-        return mock_database[cpf_key]
+IMPORTANTE:
+- Responda como uma pessoa real, de forma natural e conversacional.
+- Seja simpática, prestativa e humana.
+- NÃO use asteriscos duplos ou formatação markdown excessiva, a não ser para emojis.
+- Mantenha um tom amigável e profissional.
+- Se precisar de mais detalhes, mencione o telefone da central: 0800-701-9495.
+- Evite listar etapas ou informações técnicas que não foram pedidas explicitamente, a menos que seja sobre o status.
+""", """
+Cliente: {nome}
+Status atual do atendimento: {status}
+Tipo de serviço: {tipo_servico}
+""")
+
+IDENTIFICATION_PROMPT = prompt_library.register("identification", """
+Você é Clara, assistente virtual da CarGlass.
+Acabamos de identificar o atendimento do cliente.
 
-    logger.info(f"❌ Cliente não encontrado para {tipo}: {valor}")
-    return {"sucesso": False, "mensagem": f"Cliente não encontrado para {tipo}"}
+IMPORTANTE:
+1. Cumprimente o cliente pelo nome de forma natural e amigável.
+2. Explique o status atual, e mencione a próxima etapa.
+3. Integre os detalhes do veículo e da ordem de serviço de forma natural na conversa.
+4. NUNCA mencione loja específica pelo nome. Se precisar falar de local, diga apenas "em uma de nossas unidades" ou "nossa equipe".
+5. Seja natural, como se fosse uma pessoa real falando.
+6. NÃO use formatação excessiva ou asteriscos duplos, a não ser para emojis.
+7. Termine perguntando como pode ajudar de forma amigável e ofereça o telefone da central (0800-701-9495) para mais detalhes, se julgar relevante.
+""", """
+Informações do atendimento (cliente: {nome}):
+- Ordem: {ordem}
+- Status atual: {status}
+- Serviço: {tipo_servico}
+- Veículo: {modelo} ({ano})
+- Placa: {placa}
+- Etapas anteriores: {completed}
+- Próximas etapas: {next_steps}
+""")
 
-# Função auxiliar para determinar etapas anteriores e próximas
-def get_status_details(current_status: str) -> Tuple[List[str], List[str]]:
-    full_pipeline = [
-        "Ordem de Serviço Aberta",
-        "Aguardando fotos para liberação da ordem",
-        "Fotos Recebidas",
-        "Peça Identificada",
-        "Ordem de Serviço Liberada",
-        "Serviço agendado com sucesso", # Pode ser um estado paralelo ao "Ordem Liberada" antes da execução
-        "Em andamento", # Execução
-        "Inspeção",
-        "Concluído"
-    ]
-    
-    current_index = -1
-    for i, step in enumerate(full_pipeline):
-        if step.lower() == current_status.lower():
-            current_index = i
-            break
-            
-    if current_index == -1: # Status não encontrado no pipeline
-        return [], []
 
-    completed_steps = [s for i, s in enumerate(full_pipeline) if i < current_index]
-    next_steps = [s for i, s in enumerate(full_pipeline) if i > current_index]
-    
-    # Ajustes para casos específicos onde o fluxo pode ter ramificações ou pulos lógicos
-    if current_status.lower() == "serviço agendado com sucesso":
-        # Se agendado, as anteriores são até a liberação, e as próximas são execução e inspeção/concluído
-        completed_steps = [s for s in full_pipeline if s.lower() in ["ordem de serviço aberta", "aguardando fotos para liberação da ordem", "fotos recebidas", "peça identificada", "ordem de serviço liberada"]]
-        next_steps = ["Em andamento", "Inspeção", "Concluído"]
-    
-    return completed_steps, next_steps
+# ===== CLIENTE LLM =====
+class LLMUnavailable(RuntimeError):
+    """OpenAI não configurada (sem chave ou sem a biblioteca)"""
 
+class ModelRouter:
+    """
+    Escolhe o modelo de cada chamada: o configurado para a finalidade
+    (OPENAI_MODELS) ou, se ele não for o rápido, troca para
+    OPENAI_FAST_MODEL quando há chamadas simultâneas demais ou quando a
+    latência recente do modelo não cabe no que resta do orçamento da
+    requisição. Também acompanha latência (média móvel) e custo por modelo.
+    """
+    LATENCY_SMOOTHING = 0.2
+    LATENCY_STALE_SECONDS = 60  # Sem amostras novas o modelo volta a ser tentado
+
+    def __init__(self, cfg: Config):
+        self.default_model = cfg.OPENAI_MODEL
+        self.fast_model = cfg.OPENAI_FAST_MODEL
+        self.routes = parse_mapping_setting(cfg.OPENAI_MODELS)
+        self.busy_calls = cfg.OPENAI_BUSY_CALLS
+        self.latency_budget = cfg.OPENAI_LATENCY_BUDGET_MS / 1000.0
+        self.prices: Dict[str, Tuple[float, float]] = {}
+        for model, price in parse_mapping_setting(cfg.OPENAI_PRICES).items():
+            prompt_price, _, completion_price = price.partition('/')
+            self.prices[model] = (float(prompt_price), float(completion_price or prompt_price))
+
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._latency: Dict[str, Tuple[float, float]] = {}  # modelo -> (média móvel em s, atualizada em)
+        self._cost: Dict[str, float] = defaultdict(float)
+
+    def _remaining_budget(self) -> float:
+        """Tempo que ainda cabe na requisição atual (orçamento cheio fora de uma)"""
+        request_start = g.get('request_start') if has_request_context() else None
+        if request_start is None:
+            return self.latency_budget
+        return self.latency_budget - (time.perf_counter() - request_start)
+
+    def select(self, purpose: str) -> Tuple[str, str]:
+        """(modelo, motivo) para a finalidade"""
+        model = self.routes.get(purpose, self.default_model)
+        if model == self.fast_model:
+            return model, "route"
+        if self._in_flight >= self.busy_calls:
+            return self.fast_model, "load"
+        expected = self._latency.get(model)
+        if (expected is not None and time.time() - expected[1] < self.LATENCY_STALE_SECONDS
+                and expected[0] > self._remaining_budget()):
+            return self.fast_model, "latency"
+        return model, "route"
+
+    @contextmanager
+    def track(self, model: str):
+        """Conta a chamada como em andamento e atualiza a latência do modelo"""
+        with self._lock:
+            self._in_flight += 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self._in_flight -= 1
+                previous = self._latency.get(model)
+                smoothed = elapsed if previous is None else (
+                    previous[0] + self.LATENCY_SMOOTHING * (elapsed - previous[0]))
+                self._latency[model] = (smoothed, time.time())
+
+    def record_usage(self, purpose: str, model: str, usage: Dict[str, int]):
+        price = self.prices.get(model)
+        if not price or not usage:
+            return
+        cost = (usage.get('prompt_tokens', 0) * price[0] + usage.get('completion_tokens', 0) * price[1]) / 1000.0
+        metric_openai_cost.inc(cost, purpose=purpose, model=model)
+        with self._lock:
+            self._cost[model] += cost
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "routes": dict(self.routes),
+                "default_model": self.default_model,
+                "fast_model": self.fast_model,
+                "in_flight": self._in_flight,
+                "latency_ms": {model: round(value * 1000, 1) for model, (value, _) in self._latency.items()},
+                "cost_usd": {model: round(value, 6) for model, value in self._cost.items()}
+            }
 
-# ===== BARRA DE PROGRESSO =====
-def get_progress_bar_html(client_data: Dict[str, Any]) -> str:
-    """Gera HTML da barra de progresso baseado no status do cliente"""
-    status = client_data['dados']['status']
-    current_time = get_current_datetime()
-
-    steps = [
-        {"label": "Ordem Aberta", "state": "pending"},
-        {"label": "Aguardando Fotos", "state": "pending"},
-        {"label": "Peça Identificada", "state": "pending"},
-        {"label": "Agendado", "state": "pending"},
-        {"label": "Execução", "state": "pending"},
-        {"label": "Inspeção", "state": "pending"},
-        {"label": "Concluído", "state": "pending"}
-    ]
+class SharedSession(requests.Session):
+    """
+    Sessão HTTP compartilhada entre threads. A openai 0.28 fecha a sessão
+    de cada thread a cada MAX_SESSION_LIFETIME_SECS (3 min) e cria outra;
+    com uma sessão única, esse close() derrubaria o pool de conexões de
+    todas as threads. Aqui close() é ignorado e shutdown() fecha de fato.
+    """
+    def close(self):
+        pass
 
-    status_mapping = {
-        "Ordem de Serviço Aberta": (0, "0%", "aberta"),
-        "Aguardando fotos para liberação da ordem": (1, "14%", "aguardando"),
-        "Fotos Recebidas": (1, "28%", "recebidas"),
-        "Peça Identificada": (2, "42%", "identificada"),
-        "Ordem de Serviço Liberada": (3, "57%", "liberada"),
-        "Serviço agendado com sucesso": (3, "57%", "agendado"), # Mapeia para "Agendado"
-        "Em andamento": (4, "71%", "andamento"), # Mapeia para "Execução"
-        "Inspeção": (5, "85%", "inspecao"), # Novo estado para inspeção antes de concluído
-        "Concluído": (6, "100%", "concluido")
-    }
+    def shutdown(self):
+        super().close()
+
+class LLMClient:
+    """
+    Único ponto de acesso à OpenAI. Configura a biblioteca uma vez, mantém
+    um pool de conexões HTTP reaproveitado por todas as chamadas, escolhe
+    o modelo (ModelRouter), aplica timeout e retentativas com backoff, e
+    registra tracing e métricas.
+    """
+    def __init__(self, cfg: Config):
+        self.router = ModelRouter(cfg)
+        self.timeout = cfg.OPENAI_TIMEOUT
+        self.max_retries = cfg.OPENAI_MAX_RETRIES
+        self.retry_backoff = cfg.OPENAI_RETRY_BACKOFF
+        self.session = None
+        self.configured = bool(cfg.OPENAI_API_KEY) and len(cfg.OPENAI_API_KEY) > 10
+
+        if self.configured and openai is None:
+            logger.warning("OPENAI_API_KEY definida mas a biblioteca openai não está instalada")
+            self.configured = False
+        if not self.configured:
+            return
+
+        openai.api_key = cfg.OPENAI_API_KEY
+        # Sem isso a biblioteca abre uma sessão HTTP por thread e a recria a cada 3 min
+        self.session = SharedSession()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=cfg.OPENAI_POOL_SIZE, max_retries=0)
+        self.session.mount("https://", adapter)
+        openai.requestssession = self.session
+        atexit.register(self.session.shutdown)
+
+    @property
+    def enabled(self) -> bool:
+        """Configurada e sem sobrecarga (o controle de admissão desliga a IA na requisição degradada)"""
+        return self.configured and not admission_controller.degraded()
+
+    @staticmethod
+    def _is_retryable(error: Exception) -> bool:
+        if isinstance(error, (openai.error.Timeout, openai.error.APIConnectionError, openai.error.RateLimitError,
+                              openai.error.ServiceUnavailableError, openai.error.TryAgain)):
+            return True
+        # Erros 5xx da API também são transitórios
+        return isinstance(error, openai.error.APIError) and (error.http_status or 0) >= 500
+
+    def chat(self, purpose: str, messages: List[Dict[str, str]], max_tokens: int,
+             temperature: float = 0.7, model: Optional[str] = None) -> str:
+        """Executa uma chat completion e devolve o texto da resposta"""
+        if not self.enabled:
+            raise LLMUnavailable("OpenAI não configurada")
+
+        if model is None:
+            model, reason = self.router.select(purpose)
+            metric_openai_routing.inc(purpose=purpose, model=model, reason=reason)
+        attempt = 0
+        with tracer.span(f"openai.{purpose}"), metric_openai_duration.time(purpose=purpose, model=model):
+            while True:
+                try:
+                    with self.router.track(model):
+                        response = openai.ChatCompletion.create(
+                            model=model,
+                            messages=messages,
+                            max_tokens=max_tokens,
+                            temperature=temperature,
+                            request_timeout=self.timeout
+                        )
+                    break
+                except Exception as e:
+                    if attempt >= self.max_retries or not self._is_retryable(e):
+                        raise
+                    attempt += 1
+                    metric_openai_retries.inc(purpose=purpose, model=model)
+                    delay = self.retry_backoff * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5)
+                    logger.warning("OpenAI %s falhou (%s) - tentativa %d/%d em %.2fs",
+                                   purpose, type(e).__name__, attempt, self.max_retries, delay)
+                    time.sleep(delay)
+
+        usage = record_openai_usage(purpose, model, response)
+        self.router.record_usage(purpose, model, usage)
+        return response.choices[0].message['content'].strip()
+
+    def complete(self, prompt: RenderedPrompt, temperature: float = 0.7, model: Optional[str] = None) -> str:
+        return self.chat(prompt.purpose, prompt.messages, prompt.max_tokens, temperature, model)
+
+llm_client = LLMClient(config)
+
+
+# ===== RESPOSTA DE STATUS ANTECIPADA =====
+def generate_status_narrative(cliente_info: Any, history: Optional[ConversationContext] = None) -> str:
+    """Resposta humanizada de status via OpenAI (levanta exceção em falha)"""
+    dados = cliente_info.get('dados', {})
+    nome = dados.get('nome', 'Cliente')
+    status_atual = dados.get('status', 'Em processamento')
+    tipo_servico = dados.get('tipo_servico', 'serviço')
 
-    active_step, progress_percentage, status_class = status_mapping.get(status, (0, "0%", "desconhecido"))
+    # Obtém as etapas anteriores e próximas
+    status_info = service_pipeline.info(status_atual)
+    completed_str = status_info.completed_labels or "Nenhuma etapa anterior registrada."
+    next_str = status_info.next_labels or "Serviço está na última etapa ou concluído."
 
-    # Configura estados das etapas
-    for i, step in enumerate(steps):
-        if i < active_step:
-            step["state"] = "completed"
-        elif i == active_step:
-            step["state"] = "active"
-        # Não precisa mais do "next" no HTML, a IA fará essa parte textual
-        # elif i == active_step + 1 and active_step < len(steps) - 1:
-        #     step["state"] = "next"
+    prompt = STATUS_PROMPT.render(
+        f"Qual o status do meu atendimento para {tipo_servico}?", history,
+        nome=nome, status=status_atual, tipo_servico=tipo_servico,
+        completed=completed_str, next_steps=next_str
+    )
+    return llm_client.complete(prompt)
 
-    # Gera HTML
-    steps_html = ""
-    for step in steps:
-        state = step["state"]
-        # next_highlight = '<div class="step-highlight">Próxima etapa</div>' if state == "next" else ''
-        steps_html += f'''
-        <div class="timeline-step {state}">
-            <div class="step-node"></div>
-            <div class="step-label">{step["label"]}</div>
-            {'' if state != 'active' else '<div class="step-highlight">Etapa Atual</div>'}
-        </div>
-        '''
+@dataclass
+class SpeculativeAnswer:
+    digest: str  # Registro usado na geração; mudou = resposta obsoleta
+    future: Future
+    created_at: float
 
-    return f'''
-    <div class="status-progress-container">
-        <div class="status-current">
-            <span class="status-tag {status_class}">{status}</span>
-            <span class="status-date">{current_time}</span>
-        </div>
-        <div class="progress-timeline">
-            <div class="timeline-track" style="--progress-width: {progress_percentage};">
-                {steps_html}
-            </div>
-        </div>
-    </div>
-    '''
+class StatusSpeculator:
+    """
+    Quase toda identificação é seguida de uma pergunta de status, que custa
+    outra chamada à OpenAI. Logo após a identificação a resposta de status
+    é gerada em background e fica guardada na sessão; a pergunta seguinte
+    é respondida na hora. Só na web: no WhatsApp o comando "status" devolve
+    a timeline pronta, sem IA. Métricas: started/used/stale/wasted/failed.
+    """
+    def __init__(self, enabled: bool, workers: int, ttl: int):
+        self.enabled = enabled
+        self.ttl = ttl
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="status-speculation")
+
+    def speculate(self, session_data: SessionData):
+        record = session_data.client_info
+        if not self.enabled or not llm_client.enabled or record is None or session_data.platform != "web":
+            return
+        self.discard(session_data)
+        session_data.speculation = SpeculativeAnswer(
+            digest=record_digest(record),
+            future=self._executor.submit(generate_status_narrative, record),
+            created_at=time.time()
+        )
+        metric_status_speculation.inc(outcome="started")
 
-def get_whatsapp_status_text(client_data: Dict[str, Any]) -> str:
-    """Versão simplificada do status para WhatsApp"""
-    status = client_data['dados']['status']
+    def take(self, session_data: SessionData, record: Any) -> Optional[str]:
+        """Consome a resposta antecipada se ainda corresponder ao registro atual"""
+        speculation = session_data.speculation
+        if speculation is None:
+            return None
+        session_data.speculation = None
 
-    # Mapeia status para emojis e texto simples
-    status_emoji = {
-        "Ordem de Serviço Aberta": "📋",
-        "Aguardando fotos para liberação da ordem": "📷",
-        "Fotos Recebidas": "✅",
-        "Peça Identificada": "🔍",
-        "Ordem de Serviço Liberada": "✅",
-        "Serviço agendado com sucesso": "📅",
-        "Em andamento": "🔧",
-        "Inspeção": "🔍", # Usando lupa para inspeção
-        "Concluído": "✅"
-    }
+        if time.time() - speculation.created_at > self.ttl:
+            self._drop(speculation, "wasted")
+            return None
+        if speculation.digest != record_digest(record):
+            self._drop(speculation, "stale")
+            return None
 
-    emoji = status_emoji.get(status, "📋")
-    
-    # Obtém detalhes das etapas para a timeline simplificada
-    completed, next_steps = get_status_details(status)
+        try:
+            # Ainda em andamento: esperar sai mais barato que uma nova chamada
+            answer = speculation.future.result(timeout=config.OPENAI_TIMEOUT)
+        except Exception as e:
+            logger.warning(f"Resposta de status antecipada falhou: {e}")
+            metric_status_speculation.inc(outcome="failed")
+            return None
 
-    timeline_text_parts = ["📊 *Timeline do seu Atendimento:*"]
-    
-    # Adicionar as etapas concluídas
-    for step in completed:
-        timeline_text_parts.append(f"✅ {step}")
-        
-    # Adicionar a etapa atual
-    timeline_text_parts.append(f"🔄 *{status}*")
-    
-    # Adicionar as próximas etapas
-    if next_steps:
-        timeline_text_parts.append("\n*Próximas etapas:*")
-        for step in next_steps:
-            timeline_text_parts.append(f"⏳ {step}")
-    else:
-        if status.lower() == "concluído":
-             timeline_text_parts.append("🎉 Serviço finalizado!")
-        else:
-             timeline_text_parts.append("Não há próximas etapas definidas para este status.")
+        metric_status_speculation.inc(outcome="used")
+        logger.debug("⚡ Resposta de status antecipada utilizada")
+        return answer
+
+    def discard(self, session_data: SessionData):
+        speculation = session_data.speculation
+        if speculation is not None:
+            session_data.speculation = None
+            self._drop(speculation, "wasted")
 
-    return f"{emoji} Status Atual: {status}\n\n" + "\n".join(timeline_text_parts)
+    @staticmethod
+    def _drop(speculation: SpeculativeAnswer, outcome: str):
+        speculation.future.cancel()
+        metric_status_speculation.inc(outcome=outcome)
+
+status_speculator = StatusSpeculator(
+    config.SPECULATIVE_STATUS_ENABLED, config.SPECULATIVE_STATUS_WORKERS, config.SPECULATIVE_STATUS_TTL)
 
 
 # ===== AI SERVICE =====
-def get_ai_response(pergunta: str, cliente_info: Dict[str, Any], platform: str = "web") -> str:
-    """Processa perguntas do cliente usando IA ou respostas predefinidas"""
+STATUS_KEYWORDS = ('etapa', 'progresso', 'andamento', 'fase', 'status', 'como está', 'situação')
+
+@tracer.traced()
+def get_ai_response(pergunta: str, cliente_info: Dict[str, Any], platform: str = "web",
+                    session_data: Optional[SessionData] = None) -> str:
+    """
+    Processa perguntas do cliente usando IA ou respostas predefinidas.
+    Com session_data, as chamadas à OpenAI levam o histórico da conversa.
+    """
+    history = session_data.context if session_data else None
     pergunta_lower = pergunta.lower()
     nome = cliente_info.get('dados', {}).get('nome', 'Cliente')
     current_status = cliente_info.get('dados', {}).get('status', 'Em processamento')
 
     # Log da pergunta
-    logger.info(f"Processando pergunta ({platform}): {pergunta[:50]}...")
+    logger.info("Processando pergunta (%s): %s...", platform, pergunta[:50])
+
+    is_status_question = any(keyword in pergunta_lower for keyword in STATUS_KEYWORDS)
+    if session_data and not is_status_question:
+        # A pergunta seguinte à identificação não foi de status: a resposta antecipada não será usada
+        status_speculator.discard(session_data)
 
     # Comandos especiais para WhatsApp
     if platform == "whatsapp":
@@ -1001,7 +3812,7 @@ Sou a Clara, assistente virtual da CarGlass. Estou aqui para te ajudar com infor
     if any(keyword in pergunta_lower for keyword in ['loja', 'local', 'onde', 'endereço', 'trocar de loja', 'mudar local', 'mudar loja', 'troca de loja']):
         # SEMPRE orienta para central quando menciona trocar/mudar
         if any(keyword in pergunta_lower for keyword in ['trocar', 'mudar', 'alterar', 'escolher', 'troca']):
-            logger.info(f"Cliente solicitou troca de loja - orientando para central")
+            logger.info("Cliente solicitou troca de loja - orientando para central")
             if platform == "whatsapp":
                 return f"""
 🏪 Para trocar de loja é necessário consultar as lojas previamente.
@@ -1023,39 +3834,14 @@ Por favor, {nome}, entre em contato com nossa central de atendimento:
 Eles vão te ajudar a escolher a melhor loja para você!
 """
         # Apenas para consulta informativa específica (sem intenção de trocar)
-        elif any(keyword in pergunta_lower for keyword in ['onde fica', 'quais são', 'informação sobre lojas', 'conhecer as lojas']):
-            logger.info(f"Cliente solicitou informações sobre lojas - fornecendo lista")
-            if platform == "whatsapp":
-                return """
-🏪 Lojas CarGlass próximas:
-
-📍 CarGlass Morumbi
-Av. Professor Francisco Morato, 2307
-Butantã - São Paulo
-
-📍 CarGlass Vila Mariana  
-Rua Domingos de Morais, 1267
-Vila Mariana - São Paulo
-
-📍 CarGlass Santo André
-Av. Industrial, 600
-Santo André
-
-📞 Para escolher sua loja: 0800-701-9495
-"""
-            else:
-                return """
-🏪 Lojas CarGlass próximas:
-
-• CarGlass Morumbi: Av. Professor Francisco Morato, 2307 - Butantã
-• CarGlass Vila Mariana: Rua Domingos de Morais, 1267 - Vila Mariana
-• CarGlass Santo André: Av. Industrial, 600 - Santo André
-
-📞 Para escolher sua loja: 0800-701-9495
-"""
+        elif (any(keyword in pergunta_lower for keyword in ['onde fica', 'quais são', 'informação sobre lojas', 'conhecer as lojas',
+                                                            'mais próxima', 'mais perto', 'perto de mim'])
+              or CEP_PATTERN.search(pergunta)):
+            logger.info("Cliente solicitou informações sobre lojas - buscando as mais próximas")
+            return get_store_answer(pergunta, platform, session_data.location if session_data else None)
         else:
             # Qualquer outra menção de loja = orientar para central
-            logger.info(f"Cliente mencionou loja - orientando para central por segurança")
+            logger.info("Cliente mencionou loja - orientando para central por segurança")
             if platform == "whatsapp":
                 return f"""
 🏪 Para informações sobre lojas, entre em contato com nossa central:
@@ -1138,55 +3924,14 @@ Qual serviço você gostaria de conhecer melhor?
 """
 
     # Para perguntas sobre status - usar GPT para resposta mais humanizada e detalhada
-    if any(keyword in pergunta_lower for keyword in ['etapa', 'progresso', 'andamento', 'fase', 'status', 'como está', 'situação']):
-        if config.OPENAI_API_KEY and len(config.OPENAI_API_KEY) > 10:
+    if is_status_question:
+        if llm_client.enabled:
+            # Resposta já gerada em background logo após a identificação
+            speculated = status_speculator.take(session_data, cliente_info) if session_data else None
+            if speculated:
+                return speculated
             try:
-                import openai
-                openai.api_key = config.OPENAI_API_KEY
-
-                dados = cliente_info.get('dados', {})
-                status_atual = dados.get('status', 'Em processamento')
-                tipo_servico = dados.get('tipo_servico', 'serviço')
-                
-                # Obtém as etapas anteriores e próximas
-                completed_steps, next_steps = get_status_details(status_atual)
-                
-                completed_str = ", ".join([s.replace('Ordem de Serviço ', 'Ordem ').replace('Aguardando fotos para liberação da ordem', 'Aguardando fotos').replace('Serviço agendado com sucesso', 'Agendado') for s in completed_steps]) if completed_steps else "Nenhuma etapa anterior registrada."
-                next_str = ", ".join([s.replace('Ordem de Serviço ', 'Ordem ').replace('Aguardando fotos para liberação da ordem', 'Aguardando fotos').replace('Serviço agendado com sucesso', 'Agendado') for s in next_steps]) if next_steps else "Serviço está na última etapa ou concluído."
-
-
-                system_message = f"""
-Você é Clara, assistente virtual da CarGlass, falando com {nome}.
-Seu objetivo é explicar o status do atendimento de forma detalhada, amigável e humana.
-
-Informações do atendimento:
-- Status atual: "{status_atual}"
-- Tipo de serviço: {tipo_servico}
-- Etapas anteriores concluídas: {completed_str}
-- Próximas etapas: {next_str}
-
-Instruções:
-1. Explique o status atual de forma clara e conversacional.
-2. Mencione brevemente as etapas que já foram concluídas (se houver).
-3. Informe qual(is) é(são) a(s) próxima(s) etapa(s) do processo.
-4. Mantenha um tom otimista e prestativo.
-5. Se o serviço já foi concluído, diga isso de forma celebratória.
-6. NÃO use asteriscos duplos, sublinhados ou qualquer formatação markdown excessiva na resposta, a não ser que seja um emoji.
-7. Não se refira à sua própria capacidade de IA.
-8. Lembre o cliente que pode ligar para 0800-701-9495 para mais detalhes.
-9. Finalize perguntando como mais pode ajudar.
-"""
-                response = openai.ChatCompletion.create(
-                    model=config.OPENAI_MODEL,
-                    messages=[
-                        {"role": "system", "content": system_message},
-                        {"role": "user", "content": f"Qual o status do meu atendimento para {tipo_servico}?"}
-                    ],
-                    max_tokens=250, # Aumentado para permitir mais detalhes
-                    temperature=0.7
-                )
-
-                return response.choices[0].message['content'].strip()
+                return generate_status_narrative(cliente_info, history)
             except Exception as e:
                 logger.error(f"OpenAI erro ao gerar resposta de status detalhada: {e}")
 
@@ -1196,9 +3941,9 @@ Instruções:
         status = dados.get('status', 'Em processamento')
         previsao = dados.get('previsao_conclusao', '')
         
-        completed_steps, next_steps = get_status_details(status)
-        completed_str = ", ".join([s.replace('Ordem de Serviço ', 'Ordem ').replace('Aguardando fotos para liberação da ordem', 'Aguardando fotos') for s in completed_steps])
-        next_str = ", ".join([s.replace('Ordem de Serviço ', 'Ordem ').replace('Aguardando fotos para liberação da ordem', 'Aguardando fotos') for s in next_steps])
+        status_info = service_pipeline.info(status)
+        completed_str = status_info.completed_labels
+        next_str = status_info.next_labels
         
         response_parts = []
         response_parts.append(f"Olá {nome}! Seu atendimento está atualmente com o status: *{status}*.")
@@ -1208,7 +3953,7 @@ Instruções:
             
         if next_str:
             response_parts.append(f"A(s) próxima(s) etapa(s) será(ão): {next_str}.")
-        elif status.lower() == "concluído":
+        elif status_info.is_final:
             response_parts.append("O serviço já foi concluído com sucesso! 🎉")
         else:
             response_parts.append("Estamos trabalhando nisso e em breve teremos atualizações!")
@@ -1221,38 +3966,22 @@ Instruções:
         return "\n".join(response_parts)
 
 
+    # Perguntas frequentes respondidas sem IA quando a similaridade é alta
+    faq_entry = faq_index.answer(pergunta, config.FAQ_MIN_SCORE)
+    if faq_entry:
+        if faq_entry.id == 'lojas' and len(store_catalog):
+            # Endereços vêm do catálogo (data/lojas.json); a resposta da FAQ fica só como reserva
+            return get_store_answer(pergunta, platform, session_data.location if session_data else None)
+        return faq_entry.resposta
+
     # Fallback usando OpenAI ou genérico para outras perguntas (se não for sobre status)
-    if config.OPENAI_API_KEY and len(config.OPENAI_API_KEY) > 10:
+    if llm_client.enabled:
         try:
-            import openai
-            openai.api_key = config.OPENAI_API_KEY
-
             dados = cliente_info.get('dados', {})
-            system_message = f"""
-Você é Clara, assistente virtual da CarGlass. Cliente: {nome}
-Status atual do atendimento: {dados.get('status', 'N/A')}
-Tipo de serviço: {dados.get('tipo_servico', 'N/A')}
-
-IMPORTANTE:
-- Responda como uma pessoa real, de forma natural e conversacional.
-- Seja simpática, prestativa e humana.
-- NÃO use asteriscos duplos ou formatação markdown excessiva, a não ser para emojis.
-- Mantenha um tom amigável e profissional.
-- Se precisar de mais detalhes, mencione o telefone da central: 0800-701-9495.
-- Evite listar etapas ou informações técnicas que não foram pedidas explicitamente, a menos que seja sobre o status.
-"""
-
-            response = openai.ChatCompletion.create(
-                model=config.OPENAI_MODEL,
-                messages=[
-                    {"role": "system", "content": system_message},
-                    {"role": "user", "content": pergunta}
-                ],
-                max_tokens=150,
-                temperature=0.7
+            prompt = CHAT_PROMPT.render(
+                pergunta, history, nome=nome, status=dados.get('status', 'N/A'), tipo_servico=dados.get('tipo_servico', 'N/A')
             )
-
-            return response.choices[0].message['content'].strip()
+            return llm_client.complete(prompt)
         except Exception as e:
             logger.error(f"OpenAI erro: {e}")
 
@@ -1263,11 +3992,83 @@ IMPORTANTE:
         return f"Entendi sua pergunta, {nome}. Para informações específicas, entre em contato: 📞 0800-701-9495"
 
 # ===== PROCESSAMENTO DE IDENTIFICAÇÃO =====
+CONFIRMATION_ANSWERS = frozenset({"sim", "s", "isso", "isso mesmo", "correto", "exato", "confirmo"})
+REJECTION_ANSWERS = frozenset({"nao", "n", "errado", "nao e"})
+PHONE_CHECK_DIGITS = 4  # Últimos dígitos do telefone pedidos para liberar uma sugestão de outro número
+
+def same_phone(a: Optional[str], b: Optional[str]) -> bool:
+    """Compara pelos 8 últimos dígitos (ignora DDI/DDD e o 9 extra)"""
+    digits_a, digits_b = re.sub(r'\D', '', a or ''), re.sub(r'\D', '', b or '')
+    return len(digits_a) >= 8 and len(digits_b) >= 8 and digits_a[-8:] == digits_b[-8:]
+
+def offer_identifier_suggestion(session_data: SessionData, tipo: str, valor: str) -> Optional[str]:
+    """
+    Sugestão para um identificador não encontrado. O valor sugerido pode
+    ser de outro cliente, então só é mostrado quando o atendimento é do
+    próprio número do WhatsApp; nos demais casos fica guardado sem ser
+    revelado e só é consultado se o cliente acertar os últimos dígitos do
+    telefone cadastrado (uma tentativa).
+    """
+    suggestion = identifier_matcher.suggest(tipo, valor)
+    if not suggestion:
+        return None
+    candidate = get_client_data(tipo, suggestion)
+    telefone = candidate.get('dados', {}).get('telefone') if candidate.get('sucesso') else None
+    if not telefone:
+        return None
+
+    if same_phone(session_data.phone_number, telefone):
+        session_data.pending_identifier = (tipo, suggestion)
+        metric_identifier_suggestions.inc(outcome="offered")
+        logger.info("🤔 Sugerindo %s %s*** para %s***", tipo, suggestion[:3], valor[:3])
+        return f"""
+🤔 Não encontrei informações com a {tipo} {valor}.
+
+Você quis dizer *{suggestion}*?
+
+Responda *sim* para confirmar ou digite o identificador novamente.
+"""
+
+    session_data.pending_verification = (tipo, suggestion)
+    metric_identifier_suggestions.inc(outcome="challenged")
+    logger.info("🤔 Sugestão para %s*** aguardando confirmação pelo telefone", valor[:3])
+    return f"""
+🤔 Não encontrei informações com a {tipo} {valor}.
+
+Se foi um erro de digitação, me envie os *{PHONE_CHECK_DIGITS} últimos dígitos do telefone* cadastrado no atendimento para eu localizá-lo.
+
+Ou digite o identificador novamente.
+"""
+
+@tracer.traced()
 def process_identification(user_input: str, session_data: SessionData) -> str:
     """Processa identificação do cliente"""
-    tipo, valor = detect_identifier_type(user_input)
+    pending = session_data.pending_identifier
+    verification = session_data.pending_verification
+    session_data.pending_identifier = session_data.pending_verification = None
+    answer = fold_accents(user_input).strip(" .!")
+
+    if verification and re.fullmatch(rf'[0-9]{{{PHONE_CHECK_DIGITS}}}', answer):
+        # Últimos dígitos do telefone para a sugestão não revelada
+        tipo, valor = verification
+        candidate = get_client_data(tipo, valor)
+        telefone = re.sub(r'\D', '', str(candidate.get('dados', {}).get('telefone') or '')) if candidate.get('sucesso') else ''
+        if len(telefone) < PHONE_CHECK_DIGITS or not hmac.compare_digest(telefone[-PHONE_CHECK_DIGITS:], answer):
+            metric_identifier_suggestions.inc(outcome="verification_failed")
+            return "❌ Não consegui confirmar com esses dígitos.\n\nDigite novamente seu CPF, telefone, placa do veículo ou número da ordem de serviço."
+        metric_identifier_suggestions.inc(outcome="verified")
+    elif pending and answer in CONFIRMATION_ANSWERS:
+        # Cliente confirmou a sugestão "você quis dizer"
+        metric_identifier_suggestions.inc(outcome="accepted")
+        tipo, valor = pending
+    else:
+        if pending:
+            metric_identifier_suggestions.inc(outcome="rejected")
+            if answer in REJECTION_ANSWERS:
+                return "Sem problemas! Digite novamente seu CPF, telefone, placa do veículo ou número da ordem de serviço."
+        tipo, valor = detect_identifier_type(user_input)
 
-    logger.info(f"🔍 Processando identificação - Tipo: {tipo}, Valor: {valor[:4] if valor else 'None'}***")
+    logger.debug("🔍 Processando identificação - Tipo: %s, Valor: %s***", tipo, valor[:4] if valor else 'None')
 
     if not tipo:
         logger.info("❌ Tipo de identificador não reconhecido")
@@ -1291,10 +4092,13 @@ Por favor, forneça um identificador válido:
 """
 
     client_data = get_client_data(tipo, valor)
-    logger.info(f"📊 Resultado da consulta - Sucesso: {client_data.get('sucesso')}")
+    logger.debug("📊 Resultado da consulta - Sucesso: %s", client_data.get('sucesso'))
 
     if not client_data.get('sucesso'):
-        logger.info(f"❌ Cliente não encontrado: {tipo} = {valor}")
+        logger.info("❌ Cliente não encontrado: %s = %s", tipo, valor)
+        suggestion_reply = offer_identifier_suggestion(session_data, tipo, valor)
+        if suggestion_reply:
+            return suggestion_reply
         if session_data.platform == "whatsapp":
             return f"""
 ❌ Não encontrei informações com o {tipo} fornecido.
@@ -1316,6 +4120,8 @@ Você pode tentar:
 
     session_data.client_identified = True
     session_data.client_info = client_data
+    # A próxima mensagem quase sempre é "qual o status?": já começa a gerar a resposta
+    status_speculator.speculate(session_data)
 
     dados = client_data['dados']
     nome = dados.get('nome', 'Cliente')
@@ -1327,64 +4133,35 @@ Você pode tentar:
     ano = veiculo.get('ano', 'N/A')
     placa = veiculo.get('placa', 'N/A')
 
-    logger.info(f"✅ Cliente identificado: {nome} - Status: {status}")
+    logger.info("✅ Cliente identificado: %s - Status: %s", nome, status)
 
     # Resposta conversacional humanizada - SEM tags de status visuais
-    if config.OPENAI_API_KEY and len(config.OPENAI_API_KEY) > 10:
+    if llm_client.enabled:
         try:
-            import openai
-            openai.api_key = config.OPENAI_API_KEY
-
             # Obtém as etapas anteriores e próximas para a mensagem de identificação
-            completed_steps, next_steps = get_status_details(status)
-            completed_str = ", ".join([s.replace('Ordem de Serviço ', 'Ordem ').replace('Aguardando fotos para liberação da ordem', 'Aguardando fotos').replace('Serviço agendado com sucesso', 'Agendado') for s in completed_steps]) if completed_steps else "nenhuma etapa anterior."
-            next_str = ", ".join([s.replace('Ordem de Serviço ', 'Ordem ').replace('Aguardando fotos para liberação da ordem', 'Aguardando fotos').replace('Serviço agendado com sucesso', 'Agendado') for s in next_steps]) if next_steps else "o serviço está na última etapa ou concluído."
-
-
-            system_message = f"""
-Você é Clara, assistente virtual da CarGlass, falando com {nome}.
-Acabamos de identificar o atendimento do cliente.
-
-Informações do atendimento:
-- Ordem: {ordem}
-- Status atual: {status}
-- Serviço: {tipo_servico}
-- Veículo: {modelo} ({ano})
-- Placa: {placa}
-- Etapas anteriores: {completed_str}
-- Próximas etapas: {next_str}
-
-IMPORTANTE:
-1. Cumprimente o cliente pelo nome de forma natural e amigável.
-2. Explique o status atual, e mencione a próxima etapa.
-3. Integre os detalhes do veículo e da ordem de serviço de forma natural na conversa.
-4. NUNCA mencione loja específica pelo nome. Se precisar falar de local, diga apenas "em uma de nossas unidades" ou "nossa equipe".
-5. Seja natural, como se fosse uma pessoa real falando.
-6. NÃO use formatação excessiva ou asteriscos duplos, a não ser para emojis.
-7. Termine perguntando como pode ajudar de forma amigável e ofereça o telefone da central (0800-701-9495) para mais detalhes, se julgar relevante.
-"""
-
-            response = openai.ChatCompletion.create(
-                model=config.OPENAI_MODEL,
-                messages=[
-                    {"role": "system", "content": system_message},
-                    {"role": "user", "content": f"Cliente forneceu {tipo}: {valor}. Responda ao cliente agora."}
-                ],
-                max_tokens=350, # Aumentado para mais detalhes
-                temperature=0.7
+            status_info = service_pipeline.info(status)
+            completed_str = status_info.completed_labels or "nenhuma etapa anterior."
+            next_str = status_info.next_labels or "o serviço está na última etapa ou concluído."
+
+            prompt = IDENTIFICATION_PROMPT.render(
+                f"Cliente forneceu {tipo}: {valor}. Responda ao cliente agora.",
+                nome=nome, ordem=ordem, status=status, tipo_servico=tipo_servico,
+                modelo=modelo, ano=ano, placa=placa, completed=completed_str, next_steps=next_str
             )
 
+            reply = llm_client.complete(prompt)
+
             logger.info("✅ Resposta OpenAI gerada com sucesso para identificação")
-            return response.choices[0].message['content'].strip()
+            return reply
 
         except Exception as e:
             logger.error(f"❌ OpenAI erro na identificação: {e}")
 
     # Fallback humanizado sem OpenAI (melhorado para ser mais detalhado)
     previsao = dados.get('previsao_conclusao', '')
-    completed_steps, next_steps = get_status_details(status)
-    completed_str = ", ".join([s.replace('Ordem de Serviço ', 'Ordem ').replace('Aguardando fotos para liberação da ordem', 'Aguardando fotos') for s in completed_steps])
-    next_str = ", ".join([s.replace('Ordem de Serviço ', 'Ordem ').replace('Aguardando fotos para liberação da ordem', 'Aguardando fotos') for s in next_steps])
+    status_info = service_pipeline.info(status)
+    completed_str = status_info.completed_labels
+    next_str = status_info.next_labels
 
     response_parts = []
     response_parts.append(f"👋 Olá {nome}! Encontrei suas informações.")
@@ -1394,7 +4171,7 @@ IMPORTANTE:
         response_parts.append(f"Já passamos pelas etapas de: {completed_str}.")
     if next_str:
         response_parts.append(f"A(s) próxima(s) etapa(s) será(ão): {next_str}.")
-    elif status.lower() == "concluído":
+    elif status_info.is_final:
         response_parts.append("O serviço já foi concluído com sucesso! 🎉")
     else:
         response_parts.append("Estamos trabalhando nisso e em breve teremos atualizações!")
@@ -1416,20 +4193,29 @@ IMPORTANTE:
 
 # ===== MIDDLEWARES DE SEGURANÇA PARA HML =====
 
+REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{8,64}$')
+
 @app.before_request
 def hml_security_check():
     """Verificações básicas para HML"""
+    # ID da requisição: reaproveita X-Request-ID do proxy quando válido
+    incoming_id = request.headers.get('X-Request-ID', '')
+    g.request_id = incoming_id if REQUEST_ID_PATTERN.match(incoming_id) else uuid.uuid4().hex[:16]
+    tracer.start_request(g.request_id, request.endpoint or request.path)
+
     ip = get_remote_address()
 
     # Apenas bloqueia abuse extremo
     if security_manager.is_ip_blocked(ip):
-        logger.warning(f"🚫 IP bloqueado: {ip}")
+        logger.warning("🚫 IP bloqueado: %s", ip)
         abort(429)  # Too Many Requests
 
     # Log para monitoramento
     if request.endpoint in ['send_message', 'whatsapp_webhook']:
         security_manager.log_request(ip, request.endpoint)
 
+    g.request_start = time.perf_counter()
+
 @app.after_request
 def hml_security_headers(response):
     """Headers básicos para HML"""
@@ -1440,8 +4226,128 @@ def hml_security_headers(response):
     # Remove headers que vazam informações
     response.headers.pop('Server', None)
 
+    if g.get('request_id'):
+        response.headers['X-Request-ID'] = g.request_id
+    g.response_status = response.status_code
+
+    # Métricas por rota (endpoint Flask evita cardinalidade alta com URLs arbitrárias)
+    route = request.endpoint or "unknown"
+    metric_http_requests.inc(route=route, method=request.method, status=response.status_code)
+    request_start = g.get('request_start')
+    if request_start is not None:
+        metric_http_duration.observe(time.perf_counter() - request_start, route=route)
+
     return response
 
+@app.teardown_request
+def finish_request_trace(exc=None):
+    """Fecha o trace mesmo quando a requisição termina com exceção"""
+    tracer.finish_request(g.get('response_status', 500 if exc else None))
+
+# ===== CONTROLE DE ADMISSÃO =====
+class AdmissionController:
+    """
+    Protege as rotas de mensagem quando OpenAI ou a API de status ficam
+    lentas. Acima do limite suave (requisições em andamento ou espera no
+    proxy via X-Request-Start) a requisição segue sem IA, com as respostas
+    determinísticas; acima do limite rígido é recusada com 503 e
+    Retry-After antes de gastar qualquer recurso. A contagem é por
+    processo, então depende de workers com threads (Procfile: gthread);
+    com workers sync ela nunca passa de 1. A espera no proxy só conta se
+    ele enviar X-Request-Start, o que o Render não faz: num nginx à
+    frente, proxy_set_header X-Request-Start "t=${msec}".
+    """
+    def __init__(self, cfg: Config):
+        self.soft_limit = cfg.ADMISSION_SOFT_LIMIT
+        self.hard_limit = cfg.ADMISSION_HARD_LIMIT
+        self.soft_queue_ms = cfg.ADMISSION_SOFT_QUEUE_MS
+        self.hard_queue_ms = cfg.ADMISSION_HARD_QUEUE_MS
+        self.retry_after = cfg.ADMISSION_RETRY_AFTER
+        self.in_flight = 0
+        self.shed = 0
+        self.degraded_total = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def queue_ms(header: str, now: float) -> Optional[float]:
+        """Espera desde X-Request-Start ("t=1690000000.123" em s, ms ou µs)"""
+        value = header.strip()
+        if value.startswith('t='):
+            value = value[2:]
+        try:
+            start = float(value)
+        except ValueError:
+            return None
+        if start > 1e14:
+            start /= 1e6  # Microssegundos
+        elif start > 1e11:
+            start /= 1e3  # Milissegundos (Heroku)
+        return max(0.0, (now - start) * 1000)
+
+    def degraded(self) -> bool:
+        """A requisição atual foi admitida sem IA?"""
+        return has_request_context() and g.get('admission_degraded', False)
+
+    def shed_response(self):
+        response = jsonify({"error": "Serviço sobrecarregado, tente novamente em instantes"})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(self.retry_after)
+        return response
+
+    def guard(self, route: str):
+        """Decorator das rotas de mensagem"""
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                header = request.headers.get('X-Request-Start')
+                queue_ms = self.queue_ms(header, time.time()) if header else None
+                if queue_ms is not None:
+                    metric_request_queue.observe(queue_ms / 1000, route=route)
+
+                with self._lock:
+                    in_flight = self.in_flight
+                    shed = in_flight >= self.hard_limit or (queue_ms or 0) >= self.hard_queue_ms
+                    if shed:
+                        self.shed += 1
+                    else:
+                        self.in_flight += 1
+                if shed:
+                    logger.warning("🚦 Requisição recusada (%s): %d em andamento, fila %s ms",
+                                   route, in_flight, f"{queue_ms:.0f}" if queue_ms is not None else "?")
+                    metric_admission.inc(route=route, decision="shed")
+                    return self.shed_response()
+
+                degraded = in_flight >= self.soft_limit or (queue_ms or 0) >= self.soft_queue_ms
+                g.admission_degraded = degraded
+                if degraded:
+                    with self._lock:
+                        self.degraded_total += 1
+                    logger.info("🚦 Requisição degradada sem IA (%s): %d em andamento", route, in_flight)
+                metric_admission.inc(route=route, decision="degraded" if degraded else "admitted")
+                try:
+                    return view(*args, **kwargs)
+                finally:
+                    with self._lock:
+                        self.in_flight -= 1
+            return wrapper
+        return decorator
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "in_flight": self.in_flight,
+            "soft_limit": self.soft_limit,
+            "hard_limit": self.hard_limit,
+            "soft_queue_ms": self.soft_queue_ms,
+            "hard_queue_ms": self.hard_queue_ms,
+            "degraded": self.degraded_total,
+            "shed": self.shed
+        }
+
+admission_controller = AdmissionController(config)
+metrics.gauge_callback("carglass_admission_in_flight", "Requisições de mensagem em andamento neste processo",
+                       lambda: admission_controller.in_flight)
+
+
 # ===== ROTAS FLASK =====
 
 @app.route('/')
@@ -1482,6 +4388,7 @@ def get_messages():
 
 @app.route('/send_message', methods=['POST'])
 @limiter.limit("30 per minute")  # Mais permissivo para testes
+@admission_controller.guard("send_message")
 def send_message():
     """Versão para homologação"""
     try:
@@ -1493,7 +4400,7 @@ def send_message():
         if not user_input:
             return jsonify({'error': 'Mensagem vazia'}), 400
 
-        logger.info(f"📨 Mensagem HML de {ip[:8]}***: {user_input[:50]}...")
+        logger.info("📨 Mensagem HML de %s***: %s...", ip[:8], user_input[:50])
 
         # Lógica original mantida
         session_id = session.get('session_id')
@@ -1506,9 +4413,11 @@ def send_message():
         session_data.add_message("user", user_input)
 
         if not session_data.client_identified:
-            response = process_identification(user_input, session_data)
+            with metric_message_handling.time(stage="identification", platform=session_data.platform):
+                response = process_identification(user_input, session_data)
         else:
-            response = get_ai_response(user_input, session_data.client_info, session_data.platform)
+            with metric_message_handling.time(stage="chat", platform=session_data.platform):
+                response = get_ai_response(user_input, session_data.client_info, session_data.platform, session_data)
 
         session_data.add_message("assistant", response)
 
@@ -1521,6 +4430,7 @@ def send_message():
 
 @app.route('/whatsapp/webhook', methods=['POST'])
 @limiter.limit("60 per minute")  # Mais permissivo para testes
+@admission_controller.guard("whatsapp_webhook")
 def whatsapp_webhook():
     """Webhook WhatsApp para homologação"""
     ip = get_remote_address()
@@ -1543,11 +4453,25 @@ def whatsapp_webhook():
         phone = message_data['phone']
         message_text = sanitize_input(message_data['message'])
 
-        logger.info(f"📱 WhatsApp HML de {phone[:6]}***: {message_text[:30]}...")
+        logger.info("📱 WhatsApp HML de %s***: %s...", phone[:6], message_text[:30])
 
         session_data = session_manager.get_whatsapp_session(phone)
 
-        if message_text.lower() in ['reiniciar', 'reset', 'nova consulta']:
+        # Fotos: download em background, o webhook responde na hora. A legenda
+        # (ex.: CPF, placa, "status") segue o fluxo normal de texto.
+        media_reply = handle_media_message(session_data, message_data['media']) if message_data.get('media') else None
+        media_only = bool(message_data.get('media')) and not message_text
+
+        if message_data.get('location'):
+            # Localização compartilhada: responde com as lojas mais próximas
+            session_data.location = message_data['location']
+            session_data.add_message("user", "📍 Localização compartilhada")
+            response = get_store_answer("", "whatsapp", session_data.location)
+            session_data.add_message("assistant", response)
+        elif media_only:
+            response = media_reply or MEDIA_WAITING_IDENTIFICATION
+            session_data.add_message("assistant", response)
+        elif message_text.lower() in ['reiniciar', 'reset', 'nova consulta']:
             if session_data.session_id in session_manager.sessions:
                 session_manager._remove_session(session_data.session_id)
             session_data = session_manager.create_session("whatsapp", phone)
@@ -1556,10 +4480,18 @@ def whatsapp_webhook():
             session_data.add_message("user", message_text)
 
             if not session_data.client_identified:
-                response = process_identification(message_text, session_data)
+                with metric_message_handling.time(stage="identification", platform="whatsapp"):
+                    response = process_identification(message_text, session_data)
+                # Fotos enviadas antes da identificação (inclusive com o CPF/placa na legenda)
+                pending_reply = attach_pending_media(session_data)
+                if pending_reply:
+                    response = f"{response}\n\n{pending_reply}"
             else:
-                response = get_ai_response(message_text, session_data.client_info, "whatsapp")
+                with metric_message_handling.time(stage="chat", platform="whatsapp"):
+                    response = get_ai_response(message_text, session_data.client_info, "whatsapp", session_data)
 
+            if media_reply:
+                response = f"{media_reply}\n\n{response}"
             session_data.add_message("assistant", response)
 
         formatted_response = format_for_whatsapp(response)
@@ -1603,23 +4535,19 @@ def test_openai():
         })
 
     try:
-        import openai
-        openai.api_key = config.OPENAI_API_KEY
-
         # Teste simples da API
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",  # Modelo mais barato para teste
-            messages=[
-                {"role": "user", "content": "Responda apenas 'OK' se você está funcionando"}
-            ],
+        reply = llm_client.chat(
+            "test",
+            [{"role": "user", "content": "Responda apenas 'OK' se você está funcionando"}],
             max_tokens=10,
-            temperature=0
+            temperature=0,
+            model=config.OPENAI_FAST_MODEL  # Modelo mais barato para teste
         )
 
         return jsonify({
             "status": "success",
             "message": "OpenAI configurada corretamente",
-            "response": response.choices[0].message['content'],
+            "response": reply,
             "model": config.OPENAI_MODEL
         })
 
@@ -1635,7 +4563,7 @@ def health_check():
     """Endpoint para verificação de saúde da aplicação"""
     try:
         # Cleanup periódico
-        cache.cleanup_expired()
+        client_records.cleanup_expired()
         session_manager._cleanup_expired()
 
         stats = session_manager.get_stats()
@@ -1644,8 +4572,9 @@ def health_check():
             "status": "healthy",
             "timestamp": get_current_time(),
             "sessions": stats,
-            "cache_items": len(cache.cache),
+            "cache_items": len(client_records),
             "twilio_enabled": twilio_handler.is_enabled(),
+            "admission": admission_controller.snapshot(),
             "config": {
                 "use_real_api": config.USE_REAL_API,
                 "openai_configured": bool(config.OPENAI_API_KEY),
@@ -1664,6 +4593,125 @@ def health_check():
             "timestamp": get_current_time()
         }), 500
 
+# ===== CONSULTA EM LOTE (CENTRAL DE ATENDIMENTO) =====
+batch_executor = ThreadPoolExecutor(max_workers=config.BATCH_MAX_WORKERS, thread_name_prefix="batch-lookup")
+batch_api_keys = [key.strip() for key in config.BATCH_API_KEYS.split(',') if key.strip()]
+
+def batch_api_key_valid(provided: str) -> bool:
+    # Compara com todas as chaves para não vazar qual delas quase bateu
+    matches = [tokens_match(provided, key) for key in batch_api_keys]
+    return bool(provided) and any(matches)
+
+def lookup_identifier(raw: str) -> Dict[str, Any]:
+    """
+    Classifica e resolve um identificador (executado nas threads do pool).
+    Sem fallback para a base mockada: com a API fora do ar a central
+    recebe "erro" em vez de um registro fictício ou de um falso negativo.
+    """
+    tipo, valor = detect_identifier_type(raw)
+    if not tipo:
+        return {"tipo": None, "sucesso": False, "mensagem": "Identificador não reconhecido"}
+    data = fetch_client_data(tipo, valor, allow_fallback=False)
+    if data is None:
+        return {"tipo": tipo, "sucesso": False, "erro": "API de status indisponível"}
+    result = thaw_record(data)
+    result["tipo"] = tipo
+    return result
+
+def stream_batch_lookups(items: List[Tuple[int, str]]):
+    """
+    Gera uma linha NDJSON por (posição na entrada, identificador) na ordem
+    em que ficam prontos, mantendo no máximo BATCH_MAX_WORKERS consultas
+    em andamento por requisição.
+    """
+    start = time.perf_counter()
+    found = 0
+    pending = {}
+    queued = iter(items)
+
+    def submit_next() -> bool:
+        item = next(queued, None)
+        if item is None:
+            return False
+        index, raw = item
+        pending[batch_executor.submit(lookup_identifier, raw)] = (index, raw)
+        return True
+
+    while len(pending) < config.BATCH_MAX_WORKERS and submit_next():
+        pass
+
+    while pending:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            index, raw = pending.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.error(f"Erro na consulta em lote ({index}): {e}")
+                result = {"tipo": None, "sucesso": False, "erro": "Erro interno na consulta"}
+            if result.get("sucesso"):
+                outcome = "found"
+            elif "erro" in result:
+                outcome = "error"
+            else:
+                outcome = "invalid" if result.get("tipo") is None else "not_found"
+            metric_batch_lookups.inc(result=outcome)
+            found += outcome == "found"
+            yield json.dumps({"index": index, "input": raw, **result}, ensure_ascii=False) + "\n"
+            submit_next()
+
+    yield json.dumps({"resumo": {
+        "total": len(items),
+        "encontrados": found,
+        "segundos": round(time.perf_counter() - start, 3)
+    }}, ensure_ascii=False) + "\n"
+
+@app.route('/api/status/batch', methods=['POST'])
+@limiter.limit("30 per minute")
+def batch_status_lookup():
+    """
+    Consulta em lote para a central de atendimento. Autenticação por
+    X-API-Key; corpo JSON {"identificadores": [...]} ou texto com um
+    identificador por linha. Resposta em NDJSON, uma linha por item.
+    """
+    if not batch_api_keys:
+        return jsonify({"error": "Consulta em lote desabilitada"}), 403
+    if not batch_api_key_valid(request.headers.get('X-API-Key', '')):
+        logger.warning("🚫 Consulta em lote com X-API-Key inválida de %s", get_remote_address())
+        return jsonify({"error": "Unauthorized"}), 401
+
+    if request.is_json:
+        payload = request.get_json(silent=True) or {}
+        identifiers = payload.get('identificadores') if isinstance(payload, dict) else None
+    else:
+        identifiers = request.get_data(as_text=True).splitlines()
+    if not isinstance(identifiers, list) or not all(isinstance(item, str) for item in identifiers):
+        return jsonify({"error": "Envie {\"identificadores\": [\"...\"]} ou um identificador por linha"}), 400
+
+    # Linhas em branco são ignoradas, mas "index" continua sendo a posição na entrada
+    items = [(index, sanitize_input(item)) for index, item in enumerate(identifiers) if item.strip()]
+    if not items:
+        return jsonify({"error": "Nenhum identificador informado"}), 400
+    if len(items) > config.BATCH_MAX_IDENTIFIERS:
+        return jsonify({"error": f"Máximo de {config.BATCH_MAX_IDENTIFIERS} identificadores por lote"}), 413
+
+    logger.info("📦 Consulta em lote: %d identificadores", len(items))
+    return Response(stream_with_context(stream_batch_lookups(items)), mimetype='application/x-ndjson')
+
+@app.route('/metrics')
+@limiter.exempt
+def metrics_endpoint():
+    """Métricas no formato texto do Prometheus (por processo/worker)"""
+    if config.METRICS_TOKEN:
+        token = request.headers.get('Authorization', '').replace('Bearer ', '', 1) or request.args.get('token', '')
+        if not tokens_match(token, config.METRICS_TOKEN):
+            return jsonify({"error": "Unauthorized"}), 401
+    elif not config.DEBUG:
+        # Sem token, as contagens de sessões/cache/descartes não ficam públicas
+        abort(404)
+
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
 @app.route('/whatsapp/status')
 def whatsapp_status():
     """Endpoint para verificar status do WhatsApp"""
@@ -1693,11 +4741,23 @@ def hml_status():
             "twilio_webhook": config.TWILIO_AUTH_TOKEN is not None,
             "rate_limiting": True,
             "input_sanitization": True,
-            "ip_blocking": len(security_manager.blocked_ips)
+            "ip_blocking": security_manager.active_blocks()
         },
         "request_stats": {
             "monitored_ips": len(security_manager.request_counts),
-            "blocked_ips": len(security_manager.blocked_ips)
+            "blocked_ips": security_manager.active_blocks()
+        },
+        "prompts": prompt_library.summary(),
+        "llm_routing": llm_client.router.snapshot(),
+        "status_refresh": {
+            "enabled": config.STATUS_REFRESH_ENABLED,
+            "interval_seconds": config.STATUS_REFRESH_INTERVAL,
+            "cycles": status_refresher.cycles
+        },
+        "media": {
+            "dir": config.MEDIA_DIR,
+            "pending_downloads": media_ingestor.pending,
+            "thumbnails": Image is not None
         },
         "recommendations": [
             "✅ Ambiente adequado para testes",
@@ -1747,6 +4807,7 @@ def debug_sessions():
                 "platform": session_data.platform,
                 "client_identified": session_data.client_identified,
                 "messages_count": len(session_data.messages),
+                "context": session_data.context.to_dict(),
                 "created_at": time.strftime("%H:%M:%S", time.localtime(session_data.created_at)),
                 "last_activity": time.strftime("%H:%M:%S", time.localtime(session_data.last_activity)),
                 "phone_number": session_data.phone_number[:4] + "***" if session_data.phone_number else None
@@ -1761,6 +4822,13 @@ def debug_sessions():
         logger.error(f"Erro no debug sessions: {e}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/debug/media/<ordem>')
+def debug_media(ordem):
+    """Fotos recebidas pelo WhatsApp para uma ordem"""
+    if not debug_access_allowed():
+        return jsonify({"error": "Debug mode not enabled"}), 403
+    return jsonify({"ordem": ordem, "items": media_ingestor.items(ordem)})
+
 @app.route('/debug/cache')
 def debug_cache():
     """Endpoint para debug do cache (apenas em modo DEBUG)"""
@@ -1768,24 +4836,83 @@ def debug_cache():
         return jsonify({"error": "Debug mode not enabled"}), 403
 
     try:
-        cache_info = {}
-        current_time = time.time()
-
-        for key, item in cache.cache.items():
-            cache_info[key] = {
-                "expires_in": max(0, int(item['expires'] - current_time)),
-                "size": len(str(item['value']))
-            }
-
         return jsonify({
-            "cache_size": len(cache.cache),
-            "max_items": cache.max_items,
-            "items": cache_info
+            "cache_size": len(client_records),
+            "max_items": client_records.max_records,
+            "stats": client_records.stats(),
+            "items": client_records.debug_info()
         })
     except Exception as e:
         logger.error(f"Erro no debug cache: {e}")
         return jsonify({"error": str(e)}), 500
 
+def debug_access_allowed() -> bool:
+    """Modo DEBUG ou header X-Admin-Token válido"""
+    if config.DEBUG:
+        return True
+    token = request.headers.get('X-Admin-Token', '')
+    return bool(config.ADMIN_TOKEN) and tokens_match(token, config.ADMIN_TOKEN)
+
+@app.route('/debug/profile')
+def debug_profile():
+    """
+    Profiler por amostragem do processo atual (saída collapsed stack).
+
+    Parâmetros: seconds (máx. 60), interval_ms, route (endpoint Flask, ex.
+    send_message), background=1 para não bloquear a requisição e buscar o
+    resultado depois em /debug/profile/<id>. No modo síncrono o worker
+    precisa atender outras requisições em paralelo (gthread/dev server).
+    """
+    if not debug_access_allowed():
+        return jsonify({"error": "Debug mode not enabled"}), 403
+
+    try:
+        seconds = float(request.args.get('seconds', '5'))
+        interval = float(request.args.get('interval_ms', '10')) / 1000
+        if not (math.isfinite(seconds) and math.isfinite(interval)):
+            raise ValueError("nan/inf")  # Chegariam ao time.sleep
+    except ValueError:
+        return jsonify({"error": "Parâmetros seconds/interval_ms inválidos"}), 400
+
+    route = request.args.get('route') or None
+    if route and route not in app.view_functions:
+        return jsonify({"error": f"Rota desconhecida: {route}"}), 400
+
+    profiler = SamplingProfiler(seconds, interval, route)
+
+    if request.args.get('background') == '1':
+        profile_id = profiler_manager.start_background(profiler)
+        if not profile_id:
+            return jsonify({"error": "Já existe um profile em execução"}), 409
+        return jsonify({"profile_id": profile_id, "result_url": f"/debug/profile/{profile_id}",
+                        "seconds": profiler.seconds, "route": route}), 202
+
+    logger.info("Profiler iniciado: %ss, rota=%s", profiler.seconds, route or 'todas')
+    if not profiler_manager.run_sync(profiler):
+        return jsonify({"error": "Já existe um profile em execução"}), 409
+    return _profile_response(profiler)
+
+@app.route('/debug/profile/<profile_id>')
+def debug_profile_result(profile_id):
+    """Resultado de um profile iniciado com background=1"""
+    if not debug_access_allowed():
+        return jsonify({"error": "Debug mode not enabled"}), 403
+
+    profiler = profiler_manager.results.get(profile_id)
+    if profiler:
+        return _profile_response(profiler)
+    if profiler_manager.running == profile_id:
+        return jsonify({"status": "running"}), 202
+    return jsonify({"error": "Profile não encontrado"}), 404
+
+def _profile_response(profiler: SamplingProfiler):
+    if request.args.get('format') == 'json':
+        return jsonify({**profiler.summary(), "stacks": profiler.counts})
+
+    response = Response(profiler.collapsed(), mimetype='text/plain; charset=utf-8')
+    response.headers['X-Profile-Samples'] = str(profiler.samples)
+    return response
+
 # ===== TRATAMENTO DE ERROS =====
 @app.errorhandler(404)
 def not_found(error):
@@ -1800,6 +4927,9 @@ def internal_error(error):
 
 @app.errorhandler(Exception)
 def handle_exception(e):
+    # 429 (rate limit), 403 etc. mantêm o status original
+    if isinstance(e, HTTPException):
+        return e
     logger.error(f"Exceção não tratada: {e}")
     logger.error(traceback.format_exc())
     return jsonify({'error': 'Erro interno do servidor'}), 500
@@ -1810,7 +4940,7 @@ def initialize_app():
     logger.info("🔧 Inicializando componentes da aplicação...")
 
     # Cleanup inicial
-    cache.cleanup_expired()
+    client_records.cleanup_expired()
     session_manager._cleanup_expired()
 
     # Testa configurações
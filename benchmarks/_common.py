@@ -0,0 +1,111 @@
+"""
+Utilitários compartilhados pelos scripts de benchmark.
+
+Os scripts deste diretório importam o `app.py` diretamente, portanto as
+variáveis de ambiente que afetam o `Config` precisam ser definidas ANTES
+do import (ver `prepare_environment`).
+"""
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCH_DIR)
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+
+
+def prepare_environment(**overrides: str):
+    """Define variáveis de ambiente seguras para benchmark e coloca o repo no sys.path"""
+    defaults = {
+        "USE_REAL_API": "false",  # Nunca bate na API CarGlass real
+        "OPENAI_API_KEY": "",      # Fallbacks determinísticos, sem custo
+    }
+    defaults.update(overrides)
+    for key, value in defaults.items():
+        os.environ.setdefault(key, value)
+
+    if REPO_ROOT not in sys.path:
+        sys.path.insert(0, REPO_ROOT)
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """Percentil com interpolação linear (valores já ordenados)"""
+    if not sorted_values:
+        return 0.0
+    if len(sorted_values) == 1:
+        return sorted_values[0]
+
+    rank = (len(sorted_values) - 1) * (pct / 100.0)
+    lower = int(rank)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    weight = rank - lower
+    return sorted_values[lower] * (1 - weight) + sorted_values[upper] * weight
+
+
+def summarize_latencies(latencies_ms: List[float], elapsed_s: float, errors: int = 0) -> Dict[str, Any]:
+    """Resume uma lista de latências (ms) em p50/p95/p99 e throughput"""
+    values = sorted(latencies_ms)
+    count = len(values)
+    return {
+        "count": count,
+        "errors": errors,
+        "mean_ms": round(sum(values) / count, 3) if count else 0.0,
+        "p50_ms": round(percentile(values, 50), 3),
+        "p95_ms": round(percentile(values, 95), 3),
+        "p99_ms": round(percentile(values, 99), 3),
+        "max_ms": round(values[-1], 3) if count else 0.0,
+        "throughput_rps": round(count / elapsed_s, 2) if elapsed_s > 0 else 0.0
+    }
+
+
+def git_commit() -> str:
+    """Commit atual do repositório (ou 'unknown' fora de um checkout git)"""
+    try:
+        result = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=REPO_ROOT, capture_output=True, text=True, timeout=5
+        )
+        if result.returncode == 0:
+            return result.stdout.strip()
+    except Exception:
+        pass
+    return "unknown"
+
+
+def run_metadata(params: Dict[str, Any]) -> Dict[str, Any]:
+    """Metadados gravados junto com cada resultado"""
+    return {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "params": params
+    }
+
+
+def save_results(results: Dict[str, Any], path: Optional[str], prefix: str) -> str:
+    """Grava resultados em JSON; sem caminho explícito usa results/<prefix>-<commit>.json"""
+    if not path:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        commit = results.get("meta", {}).get("commit", "unknown")
+        path = os.path.join(RESULTS_DIR, f"{prefix}-{commit}.json")
+
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2, ensure_ascii=False, sort_keys=True)
+    return path
+
+
+def load_results(path: str) -> Dict[str, Any]:
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def relative_change(baseline: float, current: float) -> float:
+    """Variação relativa (0.10 = 10% maior que o baseline)"""
+    if baseline <= 0:
+        return 0.0
+    return (current - baseline) / baseline
@@ -0,0 +1,143 @@
+"""
+Mede a base de FAQ (FaqIndex): acerto nas perguntas reais e latência de
+consulta sobre bases sintéticas com milhares de entradas.
+
+A acurácia usa data/faq.json com perguntas reescritas à mão (rótulo =
+entrada esperada ou None quando a pergunta deve seguir para a IA). A
+latência usa entradas geradas a partir de um vocabulário do domínio,
+consultadas com trechos das próprias perguntas.
+
+Uso:
+    python benchmarks/bench_faq.py
+    python benchmarks/bench_faq.py --entries 1000 5000 20000 --queries 2000
+"""
+import argparse
+import logging
+import random
+import sys
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from _common import prepare_environment, run_metadata, save_results, summarize_latencies
+
+prepare_environment()
+import app as carglass_app  # noqa: E402
+
+# (pergunta do cliente, id esperado ou None = deve ir para a IA)
+LABELED_QUESTIONS: List[Tuple[str, Optional[str]]] = [
+    ("vcs abrem sabado?", "horario"),
+    ("que horas fecha a central", "horario"),
+    ("a garantia cobre se o vidro descolar?", "garantia_cobertura"),
+    ("preciso calibrar a camera do carro?", "adas"),
+    ("tem como consertar uma trinca pequena", "reparo_ou_troca"),
+    ("como mando as fotos", "fotos"),
+    ("quero remarcar a data", "agendamento"),
+    ("qual o numero de telefone", "contato"),
+    ("fazem insulfilm?", "pelicula"),
+    ("meu farol ta amarelado", "farois"),
+    ("vocês trocam vidro traseiro?", "servicos"),
+    ("vou ser avisado quando ficar pronto?", "acompanhamento"),
+    ("meu carro vai ficar pronto hoje?", None),  # Status do próprio atendimento: vai para a IA
+    ("qual a previsão de conclusão?", None),
+    ("bom dia tudo bem", None),
+    ("obrigado", None),
+    ("quanto custa um parabrisa novo?", None),
+    ("aceitam cartão de crédito?", None),
+]
+
+VOCABULARY = (
+    "parabrisa vidro lateral traseiro retrovisor farol película trinca reparo troca garantia "
+    "seguro sinistro franquia calibração câmera sensor agendamento loja unidade endereço horário "
+    "sábado domingo feriado telefone central atendimento orçamento pagamento cartão boleto pix "
+    "prazo previsão entrega retirada fotos documentos nota fiscal vistoria peça fornecedor "
+    "instalação borracha infiltração ruído chuva sol teto solar caminhão moto frota empresa"
+).split()
+TEMPLATES = [
+    "Como funciona {a} para {b}?", "Vocês fazem {a} com {b}?", "Qual o prazo de {a} e {b}?",
+    "Preciso de {a} depois de {b}?", "Tem {a} na {b} ou {c}?", "{a} cobre {b} e {c}?",
+]
+
+
+def synthetic_entries(count: int, seed: int = 7) -> List[Dict[str, Any]]:
+    rng = random.Random(seed)
+    entries = []
+    for position in range(count):
+        perguntas = [rng.choice(TEMPLATES).format(a=rng.choice(VOCABULARY), b=rng.choice(VOCABULARY),
+                                                  c=rng.choice(VOCABULARY)) for _ in range(3)]
+        entries.append({
+            "id": f"sintetica-{position}",
+            "perguntas": perguntas,
+            "palavras_chave": rng.sample(VOCABULARY, 4),
+            "resposta": f"Resposta sintética {position}"
+        })
+    return entries
+
+
+def check_accuracy(index: "carglass_app.FaqIndex", min_score: float) -> int:
+    errors = 0
+    for question, expected in LABELED_QUESTIONS:
+        entry = index.answer(question, min_score)
+        found = entry.id if entry else None
+        if found != expected:
+            errors += 1
+            print(f"  erro: {question!r}: esperado {expected}, obtido {found}")
+    return errors
+
+
+def measure_queries(index: "carglass_app.FaqIndex", questions: List[str]) -> Dict[str, Any]:
+    latencies = []
+    start = time.perf_counter()
+    for question in questions:
+        t0 = time.perf_counter()
+        index.search(question)
+        latencies.append((time.perf_counter() - t0) * 1000)
+    return summarize_latencies(latencies, time.perf_counter() - start)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="FaqIndex: acurácia e latência de consulta")
+    parser.add_argument("--entries", type=int, nargs="+", default=[1000, 5000, 20000],
+                        help="Tamanhos das bases sintéticas")
+    parser.add_argument("--queries", type=int, default=2000, help="Consultas por base")
+    parser.add_argument("--output", help="Arquivo JSON de saída (padrão: benchmarks/results/faq-<commit>.json)")
+    args = parser.parse_args(argv)
+
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger("app").setLevel(logging.WARNING)
+
+    min_score = carglass_app.config.FAQ_MIN_SCORE
+    errors = check_accuracy(carglass_app.faq_index, min_score)
+    print(f"Acurácia ({len(LABELED_QUESTIONS)} perguntas, limite {min_score}): "
+          f"{len(LABELED_QUESTIONS) - errors}/{len(LABELED_QUESTIONS)}")
+
+    rng = random.Random(11)
+    results = {}
+    for count in args.entries:
+        entries = synthetic_entries(count)
+        start = time.perf_counter()
+        index = carglass_app.FaqIndex(entries)
+        build_ms = (time.perf_counter() - start) * 1000
+
+        # Consultas: metade de uma pergunta existente + uma palavra qualquer
+        questions = []
+        for _ in range(args.queries):
+            words = rng.choice(rng.choice(entries)["perguntas"]).split()
+            questions.append(" ".join(words[: max(2, len(words) // 2)] + [rng.choice(VOCABULARY)]))
+        stats = measure_queries(index, questions)
+        stats["build_ms"] = round(build_ms, 1)
+        results[str(count)] = stats
+        print(f"{count:>7} entradas: build {build_ms:>8.1f} ms  p50 {stats['p50_ms'] * 1000:>7.1f} µs  "
+              f"p95 {stats['p95_ms'] * 1000:>7.1f} µs  p99 {stats['p99_ms'] * 1000:>7.1f} µs")
+
+    report = {
+        "meta": run_metadata({"entries": args.entries, "queries": args.queries, "min_score": min_score}),
+        "accuracy_errors": errors,
+        "benchmarks": results
+    }
+    path = save_results(report, args.output, "faq")
+    print(f"\nResultado salvo em {path}")
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
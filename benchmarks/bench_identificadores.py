@@ -0,0 +1,121 @@
+"""
+Mede as sugestões "você quis dizer" (IdentifierMatcher) sobre bases
+sintéticas de placas: latência por consulta e equivalência com a
+varredura linear (distância de edição contra todas as placas).
+
+As consultas são placas existentes com um erro de digitação típico
+(tecla vizinha, caractere parecido, troca de posição ou caractere a
+mais/a menos) e uma parcela de placas aleatórias sem correspondência.
+
+Uso:
+    python benchmarks/bench_identificadores.py
+    python benchmarks/bench_identificadores.py --records 10000 100000 300000 --queries 500
+"""
+import argparse
+import logging
+import random
+import string
+import sys
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from _common import prepare_environment, run_metadata, save_results, summarize_latencies
+
+prepare_environment()
+import app as carglass_app  # noqa: E402
+
+
+def random_plate(rng: random.Random) -> str:
+    letters = "".join(rng.choice(string.ascii_uppercase) for _ in range(3))
+    if rng.random() < 0.5:
+        return f"{letters}{rng.randint(0, 9999):04d}"  # Padrão antigo
+    return f"{letters}{rng.randint(0, 9)}{rng.choice(string.ascii_uppercase)}{rng.randint(0, 99):02d}"  # Mercosul
+
+
+def typo(plate: str, rng: random.Random) -> str:
+    position = rng.randrange(len(plate))
+    kind = rng.choice(("vizinha", "parecido", "troca", "remove", "insere"))
+    if kind == "vizinha":
+        neighbors = sorted(carglass_app.KEYBOARD_NEIGHBORS.get(plate[position], {plate[position]}))
+        return plate[:position] + rng.choice(neighbors) + plate[position + 1:]
+    if kind == "parecido":
+        pairs = [b for a, b in carglass_app.CONFUSABLE if a == plate[position]]
+        return plate[:position] + (rng.choice(pairs) if pairs else plate[position]) + plate[position + 1:]
+    if kind == "troca" and position < len(plate) - 1:
+        return plate[:position] + plate[position + 1] + plate[position] + plate[position + 2:]
+    if kind == "remove":
+        return plate[:position] + plate[position + 1:]
+    return plate[:position] + rng.choice(string.ascii_uppercase + string.digits) + plate[position:]
+
+
+def linear_candidates(plates: List[str], typed: str, max_distance: float, limit: int = 3) -> List[Tuple[str, float]]:
+    """Referência: distância de edição contra todas as placas"""
+    scored = []
+    for plate in plates:
+        if plate == typed:
+            return []
+        distance = carglass_app.typo_distance(typed, plate)
+        if distance <= max_distance:
+            scored.append((plate, distance))
+    return sorted(scored, key=lambda item: (item[1], item[0]))[:limit]
+
+
+def timed(func, queries: List[str]) -> Tuple[List[Any], Dict[str, Any]]:
+    answers, latencies = [], []
+    start = time.perf_counter()
+    for query in queries:
+        t0 = time.perf_counter()
+        answers.append(func(query))
+        latencies.append((time.perf_counter() - t0) * 1000)
+    return answers, summarize_latencies(latencies, time.perf_counter() - start)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="IdentifierMatcher: latência e equivalência com varredura linear")
+    parser.add_argument("--records", type=int, nargs="+", default=[10000, 100000, 300000],
+                        help="Quantidade de placas em cada base")
+    parser.add_argument("--queries", type=int, default=300, help="Consultas por base")
+    parser.add_argument("--linear-queries", type=int, default=10,
+                        help="Consultas conferidas com a varredura linear (é lenta)")
+    parser.add_argument("--output", help="Arquivo JSON de saída (padrão: benchmarks/results/identificadores-<commit>.json)")
+    args = parser.parse_args(argv)
+
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger("app").setLevel(logging.WARNING)
+
+    max_distance = carglass_app.config.FUZZY_MAX_DISTANCE
+    rng = random.Random(13)
+    mismatches = 0
+    results = {}
+    for count in args.records:
+        plates = sorted({random_plate(rng) for _ in range(count)})
+        matcher = carglass_app.IdentifierMatcher(max_distance)
+        start = time.perf_counter()
+        matcher.add_many("placa", plates)
+        build_ms = (time.perf_counter() - start) * 1000
+
+        queries = [typo(rng.choice(plates), rng) if rng.random() < 0.8 else random_plate(rng)
+                   for _ in range(args.queries)]
+        answers, stats = timed(lambda query: matcher.candidates("placa", query), queries)
+        diverged = sum(1 for query, answer in zip(queries[:args.linear_queries], answers)
+                       if answer != linear_candidates(plates, query, max_distance))
+        mismatches += diverged
+
+        stats.update({"build_ms": round(build_ms, 1), "mismatches": diverged,
+                      "with_candidates": sum(1 for answer in answers if answer)})
+        results[str(len(plates))] = stats
+        print(f"{len(plates):>7} placas: build {build_ms:>9.1f} ms  p50 {stats['p50_ms']:>6.2f} ms  "
+              f"p95 {stats['p95_ms']:>6.2f} ms  p99 {stats['p99_ms']:>6.2f} ms  "
+              f"{'ok' if not diverged else f'{diverged} divergências'}")
+
+    report = {
+        "meta": run_metadata({"records": args.records, "queries": args.queries, "max_distance": max_distance}),
+        "benchmarks": results
+    }
+    path = save_results(report, args.output, "identificadores")
+    print(f"\nResultado salvo em {path}")
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
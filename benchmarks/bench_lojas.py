@@ -0,0 +1,113 @@
+"""
+Compara a busca das lojas mais próximas (KDTree do StoreCatalog) com a
+varredura linear sobre catálogos sintéticos de milhares de lojas.
+
+Verifica primeiro que as duas devolvem as mesmas lojas para todas as
+consultas e depois mede a latência por consulta de cada uma.
+
+Uso:
+    python benchmarks/bench_lojas.py
+    python benchmarks/bench_lojas.py --stores 1000 10000 100000 --queries 2000 -k 5
+"""
+import argparse
+import logging
+import math
+import random
+import sys
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from _common import prepare_environment, run_metadata, save_results, summarize_latencies
+
+prepare_environment()
+import app as carglass_app  # noqa: E402
+
+# Retângulo aproximado do território brasileiro (lat, lon)
+LAT_RANGE = (-33.7, 5.2)
+LON_RANGE = (-73.9, -34.8)
+
+
+def synthetic_stores(count: int, seed: int = 3) -> List[Dict[str, Any]]:
+    rng = random.Random(seed)
+    return [{
+        "id": f"loja-{position}",
+        "nome": f"CarGlass {position}",
+        "endereco": f"Rua Sintética, {position}",
+        "bairro": "Centro",
+        "cidade": "Cidade",
+        "lat": rng.uniform(*LAT_RANGE),
+        "lon": rng.uniform(*LON_RANGE)
+    } for position in range(count)]
+
+
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    dlat, dlon = math.radians(lat2 - lat1), math.radians(lon2 - lon1)
+    a = (math.sin(dlat / 2) ** 2
+         + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dlon / 2) ** 2)
+    return 2 * carglass_app.EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def linear_nearest(stores: List["carglass_app.Store"], lat: float, lon: float, k: int) -> List[str]:
+    """Referência: distância de haversine para todas as lojas"""
+    ranked = sorted(stores, key=lambda store: haversine_km(lat, lon, store.lat, store.lon))
+    return [store.id for store in ranked[:k]]
+
+
+def timed(func, queries: List[Tuple[float, float]]) -> Tuple[List[Any], Dict[str, Any]]:
+    answers, latencies = [], []
+    start = time.perf_counter()
+    for lat, lon in queries:
+        t0 = time.perf_counter()
+        answers.append(func(lat, lon))
+        latencies.append((time.perf_counter() - t0) * 1000)
+    return answers, summarize_latencies(latencies, time.perf_counter() - start)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Lojas mais próximas: k-d tree vs. varredura linear")
+    parser.add_argument("--stores", type=int, nargs="+", default=[1000, 10000, 50000],
+                        help="Tamanhos dos catálogos sintéticos")
+    parser.add_argument("--queries", type=int, default=1000, help="Consultas por catálogo")
+    parser.add_argument("-k", type=int, default=3, help="Lojas por consulta")
+    parser.add_argument("--linear-queries", type=int, default=200,
+                        help="Consultas medidas na varredura linear (é lenta)")
+    parser.add_argument("--output", help="Arquivo JSON de saída (padrão: benchmarks/results/lojas-<commit>.json)")
+    args = parser.parse_args(argv)
+
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger("app").setLevel(logging.WARNING)
+
+    rng = random.Random(5)
+    mismatches = 0
+    results = {}
+    for count in args.stores:
+        start = time.perf_counter()
+        catalog = carglass_app.StoreCatalog(synthetic_stores(count), {})
+        build_ms = (time.perf_counter() - start) * 1000
+
+        queries = [(rng.uniform(*LAT_RANGE), rng.uniform(*LON_RANGE)) for _ in range(args.queries)]
+        tree_answers, tree_stats = timed(
+            lambda lat, lon: [store.id for store, _ in catalog.nearest(lat, lon, args.k)], queries)
+        linear_queries = queries[:args.linear_queries]
+        linear_answers, linear_stats = timed(
+            lambda lat, lon: linear_nearest(catalog.stores, lat, lon, args.k), linear_queries)
+
+        diverged = sum(1 for tree, linear in zip(tree_answers, linear_answers) if tree != linear)
+        mismatches += diverged
+        results[str(count)] = {"build_ms": round(build_ms, 1), "kdtree": tree_stats,
+                               "linear": linear_stats, "mismatches": diverged}
+        print(f"{count:>7} lojas: build {build_ms:>8.1f} ms  k-d tree p50 {tree_stats['p50_ms'] * 1000:>7.1f} µs "
+              f"p99 {tree_stats['p99_ms'] * 1000:>7.1f} µs  linear p50 {linear_stats['p50_ms']:>8.2f} ms  "
+              f"{'ok' if not diverged else f'{diverged} divergências'}")
+
+    report = {
+        "meta": run_metadata({"stores": args.stores, "queries": args.queries, "k": args.k}),
+        "benchmarks": results
+    }
+    path = save_results(report, args.output, "lojas")
+    print(f"\nResultado salvo em {path}")
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,102 @@
+"""
+Compara o sanitize_input atual com a implementação anterior (bleach +
+escape em toda mensagem) sobre um corpus de mensagens de chat realistas.
+
+Verifica primeiro que as duas produzem a mesma saída em todo o corpus
+(mais entradas aleatórias) e depois mede ops/s de cada uma.
+
+Uso:
+    python benchmarks/bench_sanitize.py
+    python benchmarks/bench_sanitize.py --fuzz 20000 --seconds 0.5
+"""
+import argparse
+import logging
+import random
+import sys
+import time
+from typing import Callable, List, Optional
+
+import bleach
+from markupsafe import escape
+
+from _common import prepare_environment
+
+prepare_environment()
+import app as carglass_app  # noqa: E402
+
+# Distribuição aproximada do tráfego real: identificadores e perguntas curtas
+# dominam; marcação/entidades são raras.
+CHAT_CORPUS = [
+    "12345678900", "123.456.789-00", "ABC1234", "abc1d23", "(11) 98765-4321", "11976543210",
+    "123456", "oi", "Olá, bom dia!", "status", "qual o status do meu atendimento?",
+    "como está o andamento do serviço?", "e a garantia, cobre o quê?", "onde fica a loja?",
+    "quero falar com um atendente", "quais serviços vocês oferecem?", "obrigado 😊",
+    "Meu carro é o \"Civic\" prata", "what's up", "tem previsão pra hoje?",
+    "Tom & Jerry", "<b>urgente</b> preciso do carro", "<script>alert('xss')</script>oi",
+    "linha 1\r\nlinha 2", "preço < 500?",
+    "Bom dia, gostaria de saber quando meu carro fica pronto porque preciso dele para viajar. " * 10,
+]
+
+
+def legacy_sanitize(text: str) -> str:
+    """Implementação anterior: parse HTML completo em toda mensagem"""
+    if not text:
+        return ""
+    text = bleach.clean(text, tags=[], strip=True)
+    text = escape(text)
+    return text[:2000].strip()
+
+
+def fuzz_inputs(count: int, seed: int = 42) -> List[str]:
+    rng = random.Random(seed)
+    alphabet = "abcdeABCDE0123456789 \t\n\r\"'<>&;/=\x00\x01\x0b\x1f\x7fçãé😊"
+    return ["".join(rng.choice(alphabet) for _ in range(rng.randint(0, 40))) for _ in range(count)]
+
+
+def check_equivalence(inputs: List[str]) -> int:
+    mismatches = 0
+    for text in inputs:
+        if len(text) > 2000:
+            continue  # Acima do limite o corte agora ocorre antes do parse
+        expected, current = legacy_sanitize(text), carglass_app.sanitize_input(text)
+        if str(expected) != str(current):
+            mismatches += 1
+            if mismatches <= 5:
+                print(f"  divergência: {text!r}: {str(expected)!r} != {str(current)!r}")
+    return mismatches
+
+
+def ops_per_sec(func: Callable[[str], str], inputs: List[str], seconds: float, repeat: int) -> float:
+    best = 0.0
+    for _ in range(repeat):
+        calls = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < seconds:
+            for text in inputs:
+                func(text)
+            calls += len(inputs)
+        best = max(best, calls / (time.perf_counter() - start))
+    return best
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="sanitize_input: atual vs. implementação anterior")
+    parser.add_argument("--fuzz", type=int, default=5000, help="Entradas aleatórias na verificação")
+    parser.add_argument("--seconds", type=float, default=0.3, help="Duração de cada rodada")
+    parser.add_argument("--repeat", type=int, default=3, help="Rodadas (usa a melhor)")
+    args = parser.parse_args(argv)
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    mismatches = check_equivalence(CHAT_CORPUS + fuzz_inputs(args.fuzz))
+    print(f"Equivalência: {'ok' if not mismatches else f'{mismatches} divergências'}")
+
+    legacy = ops_per_sec(legacy_sanitize, CHAT_CORPUS, args.seconds, args.repeat)
+    current = ops_per_sec(carglass_app.sanitize_input, CHAT_CORPUS, args.seconds, args.repeat)
+    print(f"anterior: {legacy:>12,.0f} ops/s")
+    print(f"atual:    {current:>12,.0f} ops/s  ({current / legacy:.1f}x)")
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,338 @@
+"""
+Teste de carga ponta a ponta dos fluxos de chat (web) e webhook WhatsApp.
+
+Cada usuário virtual executa, em loop, roteiros de conversa realistas
+(identificação por CPF/placa/telefone seguida de perguntas sobre status,
+garantia e lojas) contra `/get_messages`, `/send_message`, `/reset` e
+`/whatsapp/webhook`. Ao final são reportados p50/p95/p99 e throughput por
+rota, e o resultado é gravado em JSON para comparação entre commits.
+
+Uso:
+    # Em processo (Flask test client, dados mockados, Twilio simulado)
+    python benchmarks/load_test.py --users 8 --duration 20
+
+    # Contra um servidor rodando (webhook só é exercitado com --twilio-token)
+    python benchmarks/load_test.py --url http://localhost:5000 --users 4
+
+    # Comparação com um resultado anterior (falha se p95 piorar > 20%)
+    python benchmarks/load_test.py --compare benchmarks/results/load-abc123.json
+"""
+import argparse
+import itertools
+import logging
+import sys
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from _common import (load_results, prepare_environment, relative_change,
+                     run_metadata, save_results, summarize_latencies)
+
+# ===== ROTEIROS DE CONVERSA =====
+# Cada passo: (rota, mensagem). Para rotas sem mensagem usa-se None.
+WEB_SCRIPTS: Dict[str, List[Tuple[str, Optional[str]]]] = {
+    "web_cpf": [
+        ("/get_messages", None),
+        ("/send_message", "12345678900"),
+        ("/send_message", "qual o status do meu atendimento?"),
+        ("/send_message", "e a garantia, como funciona?"),
+        ("/send_message", "onde fica a loja?"),
+        ("/reset", None),
+    ],
+    "web_placa": [
+        ("/get_messages", None),
+        ("/send_message", "ABC1234"),
+        ("/send_message", "como está o andamento?"),
+        ("/send_message", "quero falar com atendente"),
+        ("/reset", None),
+    ],
+    "web_telefone": [
+        ("/get_messages", None),
+        ("/send_message", "(11) 97654-3210"),
+        ("/send_message", "qual a situação do serviço?"),
+        ("/send_message", "quais são as lojas? onde fica cada uma"),
+        ("/send_message", "a garantia cobre o quê?"),
+        ("/reset", None),
+    ],
+    "web_nao_encontrado": [
+        ("/get_messages", None),
+        ("/send_message", "99999999"),
+        ("/send_message", "JKL3456"),
+        ("/send_message", "status"),
+        ("/reset", None),
+    ],
+}
+
+WHATSAPP_SCRIPTS: Dict[str, List[str]] = {
+    "whatsapp_cpf": ["oi", "98765432100", "status", "garantia", "reiniciar"],
+    "whatsapp_placa": ["GHI9012", "como está o andamento?", "ajuda", "reiniciar"],
+}
+
+WEBHOOK_ROUTE = "/whatsapp/webhook"
+
+
+class FakeTwilioClient:
+    """Substitui o client Twilio em processo: registra envios sem rede"""
+
+    class _Messages:
+        def __init__(self):
+            self.sent = 0
+            self._lock = threading.Lock()
+
+        def create(self, body: str, from_: str, to: str):
+            with self._lock:
+                self.sent += 1
+                sid = f"SMbench{self.sent:010d}"
+            return type("FakeMessage", (), {"sid": sid})()
+
+    def __init__(self):
+        self.messages = self._Messages()
+
+
+# ===== DRIVERS =====
+class InProcessDriver:
+    """Executa requisições via Flask test client (um client por usuário virtual)"""
+
+    def __init__(self, keep_limits: bool):
+        prepare_environment(
+            TWILIO_ACCOUNT_SID="ACbenchmark0000000000000000000000",
+            TWILIO_AUTH_TOKEN="benchmark-auth-token",
+        )
+        import app as carglass_app
+        from twilio.request_validator import RequestValidator
+
+        self.module = carglass_app
+        self.flask_app = carglass_app.app
+        self.validator = RequestValidator(carglass_app.config.TWILIO_AUTH_TOKEN)
+        self.fake_twilio = FakeTwilioClient()
+        self.webhook_enabled = carglass_app.twilio_handler.is_enabled()
+        if self.webhook_enabled:
+            carglass_app.twilio_handler.client = self.fake_twilio
+
+        if not keep_limits:
+            carglass_app.limiter.enabled = False
+
+    def new_client(self, remote_addr: str) -> Callable[[str, str, Optional[Dict[str, str]]], int]:
+        client = self.flask_app.test_client()
+        environ = {"REMOTE_ADDR": remote_addr}
+
+        def call(method: str, route: str, data: Optional[Dict[str, str]] = None) -> int:
+            headers = {}
+            if route == WEBHOOK_ROUTE:
+                url = "http://localhost" + route
+                headers["X-Twilio-Signature"] = self.validator.compute_signature(url, data or {})
+            if method == "POST":
+                response = client.post(route, data=data or {}, headers=headers, environ_base=environ)
+            else:
+                response = client.get(route, headers=headers, environ_base=environ)
+            return response.status_code
+
+        return call
+
+
+class HttpDriver:
+    """Executa requisições contra um servidor real via requests"""
+
+    def __init__(self, base_url: str, twilio_token: Optional[str]):
+        import requests
+        self.requests = requests
+        self.base_url = base_url.rstrip("/")
+        self.validator = None
+        self.webhook_enabled = bool(twilio_token)
+        if twilio_token:
+            from twilio.request_validator import RequestValidator
+            self.validator = RequestValidator(twilio_token)
+
+    def new_client(self, remote_addr: str) -> Callable[[str, str, Optional[Dict[str, str]]], int]:
+        http = self.requests.Session()
+
+        def call(method: str, route: str, data: Optional[Dict[str, str]] = None) -> int:
+            url = self.base_url + route
+            headers = {}
+            if route == WEBHOOK_ROUTE and self.validator:
+                headers["X-Twilio-Signature"] = self.validator.compute_signature(url, data or {})
+            response = http.request(method, url, data=data, headers=headers, timeout=60)
+            return response.status_code
+
+        return call
+
+
+# ===== EXECUÇÃO =====
+class LoadRecorder:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.status_codes: Dict[str, Dict[int, int]] = defaultdict(lambda: defaultdict(int))
+        self._lock = threading.Lock()
+
+    def record(self, route: str, elapsed_ms: float, status_code: int):
+        with self._lock:
+            self.latencies[route].append(elapsed_ms)
+            self.status_codes[route][status_code] += 1
+            if status_code >= 400:
+                self.errors[route] += 1
+
+
+def build_scenarios(include_web: bool, include_whatsapp: bool) -> List[Tuple[str, str]]:
+    scenarios = []
+    if include_web:
+        scenarios += [("web", name) for name in WEB_SCRIPTS]
+    if include_whatsapp:
+        scenarios += [("whatsapp", name) for name in WHATSAPP_SCRIPTS]
+    return scenarios
+
+
+def run_conversation(driver, recorder: LoadRecorder, kind: str, name: str, conversation_id: int):
+    # IP e telefone únicos por conversa: evita que o bloqueio anti-abuso
+    # (200 req/h por IP) e as sessões WhatsApp contaminem a medição
+    remote_addr = f"10.{(conversation_id >> 16) & 255}.{(conversation_id >> 8) & 255}.{conversation_id & 255}"
+    call = driver.new_client(remote_addr)
+
+    if kind == "web":
+        for route, message in WEB_SCRIPTS[name]:
+            method = "GET" if route == "/get_messages" else "POST"
+            data = {"message": message} if message is not None else None
+            start = time.perf_counter()
+            status_code = call(method, route, data)
+            recorder.record(route, (time.perf_counter() - start) * 1000, status_code)
+    else:
+        phone = f"whatsapp:+55119{conversation_id % 100000000:08d}"
+        for index, message in enumerate(WHATSAPP_SCRIPTS[name]):
+            data = {
+                "From": phone,
+                "Body": message,
+                "MessageSid": f"SMbench{conversation_id:08d}{index:02d}",
+            }
+            start = time.perf_counter()
+            status_code = call("POST", WEBHOOK_ROUTE, data)
+            recorder.record(WEBHOOK_ROUTE, (time.perf_counter() - start) * 1000, status_code)
+
+
+def run_load(driver, users: int, duration: float, iterations: Optional[int],
+             scenarios: List[Tuple[str, str]]) -> Tuple[LoadRecorder, float]:
+    recorder = LoadRecorder()
+    counter = itertools.count(1)
+    counter_lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker(user_index: int):
+        done = 0
+        while True:
+            if iterations is not None and done >= iterations:
+                break
+            if iterations is None and time.perf_counter() >= deadline:
+                break
+            with counter_lock:
+                conversation_id = next(counter)
+            kind, name = scenarios[(user_index + done) % len(scenarios)]
+            run_conversation(driver, recorder, kind, name, conversation_id)
+            done += 1
+
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(users)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return recorder, time.perf_counter() - start
+
+
+def build_report(recorder: LoadRecorder, elapsed: float, params: Dict[str, Any]) -> Dict[str, Any]:
+    routes = {}
+    for route in sorted(recorder.latencies):
+        summary = summarize_latencies(recorder.latencies[route], elapsed, recorder.errors[route])
+        summary["status_codes"] = {str(code): count for code, count in sorted(recorder.status_codes[route].items())}
+        routes[route] = summary
+
+    all_latencies = [value for values in recorder.latencies.values() for value in values]
+    return {
+        "meta": run_metadata(params),
+        "elapsed_s": round(elapsed, 3),
+        "routes": routes,
+        "total": summarize_latencies(all_latencies, elapsed, sum(recorder.errors.values()))
+    }
+
+
+def print_report(report: Dict[str, Any]):
+    header = f"{'rota':<22}{'reqs':>8}{'erros':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>10}"
+    print(header)
+    print("-" * len(header))
+    rows = list(report["routes"].items()) + [("TOTAL", report["total"])]
+    for route, summary in rows:
+        print(f"{route:<22}{summary['count']:>8}{summary['errors']:>7}"
+              f"{summary['p50_ms']:>10.2f}{summary['p95_ms']:>10.2f}{summary['p99_ms']:>10.2f}"
+              f"{summary['throughput_rps']:>10.1f}")
+
+
+def compare_reports(baseline: Dict[str, Any], current: Dict[str, Any], max_regression: float) -> bool:
+    """Compara p95 e throughput por rota; retorna False se alguma rota regrediu além do limite"""
+    ok = True
+    print(f"\nComparação com baseline {baseline['meta'].get('commit')} (limite {max_regression:.0%}):")
+    for route, summary in current["routes"].items():
+        base = baseline.get("routes", {}).get(route)
+        if not base:
+            print(f"  {route:<22} sem baseline")
+            continue
+        p95_delta = relative_change(base["p95_ms"], summary["p95_ms"])
+        rps_delta = relative_change(base["throughput_rps"], summary["throughput_rps"])
+        regressed = p95_delta > max_regression
+        ok = ok and not regressed
+        flag = "REGRESSÃO" if regressed else "ok"
+        print(f"  {route:<22} p95 {p95_delta:+.1%}  throughput {rps_delta:+.1%}  {flag}")
+    return ok
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Teste de carga dos fluxos de chat e webhook")
+    parser.add_argument("--url", help="URL base de um servidor rodando (padrão: em processo)")
+    parser.add_argument("--twilio-token", help="Auth token para assinar o webhook no modo --url")
+    parser.add_argument("--users", type=int, default=4, help="Usuários virtuais concorrentes")
+    parser.add_argument("--duration", type=float, default=10.0, help="Duração em segundos")
+    parser.add_argument("--iterations", type=int, help="Conversas por usuário (substitui --duration)")
+    parser.add_argument("--only", choices=["web", "whatsapp"], help="Executa apenas um tipo de fluxo")
+    parser.add_argument("--keep-limits", action="store_true", help="Mantém o rate limiting do flask-limiter")
+    parser.add_argument("--log-level", default="WARNING", help="Nível de log da aplicação durante o teste")
+    parser.add_argument("--output", help="Arquivo JSON de saída (padrão: benchmarks/results/load-<commit>.json)")
+    parser.add_argument("--compare", help="Resultado JSON anterior para comparação")
+    parser.add_argument("--max-regression", type=float, default=0.20, help="Regressão máxima tolerada no p95")
+    args = parser.parse_args(argv)
+
+    if args.url:
+        driver = HttpDriver(args.url, args.twilio_token)
+    else:
+        driver = InProcessDriver(args.keep_limits)
+    logging.getLogger().setLevel(args.log_level.upper())
+    for handler in logging.getLogger().handlers:
+        handler.setLevel(args.log_level.upper())
+
+    include_whatsapp = args.only != "web" and driver.webhook_enabled
+    if args.only == "whatsapp" and not include_whatsapp:
+        print("Webhook indisponível neste modo (use --twilio-token com --url)")
+        return 2
+    scenarios = build_scenarios(args.only != "whatsapp", include_whatsapp)
+
+    params = {
+        "mode": "http" if args.url else "in-process",
+        "users": args.users,
+        "duration": None if args.iterations else args.duration,
+        "iterations": args.iterations,
+        "scenarios": [name for _, name in scenarios],
+    }
+    print(f"Executando {params['mode']} com {args.users} usuários, roteiros: {', '.join(params['scenarios'])}")
+
+    recorder, elapsed = run_load(driver, args.users, args.duration, args.iterations, scenarios)
+    report = build_report(recorder, elapsed, params)
+    print_report(report)
+
+    path = save_results(report, args.output, "load")
+    print(f"\nResultado salvo em {path}")
+
+    if args.compare:
+        if not compare_reports(load_results(args.compare), report, args.max_regression):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,196 @@
+"""
+Micro-benchmarks das funções puras executadas a cada mensagem.
+
+Para cada função mede-se ops/s (melhor de N repetições, alternando entre
+entradas representativas) e o pico de memória alocada por chamada via
+tracemalloc. O resultado pode ser gravado como baseline e verificado
+contra ele com um limite de regressão.
+
+Uso:
+    python benchmarks/micro_bench.py                    # executa e imprime
+    python benchmarks/micro_bench.py --save-baseline    # atualiza baseline_micro.json
+    python benchmarks/micro_bench.py --check            # falha se ops/s cair > 30%
+    python benchmarks/micro_bench.py --only sanitize_input --check --threshold 0.15
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from _common import (BENCH_DIR, load_results, prepare_environment, relative_change,
+                     run_metadata, save_results)
+
+BASELINE_PATH = os.path.join(BENCH_DIR, "baseline_micro.json")
+
+prepare_environment()
+import app as carglass_app  # noqa: E402
+
+MOCK_CPFS = ["12345678900", "98765432100", "11122233344", "33344455566",
+             "44455566677", "55566677788", "77788899900", "22233344455"]
+CLIENTS = [carglass_app.get_mock_data("cpf", cpf) for cpf in MOCK_CPFS]
+STATUSES = [client["dados"]["status"] for client in CLIENTS] + ["Status Desconhecido"]
+
+LONG_TEXT = ("Bom dia, gostaria de saber quando meu carro fica pronto porque preciso "
+             "dele para viajar no fim de semana e ainda não recebi nenhuma atualização. ") * 12
+
+SAMPLE_HTML_RESPONSE = (
+    "<strong>Olá Carlos!</strong> Seu atendimento está <em>em andamento</em>.\n\n\n"
+    + carglass_app.get_progress_bar_html(CLIENTS[0])
+    + "\n<b>Próximas etapas:</b> Inspeção, Concluído &amp; entrega.   Até logo!"
+)
+
+
+def build_cases() -> Dict[str, Tuple[Callable[..., Any], List[Tuple[Any, ...]]]]:
+    """Função + lista de argumentos representativos para cada benchmark"""
+    return {
+        "detect_identifier_type": (carglass_app.detect_identifier_type, [
+            ("12345678900",), ("(11) 97654-3210",), ("ABC1234",), ("abc1d23",),
+            ("123456",), ("qual o status do meu atendimento?",),
+        ]),
+        "validate_cpf": (carglass_app.validate_cpf, [
+            ("12345678900",), ("52998224725",), ("11111111111",), ("12345678901",),
+        ]),
+        "sanitize_input": (carglass_app.sanitize_input, [
+            ("12345678900",), ("ABC1234",), ("qual o status do meu atendimento?",),
+            ("e a garantia? cobre trinca",), ("<script>alert('xss')</script>oi",),
+            ("Tom & Jerry's \"carro\"",), (LONG_TEXT,),
+        ]),
+        "format_for_whatsapp": (carglass_app.format_for_whatsapp, [
+            (SAMPLE_HTML_RESPONSE,),
+            ("Olá Carlos Silva! Seu atendimento está atualmente com o status: *Em andamento*.",),
+            (LONG_TEXT,),
+        ]),
+        "get_progress_bar_html": (carglass_app.get_progress_bar_html, [(client,) for client in CLIENTS]),
+        "get_whatsapp_status_text": (carglass_app.get_whatsapp_status_text, [(client,) for client in CLIENTS]),
+        "get_status_details": (carglass_app.get_status_details, [(status,) for status in STATUSES]),
+    }
+
+
+def measure_ops(func: Callable[..., Any], inputs: List[Tuple[Any, ...]],
+                repeat: int, target_seconds: float) -> float:
+    """Melhor ops/s entre `repeat` rodadas calibradas para ~target_seconds cada"""
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            for args in inputs:
+                func(*args)
+        elapsed = time.perf_counter() - start
+        if elapsed >= target_seconds / 10 or loops >= 1_000_000:
+            break
+        loops *= 4
+    loops = max(1, int(loops * (target_seconds / max(elapsed, 1e-9))))
+
+    best = 0.0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(loops):
+            for args in inputs:
+                func(*args)
+        elapsed = time.perf_counter() - start
+        best = max(best, (loops * len(inputs)) / elapsed)
+    return best
+
+
+def measure_allocations(func: Callable[..., Any], inputs: List[Tuple[Any, ...]]) -> Dict[str, float]:
+    """Pico médio e máximo de bytes alocados por chamada (tracemalloc)"""
+    peaks = []
+    tracemalloc.start()
+    try:
+        for args in inputs:
+            func(*args)  # Aquece caches internos (regex, etc.) fora da medição
+        for args in inputs:
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            func(*args)
+            _, peak = tracemalloc.get_traced_memory()
+            peaks.append(max(0, peak - before))
+    finally:
+        tracemalloc.stop()
+    return {
+        "alloc_peak_avg_bytes": round(sum(peaks) / len(peaks), 1),
+        "alloc_peak_max_bytes": max(peaks)
+    }
+
+
+def run_benchmarks(only: Optional[List[str]], repeat: int, target_seconds: float) -> Dict[str, Dict[str, Any]]:
+    results = {}
+    for name, (func, inputs) in build_cases().items():
+        if only and name not in only:
+            continue
+        ops = measure_ops(func, inputs, repeat, target_seconds)
+        entry = {"ops_per_sec": round(ops, 1), "us_per_op": round(1e6 / ops, 3), "inputs": len(inputs)}
+        entry.update(measure_allocations(func, inputs))
+        results[name] = entry
+        print(f"{name:<28}{entry['ops_per_sec']:>14,.0f} ops/s{entry['us_per_op']:>10.2f} µs/op"
+              f"{entry['alloc_peak_avg_bytes']:>12,.0f} B pico/op")
+    return results
+
+
+def check_against_baseline(baseline: Dict[str, Any], results: Dict[str, Dict[str, Any]],
+                           threshold: float) -> bool:
+    """Retorna False se alguma função perdeu mais que `threshold` de ops/s"""
+    ok = True
+    print(f"\nVerificação contra baseline {baseline['meta'].get('commit')} (limite {threshold:.0%}):")
+    for name, entry in results.items():
+        base = baseline.get("benchmarks", {}).get(name)
+        if not base:
+            print(f"  {name:<28} sem baseline")
+            continue
+        # Perda de throughput: -0.30 significa 30% menos ops/s
+        change = relative_change(base["ops_per_sec"], entry["ops_per_sec"])
+        regressed = change < -threshold
+        ok = ok and not regressed
+        print(f"  {name:<28} ops/s {change:+.1%}  {'REGRESSÃO' if regressed else 'ok'}")
+    return ok
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Micro-benchmarks das funções do caminho quente")
+    parser.add_argument("--only", nargs="+", help="Executa apenas as funções indicadas")
+    parser.add_argument("--repeat", type=int, default=5, help="Rodadas por função (usa a melhor)")
+    parser.add_argument("--seconds", type=float, default=0.2, help="Duração alvo de cada rodada")
+    parser.add_argument("--log-level", default="WARNING", help="Nível de log da aplicação (INFO mede o custo do logging)")
+    parser.add_argument("--output", help="Arquivo JSON de saída (padrão: benchmarks/results/micro-<commit>.json)")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="Arquivo de baseline")
+    parser.add_argument("--save-baseline", action="store_true", help="Grava o resultado como novo baseline")
+    parser.add_argument("--check", action="store_true", help="Compara com o baseline e falha em regressão")
+    parser.add_argument("--threshold", type=float, default=0.30, help="Perda máxima de ops/s tolerada")
+    args = parser.parse_args(argv)
+
+    logging.getLogger().setLevel(args.log_level.upper())
+    logging.getLogger("app").setLevel(args.log_level.upper())
+
+    results = run_benchmarks(args.only, args.repeat, args.seconds)
+    report = {
+        "meta": run_metadata({"repeat": args.repeat, "seconds": args.seconds, "log_level": args.log_level.upper()}),
+        "benchmarks": results
+    }
+
+    path = save_results(report, args.output, "micro")
+    print(f"\nResultado salvo em {path}")
+
+    if args.save_baseline:
+        if args.only and os.path.exists(args.baseline):
+            # Atualização parcial preserva as demais entradas do baseline
+            merged = load_results(args.baseline)
+            merged["benchmarks"].update(results)
+            merged["meta"] = report["meta"]
+            report = merged
+        save_results(report, args.baseline, "baseline")
+        print(f"Baseline atualizado em {args.baseline}")
+
+    if args.check:
+        if not os.path.exists(args.baseline):
+            print(f"Baseline não encontrado: {args.baseline}")
+            return 2
+        if not check_against_baseline(load_results(args.baseline), results, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,23 @@
+"""
+Miniaturas das fotos recebidas no WhatsApp.
+
+Separado do app.py porque roda nos processos do pool de miniaturas, que
+usa o contexto "spawn": cada processo importa só este módulo, sem
+carregar a aplicação Flask nem iniciar as threads de background dela.
+"""
+from typing import Optional
+
+try:
+    from PIL import Image  # Opcional: sem ele as fotos ficam sem miniatura
+except ImportError:
+    Image = None
+
+
+def make_thumbnail(source: str, target: str, size: int) -> Optional[str]:
+    """Grava a miniatura JPEG de source em target (None sem Pillow)"""
+    if Image is None:
+        return None
+    with Image.open(source) as image:
+        image.thumbnail((size, size))
+        image.convert("RGB").save(target, "JPEG", quality=80, optimize=True)
+    return target